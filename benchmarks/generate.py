@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""Generates synthetic Trivial Todo databases for benchmarking
+
+Reminders are drawn to look like a real list that has grown over a couple
+of years: a few categories hold most reminders (a Zipf distribution over
+CATEGORIES categories), content is a handful of words with the odd long
+note, most reminders have no due date, and due dates cluster around today
+with a tail far into the past and future. The same seed always gives the
+same database.
+
+    python benchmarks/generate.py 100000 /tmp/todo.sqlite
+"""
+
+import argparse
+import datetime
+import itertools
+import os
+import random
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import todo  # noqa: E402
+
+CATEGORIES = 40
+# Share of reminders with a due date, and the spread of due dates in days
+# around today
+DUE_SHARE = 0.4
+DUE_SPREAD = 45
+# Reminders are created over this many days before today
+HISTORY = 730
+WORDS = """
+buy call email fix book pay renew send check clean return order write read
+plan review update cancel pick drop schedule file sign print water feed walk
+milk bread eggs coffee rent insurance dentist doctor car bike garden kitchen
+report invoice meeting slides budget taxes passport visa tickets hotel gift
+birthday present mum dad sister brother team manager client landlord vet
+before after tomorrow weekend monday friday morning evening urgent later
+""".split()
+
+
+def category_weights(count=CATEGORIES, skew=1.1):
+    return [1.0 / (rank ** skew) for rank in range(1, count + 1)]
+
+
+def make_reminder(rng, categories, weights, today):
+    # Mostly short reminders, with a long tail of notes
+    length = max(1, min(int(rng.lognormvariate(1.6, 0.6)), 120))
+    content = ' '.join(rng.choice(WORDS) for _ in range(length))
+    category = rng.choices(categories, weights)[0]
+    date = today - datetime.timedelta(days=rng.randrange(HISTORY))
+    date_due = None
+    if rng.random() < DUE_SHARE:
+        date_due = today + datetime.timedelta(
+            days=int(rng.gauss(0, DUE_SPREAD)))
+    return todo.Reminder(content, category, date_due, date)
+
+
+def reminders(count=None, seed=0):
+    """Yields `count` synthetic reminders, or as many as are asked for"""
+    rng = random.Random(seed)
+    categories = ['category{:02d}'.format(rank)
+                  for rank in range(CATEGORIES)]
+    weights = category_weights()
+    today = datetime.date.today()
+    for _ in (range(count) if count is not None else itertools.count()):
+        yield make_reminder(rng, categories, weights, today)
+
+
+def generate(location, count, seed=0, batch_size=todo.IMPORT_BATCH_SIZE):
+    """Fills an empty database with `count` synthetic reminders, drawing
+    more for any that repeat one already added
+    Returns the number of reminders added.
+    """
+    drawn = reminders(seed=seed)
+    added = 0
+    with todo.TodoStore(location) as store:
+        while added < count:
+            more, skipped = store.add_many(
+                itertools.islice(drawn, count - added), batch_size)
+            added += more
+    return added
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('count', type=int, help="number of reminders")
+    parser.add_argument('location', help="""database to create, in any
+            form --db accepts""")
+    parser.add_argument('--seed', type=int, default=0)
+    options = parser.parse_args()
+
+    if todo._database_exists(options.location):
+        sys.exit("'{}' already exists".format(options.location))
+    print("Added {} reminders".format(
+        generate(options.location, options.count, options.seed)))
+
+
+if __name__ == '__main__':
+    main()
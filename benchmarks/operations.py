@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+"""Times the main Trivial Todo operations against large synthetic databases
+
+Each database size and backend is generated by generate.py and measured in a
+fresh process, so that its peak RSS is its own. Operations go through the
+same module functions the commands use, with the store kept open as it is
+for a running command, and commands print to /dev/null. Results give the
+ops/sec and p50/p99 latency of every operation as JSON; --record appends
+them to a JSON Lines history, and --compare reports what got slower since
+an earlier run.
+
+    python benchmarks/operations.py --sizes 1000,100000 --record ops.jsonl
+    python benchmarks/operations.py --compare ops.jsonl
+    python benchmarks/operations.py --compare before.json after.json
+
+dbm.dumb, the shelve fallback when no other dbm module is installed, slows
+down badly past ~10k reminders; use --backends sqlite,journal for 1M.
+"""
+
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import todo  # noqa: E402
+import generate  # noqa: E402
+
+try:
+    import resource
+except ImportError:  # Not on Unix
+    resource = None
+
+EXTENSIONS = {'shelve': '.shelve', 'sqlite': '.sqlite',
+              'journal': '.journal'}
+
+
+def peak_rss():
+    """Returns the peak resident set size of this process in KiB, or None
+    where it cannot be measured
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, everything else KiB
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def summarize(timings):
+    timings = sorted(timings)
+
+    def percentile(fraction):
+        return timings[min(len(timings) - 1,
+                           int(round(fraction * (len(timings) - 1))))]
+
+    return {'count': len(timings),
+            'ops_per_sec': round(len(timings) / sum(timings), 2),
+            'p50_ms': round(percentile(0.5) * 1000, 4),
+            'p99_ms': round(percentile(0.99) * 1000, 4)}
+
+
+def measure(call, arguments):
+    """Calls `call` with each set of arguments, returning the latencies"""
+    timings = []
+    for args in arguments:
+        started = time.perf_counter()
+        call(*args)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def run_case(size, backend, options):
+    """Generates a database and times every operation against it"""
+    rng = random.Random(options.seed)
+    directory = tempfile.mkdtemp()
+    location = os.path.join(directory, 'todo' + EXTENSIONS[backend])
+    result = {'size': size, 'backend': backend}
+    try:
+        started = time.perf_counter()
+        generate.generate(location, size, options.seed)
+        result['generate_s'] = round(time.perf_counter() - started, 3)
+
+        todo._session = todo.TodoStore(location)
+        with todo._session, open(os.devnull, 'w') as null, \
+                contextlib.redirect_stdout(null):
+            result['operations'] = dict(
+                (name, summarize(timings))
+                for name, timings in operations(todo._session, rng,
+                                                options))
+    finally:
+        todo._session = None
+        shutil.rmtree(directory)
+
+    result['peak_rss_kb'] = peak_rss()
+    return result
+
+
+def operations(store, rng, options):
+    """Yields the name and latencies of each operation in turn. Reads come
+    first so they all see the generated database.
+    """
+    count, scans = options.operations, options.scans
+    # Serials are drawn from those stored, which need not run from 1 to size
+    serials = [reminder.serial for reminder in store.iterate_serials()]
+    sample = [store.get(serial)
+              for serial in rng.sample(serials, min(len(serials), count))]
+    words = [reminder.content.split() for reminder in sample]
+    phrases = [' '.join(content[:2]) for content in words]
+    today = datetime.date.today()
+    week = (today, today + datetime.timedelta(days=7))
+
+    def pick(values, number):
+        return [(rng.choice(values),) for _ in range(number)]
+
+    def arguments(**values):
+        return [(todo._Arguments(**values),)] * scans
+
+    def search_args(**values):
+        defaults = dict(content=None, date_due=None, overdue=False,
+                        before=False, after=False, older=None, newer=None,
+                        insensitive=False)
+        defaults.update(values)
+        return arguments(**defaults)
+
+    yield 'search_field_serial', measure(
+        todo.search_field,
+        [(reminder.serial, 'serial') for reminder in sample])
+    yield 'search_field_category', measure(
+        todo.search_field,
+        [(sample[index % len(sample)].category, 'category')
+         for index in range(scans)])
+    yield 'search_in_content', measure(
+        todo.search_in_content, pick(phrases, scans))
+    yield 'search_in_content_insensitive', measure(
+        todo.search_in_content,
+        [(phrase.upper(), True) for (phrase,) in pick(phrases, scans)])
+    yield 'search_in_content_due', measure(
+        todo.search_in_content,
+        [(phrase, False, week) for (phrase,) in pick(phrases, scans)])
+    yield 'search_due', measure(todo.search_due, [(week,)] * scans)
+    yield 'search_due_before', measure(
+        todo.search, search_args(date_due=today.strftime('%Y-%m-%d'),
+                                 before=True))
+    yield 'search_overdue', measure(todo.search, search_args(overdue=True))
+    yield 'lst', measure(todo.lst, arguments(serial=None, category=None))
+    yield 'lst_category', measure(
+        todo.lst, arguments(serial=None, category=sample[0].category))
+
+    # Only reminders that are new, as the add command would refuse the rest
+    new, seen = [], set()
+    for reminder in generate.reminders(seed=options.seed + 1):
+        if len(new) == count:
+            break
+        key = (reminder.content, reminder.category, reminder.date_due)
+        if key not in seen and not store.exists(reminder):
+            seen.add(key)
+            new.append(reminder)
+    yield 'add_reminder', measure(
+        todo.add_reminder, [(reminder,) for reminder in new])
+    yield 'delete_reminder', measure(
+        todo.delete_reminder, [(reminder,) for reminder in sample])
+
+
+def revision():
+    """Returns the git commit being measured, marked if it has changes"""
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            universal_newlines=True, check=True).stdout.strip()
+        dirty = subprocess.run(
+            ['git', 'status', '--porcelain', '--untracked-files=no'],
+            cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            universal_newlines=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('+' if dirty else '')
+
+
+def load_results(path):
+    """Returns the last run recorded in a results or JSON Lines file"""
+    with open(path) as stream:
+        lines = [line for line in stream if line.strip()]
+    try:
+        return json.loads(''.join(lines))
+    except ValueError:
+        return json.loads(lines[-1])
+
+
+def compare(old, new, threshold, stream=sys.stdout):
+    """Prints how each operation changed between two runs
+    Returns the number of operations whose p50 grew by more than
+    `threshold` percent.
+    """
+    baseline = dict(((case['backend'], case['size'], name), stats)
+                    for case in old['cases']
+                    for name, stats in case['operations'].items())
+    regressions = 0
+    print("{:8} {:>8} {:32} {:>12} {:>12} {:>8}".format(
+        'backend', 'size', 'operation', 'old p50 ms', 'new p50 ms',
+        'change'), file=stream)
+    for case in new['cases']:
+        for name, stats in sorted(case['operations'].items()):
+            before = baseline.get((case['backend'], case['size'], name))
+            if before is None or not before['p50_ms']:
+                continue
+            change = (stats['p50_ms'] / before['p50_ms'] - 1) * 100
+            flag = ''
+            if change > threshold:
+                regressions += 1
+                flag = '  slower'
+            print("{:8} {:>8} {:32} {:>12} {:>12} {:>+7.1f}%{}".format(
+                case['backend'], case['size'], name, before['p50_ms'],
+                stats['p50_ms'], change, flag), file=stream)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default='1000,10000',
+                        help="""comma separated database sizes (default:
+                        1000,10000)""")
+    parser.add_argument('--backends', default='shelve,sqlite,journal',
+                        help="comma separated backends (default: all)")
+    parser.add_argument('--operations', '-n', type=int, default=200,
+                        help="""runs of each single reminder operation
+                        (default: 200)""")
+    parser.add_argument('--scans', type=int, default=20,
+                        help="""runs of each listing and search (default:
+                        20)""")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--record', metavar='FILE',
+                        help="append the results to a JSON Lines history")
+    parser.add_argument('--compare', nargs='+', metavar='FILE',
+                        help="""compare with the last run in FILE, or
+                        compare the last runs in two files without
+                        measuring""")
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        metavar='PERCENT',
+                        help="""p50 growth reported as a regression
+                        (default: 10)""")
+    parser.add_argument('--case', nargs=2, metavar=('SIZE', 'BACKEND'),
+                        help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.case:
+        size, backend = options.case
+        print(json.dumps(run_case(int(size), backend, options)))
+        return
+    baseline = None
+    if options.compare:
+        if len(options.compare) > 2:
+            parser.error("--compare takes one or two files")
+        baseline = load_results(options.compare[0])
+        if len(options.compare) == 2:
+            sys.exit(compare(baseline, load_results(options.compare[1]),
+                             options.threshold) and 1)
+
+    results = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'revision': revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'seed': options.seed,
+        'cases': [],
+    }
+    for backend in options.backends.split(','):
+        for size in options.sizes.split(','):
+            # A process per case keeps its peak RSS to itself
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__),
+                 '--case', size, backend,
+                 '--operations', str(options.operations),
+                 '--scans', str(options.scans), '--seed', str(options.seed)],
+                stdout=subprocess.PIPE, universal_newlines=True,
+                check=True).stdout
+            results['cases'].append(json.loads(output))
+
+    print(json.dumps(results, indent=2, sort_keys=True))
+    if options.record:
+        with open(options.record, 'a') as history:
+            history.write(json.dumps(results, sort_keys=True) + '\n')
+    if baseline is not None:
+        # Keep standard output to the JSON results
+        sys.exit(compare(baseline, results, options.threshold,
+                         sys.stderr) and 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+"""Measures how long Trivial Todo takes to import and to start commands
+
+The import time of todo and its slowest imports come from -X importtime,
+and each command is timed end to end against a small database in a
+temporary home directory. Results are printed as JSON, and appended to a
+JSON Lines history with --record so changes can be followed over time.
+
+    python benchmarks/startup.py --record benchmarks/startup.jsonl
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TODO = os.path.join(ROOT, 'todo.py')
+
+# Commands timed, by name. 'list' and 'search' take the fast path, 'verify'
+# builds the full parser and 'module' runs todo from its compiled bytecode.
+COMMANDS = {
+    'list': [TODO, 'list'],
+    'list_category': [TODO, 'list', '-c', 'work'],
+    'search': [TODO, 'search', 'item', '-i'],
+    'verify': [TODO, 'reindex', '--verify'],
+    'module': ['-m', 'todo', 'list'],
+}
+
+
+def import_times(environment):
+    """Returns the microseconds taken to import todo, and the modules it
+    imports that took longest, from -X importtime
+    """
+    output = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import todo'],
+        cwd=ROOT, env=environment, stderr=subprocess.PIPE,
+        universal_newlines=True, check=True).stderr
+
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        modules.append((name.strip(), int(own), int(cumulative)))
+
+    total = next(cumulative for name, own, cumulative in modules
+                 if name == 'todo')
+    # todo's own modules are imported after site's, at the end
+    start = max(index for index, module in enumerate(modules)
+                if module[0] == 'site') + 1
+    slowest = sorted(modules[start:-1], key=lambda module: -module[2])
+    return total, [{'module': name, 'cumulative_us': cumulative}
+                   for name, own, cumulative in slowest[:10]]
+
+
+def time_command(arguments, environment, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.time()
+        subprocess.run([sys.executable] + arguments, cwd=ROOT,
+                       env=environment, stdout=subprocess.DEVNULL,
+                       check=True)
+        timings.append((time.time() - started) * 1000)
+    timings.sort()
+    return {'best_ms': round(timings[0], 2),
+            'median_ms': round(timings[len(timings) // 2], 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--repeat', '-r', type=int, default=20,
+                        help="runs of each command (default: 20)")
+    parser.add_argument('--reminders', type=int, default=100,
+                        help="reminders in the database (default: 100)")
+    parser.add_argument('--record', metavar='FILE',
+                        help="append the results to a JSON Lines history")
+    parser.add_argument('--budget', type=float, metavar='MS',
+                        help="fail if importing todo takes longer")
+    options = parser.parse_args()
+
+    home = tempfile.mkdtemp()
+    try:
+        os.mkdir(os.path.join(home, '.todo'))
+        environment = dict(os.environ, HOME=home)
+        sys.path.insert(0, ROOT)
+        import todo
+        todo.DB_LOCATION = os.path.join(home, '.todo', todo.DB_NAME)
+        with todo.TodoStore() as store:
+            store.add_many(todo.Reminder('item {}'.format(x),
+                                         ('work', 'home')[x % 2])
+                           for x in range(options.reminders))
+
+        total, slowest = import_times(environment)
+        results = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'import_ms': round(total / 1000.0, 2),
+            'slowest_imports': slowest,
+            'python_startup': time_command(['-c', 'pass'], environment,
+                                           options.repeat),
+            'commands': dict((name, time_command(arguments, environment,
+                                                 options.repeat))
+                             for name, arguments in sorted(COMMANDS.items())),
+        }
+    finally:
+        shutil.rmtree(home)
+
+    print(json.dumps(results, indent=2, sort_keys=True))
+    if options.record:
+        with open(options.record, 'a') as history:
+            history.write(json.dumps(results, sort_keys=True) + '\n')
+    if options.budget is not None and results['import_ms'] > options.budget:
+        sys.exit("Importing todo took {}ms, over the budget of {}ms".format(
+            results['import_ms'], options.budget))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,4 @@
+# -*- coding: utf-8 -*-
 import tempfile
 import os
 import shutil
@@ -5,6 +6,12 @@ import shelve
 import todo
 import pytest
 import datetime
+import io
+import pickle
+import socket
+import threading
+import subprocess
+import sys
 
 from contextlib import closing
 from collections import namedtuple
@@ -213,3 +220,1236 @@ class TestTodo():
                                              'insensitive'))
         args = Namespace('test', None, False)
         assert todo.search(args) == TestTodo.sample
+
+
+@pytest.fixture
+def store(tmpdir, monkeypatch):
+    """Points todo at an empty database in a temporary directory"""
+    path = str(tmpdir.join('todo.shelve'))
+    monkeypatch.setattr(todo, 'DB_LOCATION', path)
+    return path
+
+
+class TestIndexes():
+    def test_lookup_by_serial(self, store):
+        reminders = [todo.Reminder('indexed {}'.format(x), 'work')
+                     for x in range(3)]
+        for reminder in reminders:
+            todo.add_reminder(reminder)
+
+        assert todo.search_field(reminders[1].serial, 'serial') == \
+            [reminders[1]]
+        assert todo.verify_indexes() == []
+
+    def test_remove_keeps_others(self, store):
+        reminders = [todo.Reminder('shifted {}'.format(x), 'work')
+                     for x in range(3)]
+        for reminder in reminders:
+            todo.add_reminder(reminder)
+
+        todo.delete_reminder(reminders[0])
+        assert todo.search_field(reminders[2].serial,
+                                 'serial')[0].content == 'shifted 2'
+        with pytest.raises(todo.ReminderDoesNotExistException):
+            todo.search_field(reminders[0].serial, 'serial')
+        assert todo.verify_indexes() == []
+
+    @pytest.mark.parametrize('writes', range(1, 16))
+    def test_renumber_interrupted(self, store, writes):
+        class Interrupted(Exception):
+            pass
+
+        class FailingRecords():
+            """Fails the given write to the records, as a crash would"""
+            def __init__(self, records):
+                self.records, self.writes = records, 0
+
+            def _write(self):
+                self.writes += 1
+                if self.writes == writes:
+                    raise Interrupted()
+
+            def __setitem__(self, key, value):
+                self._write()
+                self.records[key] = value
+
+            def __delitem__(self, key):
+                self._write()
+                del self.records[key]
+
+            def __getattr__(self, name):
+                return getattr(self.records, name)
+
+            def __getitem__(self, key):
+                return self.records[key]
+
+        reminders = [todo.Reminder('r{}'.format(x), 'work') for x in range(6)]
+        for reminder in reminders:
+            todo.add_reminder(reminder)
+        todo.delete_reminder(reminders[0])
+        todo.delete_reminder(reminders[2])
+
+        with todo.TodoStore(store) as session:
+            backend = session.backend
+            backend._records = FailingRecords(backend._records)
+            try:
+                session.renumber()
+            except Interrupted:
+                pass
+
+        with todo.TodoStore(store) as session:
+            found = [(x.serial, x.content) for x in session.iterate()]
+            assert found in ([(2, 'r1'), (4, 'r3'), (5, 'r4'), (6, 'r5')],
+                             [(1, 'r1'), (2, 'r3'), (3, 'r4'), (4, 'r5')])
+            assert session.verify_indexes() == []
+            assert todo.RENUMBER_KEY not in session.backend._db
+
+    def test_rebuild_indexes(self, store):
+        for x in range(3):
+            todo.add_reminder(todo.Reminder('rebuilt {}'.format(x), 'work'))
+
+        with closing(shelve.open(store)) as db:
+            del db[todo.CATEGORIES_KEY]
+
+        assert todo.verify_indexes() == ["Category list is not indexed"]
+        assert todo.rebuild_indexes() == 3
+        assert todo.verify_indexes() == []
+        assert len(todo.search_field('work', 'category')) == 3
+
+    def test_upgrade_legacy_database(self, store, monkeypatch):
+        sample = [todo.Reminder('legacy 1', 'activities', serial=1),
+                  todo.Reminder('legacy 2', 'activities', serial=2),
+                  todo.Reminder('legacy 3', 'chores', serial=3)]
+
+        # Reminders were pickled with their __dict__ before __slots__
+        class Reminder():
+            pass
+        Reminder.__module__, Reminder.__qualname__ = 'todo', 'Reminder'
+        pickled = []
+        for reminder in sample:
+            old = Reminder()
+            old.__dict__.update(reminder._asdict())
+            pickled.append(old)
+
+        with monkeypatch.context() as patch:
+            patch.setattr(todo, 'Reminder', Reminder)
+            with closing(shelve.open(store)) as db:
+                db.clear()
+                db['serial'] = 3
+                db['activities'] = pickled[:2]
+                db['chores'] = pickled[2:]
+
+        assert [x._asdict() for x in todo._iter_reminders()] == \
+            [x._asdict() for x in sample]
+        assert todo.search_field(sample[1].serial, 'serial') == [sample[1]]
+        assert todo.verify_indexes() == []
+        with closing(shelve.open(store)) as db:
+            assert 'activities' not in db
+            assert db[todo.LAYOUT_KEY] == todo.LAYOUT_VERSION
+
+    def test_duplicate_detected_by_index(self, store):
+        todo.add_reminder(todo.Reminder('dup', 'work',
+                                        datetime.date(2013, 3, 8)))
+        with pytest.raises(todo.ReminderExistsException):
+            todo.add_reminder(todo.Reminder('dup', 'work',
+                                            datetime.date(2013, 3, 8)))
+        todo.add_reminder(todo.Reminder('dup', 'work',
+                                        datetime.date(2013, 3, 9)))
+        todo.add_reminder(todo.Reminder('dup', 'home'))
+        assert todo.verify_indexes() == []
+
+    def test_duplicate_wildcard_due_date(self, store):
+        todo.add_reminder(todo.Reminder('undated', 'work'))
+        assert todo.reminder_exists(
+            todo.Reminder('undated', 'work', datetime.date(2013, 3, 8)))
+        assert todo.reminder_exists(todo.Reminder('undated', 'work'))
+        assert not todo.reminder_exists(todo.Reminder('undated', 'home'))
+
+    def test_removed_reminder_leaves_dedup_index(self, store):
+        reminder = todo.Reminder('temporary', 'work')
+        todo.add_reminder(reminder)
+        todo.delete_reminder(reminder)
+        assert not todo.reminder_exists(reminder)
+        assert todo.verify_indexes() == []
+
+    def test_templates_take_no_serial(self, store):
+        first = todo.Reminder('first')
+        todo.add_reminder(first)
+        assert not todo.reminder_exists(todo.Reminder('template'))
+        second = todo.Reminder('second')
+        todo.add_reminder(second)
+        assert (first.serial, second.serial) == (1, 2)
+
+    def test_encode_decode(self):
+        reminders = [todo.Reminder('Füße', 'ünïcode',
+                                   datetime.date(2013, 3, 8),
+                                   datetime.date(2013, 1, 1), serial=2 ** 40),
+                     todo.Reminder(None, serial=1),
+                     todo.Reminder('', 'x', serial=3)]
+        for reminder in reminders:
+            data = reminder.encode()
+            assert len(data) < len(pickle.dumps(reminder, 2))
+            assert todo.Reminder.decode(data)._asdict() == reminder._asdict()
+
+        with pytest.raises(todo.InvalidRecordException):
+            todo.Reminder.decode(b'\0R\x63' + data[3:])
+
+    def test_non_ascii_stored(self, backend_store):
+        # Native strings, as the command line gives them on either version
+        reminder = todo.Reminder('Füße wärmen', 'ünïcode')
+        todo.add_reminder(reminder)
+        stored = todo.search_field(reminder.serial, 'serial')[0]
+        assert (stored.content, stored.category) == \
+            ('Füße wärmen', 'ünïcode')
+        assert todo.search_in_content('wärm') == [reminder]
+        assert todo.Reminder.decode(stored.encode())._asdict() == \
+            stored._asdict()
+
+    def test_pickle_roundtrip(self):
+        reminder = todo.Reminder('pickled', serial=5)
+        assert pickle.loads(pickle.dumps(reminder))._asdict() == \
+            reminder._asdict()
+
+
+class TestTodoStore():
+    def test_single_handle(self, store, monkeypatch):
+        opened = []
+        real_open = shelve.open
+        monkeypatch.setattr(shelve, 'open',
+                            lambda *args: opened.append(args) or
+                            real_open(*args))
+
+        with todo.TodoStore(store) as session:
+            monkeypatch.setattr(todo, '_session', session)
+            reminder = todo.Reminder('session', 'work')
+            todo.add_reminder(reminder)
+            assert session.get(reminder.serial) == reminder
+            assert todo.search_in_content('sess') == [reminder]
+            assert list(session) == [reminder]
+
+        assert len(opened) == 1
+
+    def test_serials_reserved_in_blocks(self, store, monkeypatch):
+        with todo.TodoStore(store) as session:
+            reserved = []
+            real_reserve = session.backend.reserve_serials
+            monkeypatch.setattr(session.backend, 'reserve_serials',
+                                lambda count: reserved.append(count) or
+                                real_reserve(count))
+            for x in range(todo.SERIAL_BLOCK + 1):
+                session.add(todo.Reminder('blocked {}'.format(x)))
+            # Blocks double in size from a single serial
+            assert reserved == [1, 2, 4, 8, 16, 32, todo.SERIAL_BLOCK]
+
+        # The unused end of the last block is given back on close
+        with todo.TodoStore(store) as session:
+            assert session.next_serial() == todo.SERIAL_BLOCK + 2
+
+    def test_single_add_writes_serial_once(self, store, monkeypatch):
+        written = []
+        real_reset = todo.ShelveBackend.reset_serial
+        monkeypatch.setattr(todo.ShelveBackend, 'reset_serial',
+                            lambda backend, serial: written.append(serial) or
+                            real_reset(backend, serial))
+        with todo.TodoStore(store) as session:
+            session.add(todo.Reminder('just one'))
+        assert written == [1]
+
+    def test_remove_missing(self, store):
+        with todo.TodoStore(store) as session:
+            with pytest.raises(todo.ReminderDoesNotExistException):
+                session.remove(todo.Reminder('never added'))
+
+
+@pytest.fixture(params=['todo.shelve', 'todo.sqlite', 'todo.journal'])
+def backend_store(request, tmpdir, monkeypatch):
+    """Points todo at an empty database for each of the backends"""
+    path = str(tmpdir.join(request.param))
+    monkeypatch.setattr(todo, 'DB_LOCATION', path)
+    return path
+
+
+class TestBackends():
+    def add_sample(self):
+        sample = [todo.Reminder('Walk the dog', 'chores',
+                                datetime.date(2013, 3, 8)),
+                  todo.Reminder('walk to work', 'work',
+                                datetime.date(2013, 3, 10)),
+                  todo.Reminder('Feed the cat', 'chores')]
+        for reminder in sample:
+            todo.add_reminder(reminder)
+        return sample
+
+    def test_backend_chosen_by_location(self, tmpdir):
+        shelve_path = str(tmpdir.join('todo.shelve'))
+        sqlite_path = str(tmpdir.join('todo'))
+        assert todo._split_location(shelve_path) == ('shelve', shelve_path)
+        assert todo._split_location(sqlite_path + '.db')[0] == 'sqlite'
+        assert todo._split_location('sqlite://' + sqlite_path) == \
+            ('sqlite', sqlite_path)
+        assert todo._split_location(sqlite_path + '.journal')[0] == 'journal'
+
+    def test_legacy_db_shelve(self, tmpdir):
+        try:
+            import dbm.dumb as dumb
+        except ImportError:
+            import dumbdbm as dumb
+        path = str(tmpdir.join('old.db'))
+        with closing(shelve.Shelf(dumb.open(path, 'c'))) as db:
+            db['chores'] = [todo.Reminder('Walk the dog', 'chores', serial=1)]
+            db['serial'] = 1
+        assert not os.path.exists(path)
+
+        assert todo._split_location(path) == ('shelve', path)
+        assert todo._database_exists(path)
+        with todo.TodoStore(path) as store:
+            assert [x.content for x in store.iterate()] == ['Walk the dog']
+        assert not os.path.exists(path)
+
+    def test_upgraded_under_exclusive_lock(self, tmpdir, monkeypatch):
+        path = str(tmpdir.join('old.shelve'))
+        with closing(shelve.open(path)) as db:
+            db['chores'] = [todo.Reminder('Walk the dog', 'chores', serial=1)]
+            db['serial'] = 1
+
+        upgrades = []
+        real_upgrade = todo.ShelveBackend.upgrade
+        monkeypatch.setattr(todo.ShelveBackend, 'upgrade',
+                            lambda backend: upgrades.append(
+                                store._lock.exclusive) or
+                            real_upgrade(backend))
+        with todo.TodoStore(path) as store:
+            with store.transaction():
+                generation = store._lock.generation
+                assert [x.content for x in store.iterate()] == \
+                    ['Walk the dog']
+                assert store._lock.generation == generation + 1
+        assert upgrades == [True]
+
+        with todo.TodoStore(path) as store:
+            assert len(list(store.iterate())) == 1
+        assert upgrades == [True]
+
+    def test_search_field(self, backend_store):
+        sample = self.add_sample()
+        assert todo.search_field(sample[1].serial, 'serial') == [sample[1]]
+        assert todo.search_field('chores', 'category') == \
+            [sample[0], sample[2]]
+        assert todo.search_field('Feed the cat', 'content') == [sample[2]]
+        with pytest.raises(todo.ReminderDoesNotExistException):
+            todo.search_field('nothing', 'category')
+
+    def test_search_in_content(self, backend_store):
+        sample = self.add_sample()
+        assert todo.search_in_content('walk') == [sample[1]]
+        matches = todo.search_in_content('WALK', True)
+        assert sorted(x.serial for x in matches) == \
+            [x.serial for x in sample[:2]]
+
+    def test_search_in_content_by_due_date(self, backend_store):
+        sample = self.add_sample()
+        march_9 = datetime.date(2013, 3, 9)
+        assert todo.search_in_content(
+            'walk', True, todo._due_range(march_9, before=True)) == \
+            [sample[0]]
+        assert todo.search_in_content(
+            'walk', True, todo._due_range(march_9, after=True)) == \
+            [sample[1]]
+        assert todo.search_in_content(
+            'walk', True, todo._due_range(march_9)) == []
+
+    def test_duplicates(self, backend_store):
+        sample = self.add_sample()
+        assert todo.reminder_exists(todo.Reminder('Feed the cat', 'chores',
+                                                  datetime.date(2013, 1, 1)))
+        assert not todo.reminder_exists(todo.Reminder(
+            'Walk the dog', 'chores', datetime.date(2013, 1, 1)))
+        todo.delete_reminder(sample[2])
+        assert not todo.reminder_exists(sample[2])
+
+    def test_convert(self, backend_store, tmpdir):
+        sample = self.add_sample()
+        destination = str(tmpdir.join('converted.sqlite'))
+        if backend_store.endswith('.sqlite'):
+            destination = str(tmpdir.join('converted.shelve'))
+
+        assert todo.convert_database(backend_store, destination) == 3
+        with todo.TodoStore(destination) as store:
+            assert sorted(x.serial for x in store) == \
+                [x.serial for x in sample]
+            assert store.next_serial() == sample[-1].serial + 1
+
+        with pytest.raises(todo.DatabaseNotEmptyException):
+            todo.convert_database(backend_store, destination)
+
+    def test_content_index_matches_scan(self, backend_store):
+        contents = ['Walk the dog', 'walking', 'DOGGED pursuit',
+                    'Straße', 'STRASSE', 'ΣΊΣΥΦΟΣ', 'σίσυφος',
+                    'ab', 'x' * 5]
+        reminders = [todo.Reminder(content, 'misc') for content in contents]
+        for reminder in reminders:
+            todo.add_reminder(reminder)
+        todo.delete_reminder(reminders[1])
+        remaining = [x for x in reminders if x is not reminders[1]]
+
+        for query in ('walk', 'Walk', 'dog', 'DOG', 'og', 'ß', 'asse',
+                      'ΣΥΦ', 'υφος', 'xxxx', 'b', 'nothing'):
+            for insensitive in (False, True):
+                expected = [x.serial for x in remaining
+                            if todo._content_matches(x, query, insensitive)]
+                found = todo.search_in_content(query, insensitive)
+                assert sorted(x.serial for x in found) == expected
+
+        assert todo.verify_indexes() == []
+        assert todo.rebuild_indexes() == len(remaining)
+        assert todo.verify_indexes() == []
+
+    def test_search_due_without_content(self, backend_store):
+        sample = self.add_sample()
+        march_9 = datetime.date(2013, 3, 9)
+        assert todo.search_due(todo._due_range(march_9, before=True)) == \
+            [sample[0]]
+        assert todo.search_due(todo._due_range(march_9, True, True)) == \
+            sample[:2]
+        assert todo.search_due((None, datetime.date.today())) == sample[:2]
+
+    def test_search_created(self, backend_store):
+        today = datetime.date.today()
+        ages = [30, 10, 0]
+        sample = [todo.Reminder('aged {}'.format(age), 'misc',
+                                date=today - datetime.timedelta(days=age))
+                  for age in ages]
+        for reminder in sample:
+            todo.add_reminder(reminder)
+
+        older = todo._parse_age('2 weeks')
+        assert todo.search_created((None, older)) == [sample[0]]
+        assert todo.search_created((older, None)) == sample[1:]
+        assert todo.verify_indexes() == []
+
+    def test_parse_age(self):
+        today = datetime.date.today()
+        assert todo._parse_age('1 week') == today - datetime.timedelta(7)
+        assert todo._parse_age('today') == today
+        assert todo._parse_age('3/8/2013') == datetime.date(2013, 3, 8)
+
+    @pytest.mark.parametrize('format', ['jsonl', 'csv'])
+    def test_export_import(self, backend_store, tmpdir, monkeypatch, format):
+        sample = self.add_sample()
+        stream = io.StringIO()
+        assert todo.export_reminders(stream, format) == 3
+
+        destination = str(tmpdir.join('imported.sqlite'))
+        monkeypatch.setattr(todo, 'DB_LOCATION', destination)
+        todo.add_reminder(todo.Reminder('Feed the cat', 'chores'))
+        stream.seek(0)
+        assert todo.import_reminders(stream, format, batch_size=2) == (2, 1)
+
+        imported = sorted(todo._iter_reminders(), key=lambda x: x.serial)
+        assert [x.content for x in imported] == \
+            ['Feed the cat', 'Walk the dog', 'walk to work']
+        assert [x.serial for x in imported] == [1, 2, 3]
+        assert imported[1].date_due == sample[0].date_due
+        assert todo.Reminder.next_serial() == 4
+
+    def test_import_keep_serials(self, backend_store):
+        lines = ['{"serial": 40, "content": "kept", "category": "misc"}',
+                 '{"serial": 7, "content": "also kept", "date_due": ""}']
+        assert todo.import_reminders(io.StringIO('\n'.join(lines)),
+                                     keep_serials=True) == (2, 0)
+        assert todo.search_field(40, 'serial')[0].content == 'kept'
+        assert todo.search_field(7, 'serial')[0].category == 'general'
+        assert todo.Reminder.next_serial() == 41
+
+    def test_renumber(self, backend_store):
+        sample = self.add_sample()
+        sample.append(todo.Reminder('Water the plants', 'chores'))
+        todo.add_reminder(sample[-1])
+        todo.delete_reminder(sample[0])
+        todo.delete_reminder(sample[2])
+
+        assert todo.renumber_reminders() == [(2, 1), (4, 2)]
+        assert sorted((reminder.serial, reminder.content) for reminder in
+                      todo.search_in_content('w', True)) == [
+            (1, 'walk to work'), (2, 'Water the plants')]
+        assert todo.search_field(2, 'serial')[0].content == 'Water the plants'
+        assert todo.search_due((datetime.date(2013, 3, 9), None))[0] \
+            .serial == 1
+        assert todo.verify_indexes() == []
+        assert todo.renumber_reminders() == []
+
+        reminder = todo.Reminder('Feed the cat', 'chores')
+        todo.add_reminder(reminder)
+        assert reminder.serial == 3
+
+    def test_update(self, backend_store):
+        sample = self.add_sample()
+        updated = todo.update_reminder(1, category='dogs',
+                                       content='Walk the puppy')
+        assert (updated.serial, updated.category, updated.content,
+                updated.date_due) == (1, 'dogs', 'Walk the puppy',
+                                      datetime.date(2013, 3, 8))
+        assert todo.search_field(1, 'serial')[0].content == 'Walk the puppy'
+        assert [x.serial for x in todo.search_field('dogs', 'category')] == [1]
+        assert [x.serial for x in todo.search_field('chores', 'category')] \
+            == [3]
+        assert todo.search_in_content('dog') == []
+        assert [x.serial for x in todo.search_in_content('pupp')] == [1]
+        assert todo.reminder_exists(todo.Reminder('Walk the puppy', 'dogs'))
+        assert not todo.reminder_exists(sample[0])
+
+        todo.update_reminder(2, date_due=None)
+        todo.update_reminder(3, date_due=datetime.date(2013, 3, 1))
+        assert [x.serial for x in todo.search_due((None, None))] == [3, 1]
+        assert todo.verify_indexes() == []
+
+        with pytest.raises(todo.ReminderDoesNotExistException):
+            todo.update_reminder(9, content='missing')
+        with pytest.raises(TypeError):
+            todo.update_reminder(1, serial=5)
+
+    def test_update_keeps_stored_fields(self, backend_store):
+        undated = todo.Reminder('Undated', 'chores')
+        undated.date = None
+        todo.add_reminder(undated)
+        updated = todo.update_reminder(undated.serial, content='Still undated')
+        assert updated.date is None
+        assert todo.search_field(undated.serial, 'serial')[0].date is None
+        assert todo.verify_indexes() == []
+
+    def test_update_refuses_duplicates(self, backend_store):
+        sample = self.add_sample()
+        with pytest.raises(todo.ReminderExistsException):
+            todo.update_reminder(3, content='Walk the dog',
+                                 date_due=datetime.date(2013, 3, 8))
+        assert todo.search_field(3, 'serial')[0].content == 'Feed the cat'
+        # Changing only the due date does not clash with itself
+        todo.update_reminder(1, date_due=datetime.date(2013, 3, 9))
+        assert todo.search_field(1, 'serial')[0].content == sample[0].content
+        assert todo.verify_indexes() == []
+
+    def test_edit_fields(self, backend_store):
+        self.add_sample()
+        Namespace = namedtuple('Namespace', ('serial', 'category',
+                                             'date_due', 'no_due'))
+        todo.edit(Namespace(2, 'office', '3/12/2013', False))
+        reminder = todo.search_field(2, 'serial')[0]
+        assert (reminder.category, reminder.date_due) == \
+            ('office', datetime.date(2013, 3, 12))
+        todo.edit(Namespace(2, None, None, True))
+        assert todo.search_field(2, 'serial')[0].date_due is None
+        assert todo.verify_indexes() == []
+
+    def test_remove_matching(self, backend_store):
+        self.add_sample()
+        notes = [todo.Reminder('note {}'.format(x), 'notes',
+                               datetime.date(2013, 4, x % 28 + 1))
+                 for x in range(100)]
+        with todo.TodoStore() as store:
+            store.add_many(notes)
+
+        removed = todo.remove_reminders(todo.Query(
+            'notes', due=(None, datetime.date(2013, 4, 10))))
+        assert sorted(x.serial for x in removed) == [
+            x.serial for x in notes if x.date_due.day <= 10]
+        assert todo.search_in_content('note 36') == []
+        assert todo.verify_indexes() == []
+
+        removed = todo.remove_reminders(todo.Query(serials=(1, 20)))
+        assert [x.serial for x in removed] == [
+            serial for serial in range(1, 21)
+            if serial <= 3 or notes[serial - 4].date_due.day > 10]
+        assert todo.remove_reminders(todo.Query('chores')) == []
+        with pytest.raises(todo.ReminderDoesNotExistException):
+            todo.search_field('chores', 'category')
+
+        todo.remove_reminders(todo.Query('notes'))
+        with pytest.raises(todo.ReminderDoesNotExistException):
+            todo.search_field('notes', 'category')
+        assert todo.verify_indexes() == []
+
+    def test_remove_command(self, backend_store, capsys, monkeypatch):
+        self.add_sample()
+        Namespace = namedtuple('Namespace', ('serial', 'category',
+                                             'due_before', 'serials',
+                                             'confirm'))
+        monkeypatch.setattr(todo, '_confirm', lambda: False)
+        todo.remove(Namespace(None, 'chores', None, None, None))
+        assert capsys.readouterr()[0] == \
+            "Remove 2 reminders?\n\tchores: 2\n"
+        assert len(todo.search_field('chores', 'category')) == 2
+
+        # Strictly before, keeping the reminder due on 3/10
+        todo.remove(Namespace(None, None, '3/10/2013', None, True))
+        assert capsys.readouterr()[0] == "Removed 1 reminders\n"
+        assert [x.serial for x in todo.search_due((None, None))] == [2]
+
+    def test_remove_command_removes_listed(self, backend_store, capsys,
+                                           monkeypatch):
+        self.add_sample()
+        Namespace = namedtuple('Namespace', ('serial', 'category',
+                                             'due_before', 'serials',
+                                             'confirm'))
+        late = todo.Reminder('Take out the bins', 'chores')
+        with todo.TodoStore() as session:
+            monkeypatch.setattr(todo, '_session', session)
+            # Added while the user is asked, so not among those listed
+            monkeypatch.setattr(todo, '_confirm',
+                                lambda: todo.add_reminder(late) or True)
+            todo.remove(Namespace(None, 'chores', None, None, None))
+        assert capsys.readouterr()[0] == \
+            "Remove 2 reminders?\n\tchores: 2\nRemoved 2 reminders\n"
+        assert todo.search_field('chores', 'category') == [late]
+
+    def test_list_orders(self, backend_store):
+        sample = self.add_sample()
+        sample.append(todo.Reminder('Water the plants', 'chores',
+                                    datetime.date(2013, 3, 1)))
+        todo.add_reminder(sample[-1])
+
+        def serials(*args):
+            return [reminder.serial
+                    for reminder in todo.list_reminders(*args)]
+
+        assert serials() == [1, 3, 4, 2]
+        assert serials(None, 'serial') == [1, 2, 3, 4]
+        assert serials(None, 'due') == [4, 1, 2, 3]
+        assert serials('chores', 'due') == [4, 1, 3]
+        # Listing resumes after the cursor in each order
+        assert serials(None, None, 3) == [4, 2]
+        assert serials(None, 'serial', 2) == [3, 4]
+        assert serials(None, 'due', 1) == [2, 3]
+        assert serials(None, 'due', 3) == []
+
+    def test_list_pages(self, backend_store, capsys):
+        self.add_sample()
+        page = todo._paginate(todo.list_reminders(None, 'serial'), 2)
+        assert [reminder.serial for reminder in page] == [1, 2]
+        assert '--cursor 2' in capsys.readouterr()[1]
+
+        page = todo._paginate(todo.list_reminders(None, 'serial', 2), 2)
+        assert [reminder.serial for reminder in page] == [3]
+        assert capsys.readouterr()[1] == ''
+
+    def test_query(self, backend_store):
+        sample = self.add_sample()
+        sample.append(todo.Reminder('Walk the neighbour\'s dog', 'chores',
+                                    datetime.date(2013, 3, 20),
+                                    datetime.date(2013, 1, 1)))
+        todo.add_reminder(sample[-1])
+
+        def serials(**criteria):
+            return sorted(reminder.serial for reminder in
+                          todo.search_query(todo.Query(**criteria)))
+
+        assert serials(category='chores', content='walk',
+                       case_insensitive=True) == [1, 4]
+        assert serials(category='chores',
+                       due=(datetime.date(2013, 3, 9), None)) == [4]
+        assert serials(content='dog', serials=(2, None)) == [4]
+        assert serials(serials=(2, 3)) == [2, 3]
+        assert serials(serials=(3, 3), category='work') == []
+        assert serials(created=(None, datetime.date(2013, 1, 1))) == [4]
+        assert serials(category='chores', due=(None, None)) == [1, 4]
+
+    def test_query_plan(self):
+        march = (datetime.date(2013, 3, 1), datetime.date(2013, 3, 31))
+        assert todo.Query('work', 'milk', serials=(1, 9)).plan() == 'serial'
+        assert todo.Query('work', 'milk', due=march).plan() == 'content'
+        assert todo.Query('work', 'mi', due=march).plan() == 'due'
+        assert todo.Query('work', due=(march[0], None)).plan() == \
+            'category'
+        assert todo.Query(created=(march[0], None)).plan() == 'created'
+        assert todo.Query(content='mi').plan() == 'scan'
+        assert todo.Query().is_empty()
+        assert not todo.Query(serials=(None, 9)).is_empty()
+
+    def test_due_option(self):
+        march_1, march_15 = (datetime.date(2013, 3, 1),
+                             datetime.date(2013, 3, 15))
+        assert todo._parse_due('3/1/2013..3/15/2013') == (march_1, march_15)
+        assert todo._parse_due('3.1.2013..') == (march_1, None)
+        assert todo._parse_due('..3/15/2013') == (None, march_15)
+        assert todo._parse_due('3/1/2013', before=True) == (None, march_1)
+        assert todo.Query(due=(march_1, march_15)).plan() == 'due'
+
+    def test_describe_plan(self):
+        query = todo.Query('work', 'milk')
+        assert todo._describe_plan(query, todo.ShelveBackend) == \
+            "Finding reminders by the trigrams of their content, " \
+            "filtered by category"
+        for backend in (todo.JournalBackend, todo.SnapshotBackend):
+            assert "every reminder" in todo._describe_plan(query, backend)
+
+    def test_describe_plan_columns(self, store, capsys, monkeypatch):
+        today = datetime.date.today()
+        combined = todo.Query('work', due=(today, None))
+        assert combined.use_columns() == 'cached'
+        assert todo._describe_plan(combined) == \
+            "Finding reminders by category, filtered by due"
+        assert todo._describe_plan(combined, cached=True) == \
+            "Finding reminders from the columns cache, filtered by " \
+            "category, due"
+        unnarrowed = todo.Query(due=(None, None))
+        assert unnarrowed.use_columns() == 'build'
+        assert "columns cache" in todo._describe_plan(unnarrowed)
+        assert todo.Query('work', 'milk').use_columns() is None
+
+        with todo.TodoStore() as session:
+            session.add(todo.Reminder('milk', 'work', today))
+        with todo.TodoStore() as session:
+            session.columns()
+        with todo.TodoStore() as session:
+            monkeypatch.setattr(todo, '_session', session)
+            todo.search(todo._Arguments(
+                category='work', content=None, date_due='today',
+                overdue=False, before=False, after=True, older=None,
+                newer=None, insensitive=False, explain=True))
+        assert "from the columns cache" in capsys.readouterr()[1]
+
+
+@pytest.fixture(params=['numpy', 'array'])
+def columns_with(request, monkeypatch):
+    """Runs a test with NumPy, if it is installed, and without it"""
+    if request.param == 'numpy':
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(todo, '_numpy', lambda: None)
+    return request.param
+
+
+class TestColumns():
+    def reminders(self):
+        today = datetime.date.today()
+        return [todo.Reminder('a', 'work', today, today, serial=1),
+                todo.Reminder('b', 'home', today - datetime.timedelta(1),
+                              datetime.date(2013, 1, 1), serial=2),
+                todo.Reminder('c', 'work', None, datetime.date(2013, 2, 1),
+                              serial=5),
+                todo.Reminder('d', 'home', datetime.date(2013, 3, 9),
+                              today, serial=7)]
+
+    def test_select_matches_query(self, columns_with, tmpdir):
+        reminders = self.reminders()
+        columns = todo.Columns.build(reminders, generation=3)
+        path = str(tmpdir.join('todo.columns'))
+        columns.save(path)
+        loaded = todo.Columns.load(path)
+        assert loaded.generation == 3
+        assert loaded.categories == ['work', 'home']
+
+        today = datetime.date.today()
+        queries = [todo.Query('work'), todo.Query(due=(None, None)),
+                   todo.Query('home', due=(None, today)),
+                   todo.Query(created=(datetime.date(2013, 1, 15), None)),
+                   todo.Query(serials=(2, 6), created=(None, today)),
+                   todo.Query('garden')]
+        for query in queries:
+            expected = [x.serial for x in reminders if query.matches(x)]
+            assert columns.select(query) == expected
+            assert loaded.select(query) == expected
+
+    def test_stats(self, columns_with):
+        counts = todo.Columns.build(self.reminders()).stats()
+        assert counts['total'] == 4
+        assert (counts['overdue'], counts['due_today'],
+                counts['undated']) == (2, 1, 1)
+        assert counts['categories'] == {'work': (2, 0), 'home': (2, 2)}
+        assert counts['due_by_month']['2013-03'] == 1
+        assert sum(counts['due_by_month'].values()) == 3
+
+    def test_cached_until_written(self, backend_store, columns_with):
+        todo.add_reminder(todo.Reminder('milk', 'shopping'))
+        with todo.TodoStore() as store:
+            assert store.columns(build=False) is None
+            assert len(store.columns()) == 1
+        with todo.TodoStore() as store:
+            assert len(store.columns(build=False)) == 1
+            assert [x.content for x in store.query(todo.Query(
+                'shopping', created=(None, None)))] == ['milk']
+
+        todo.add_reminder(todo.Reminder('bread', 'shopping'))
+        with todo.TodoStore() as store:
+            assert store.columns(build=False) is None
+            assert todo.reminder_stats()['total'] == 2
+
+    def test_built_by_unnarrowed_search(self, backend_store, columns_with):
+        todo.add_reminder(todo.Reminder('milk', 'shopping'))
+        with todo.TodoStore() as store:
+            assert [x.content for x in store.query(todo.Query(
+                'shopping', created=(datetime.date(2013, 1, 1), None)))] \
+                == ['milk']
+            assert store.columns(build=False) is None
+            assert [x.content for x in store.query(todo.Query(
+                due=(None, None)))] == []
+            assert len(store.columns(build=False)) == 1
+
+
+@pytest.mark.skipif(not hasattr(memoryview, 'cast'),
+                    reason="needs memoryview.cast")
+class TestSnapshot():
+    def test_reads_match_backend(self, backend_store):
+        TestBackends().add_sample()
+        todo.add_reminder(todo.Reminder('Water the plants', 'garden',
+                                        datetime.date(2013, 3, 1)))
+        due = (datetime.date(2013, 3, 2), None)
+        created = (datetime.date.today(), None)
+        reads = [lambda store: store.categories(),
+                 lambda store: list(store.iterate()),
+                 lambda store: list(store.iterate('chores')),
+                 lambda store: list(store.iterate('missing')),
+                 lambda store: list(store.iterate_serials(1)),
+                 lambda store: [store.get(2), store.get(99)],
+                 lambda store: list(store.backend.find_due(due)),
+                 lambda store: list(store.backend.find_created(created)),
+                 lambda store: list(store.backend.find_content('alk', True)),
+                 lambda store: list(store.backend.find_content('walk'))]
+
+        def fields(value):
+            if isinstance(value, todo.Reminder):
+                return (value.serial, value.category, value.content,
+                        value.date, value.date_due)
+            elif isinstance(value, list):
+                return [fields(item) for item in value]
+            return value
+
+        with todo.TodoStore() as store:
+            expected = [fields(read(store)) for read in reads]
+        with todo.TodoStore(read_only=True) as store:
+            list(store.iterate())
+        with todo.TodoStore(read_only=True) as store:
+            assert isinstance(store.backend, todo.SnapshotBackend)
+            assert [fields(read(store)) for read in reads] == expected
+            assert store.backend.last_serial() == 4
+
+    def test_taken_again_after_write(self, backend_store):
+        todo.add_reminder(todo.Reminder('milk', 'shopping'))
+        with todo.TodoStore(read_only=True) as store:
+            assert [x.content for x in store.iterate()] == ['milk']
+        path = todo._split_location(backend_store)[1] + todo.SNAPSHOT_SUFFIX
+        assert os.path.exists(path)
+
+        todo.add_reminder(todo.Reminder('bread', 'shopping'))
+        with todo.TodoStore(read_only=True) as store:
+            assert [x.content for x in store.iterate()] == ['milk', 'bread']
+
+    def test_taken_by_writer(self, backend_store):
+        todo.add_reminder(todo.Reminder('milk', 'shopping'))
+        with todo.TodoStore(read_only=True) as store:
+            list(store.iterate())
+
+        todo.add_reminder(todo.Reminder('bread', 'shopping'))
+        with todo.TodoStore(read_only=True) as store:
+            assert isinstance(store.backend, todo.SnapshotBackend)
+            assert store.get(2).content == 'bread'
+
+    def test_stale_snapshot_taken_after_reads(self, backend_store):
+        todo.add_reminder(todo.Reminder('milk', 'shopping'))
+        path = todo._split_location(backend_store)[1] + todo.SNAPSHOT_SUFFIX
+        with todo.TodoStore(read_only=True) as store:
+            assert store.get(1).content == 'milk'
+            assert not os.path.exists(path)
+        # Once the command is done
+        assert os.path.exists(path)
+        size = os.path.getsize(path)
+
+        # Written as an older todo would, leaving the snapshot as it was
+        backend = todo.open_backend(backend_store)
+        backend.put(todo.Reminder('bread', 'shopping', serial=2))
+        backend.reset_serial(2)
+        backend.close()
+        with todo.TodoStore(read_only=True) as store:
+            # Answered by the database's backend, leaving the snapshot be
+            assert store.get(2).content == 'bread'
+            assert [x.content for x in store.iterate('shopping')] == \
+                ['milk', 'bread']
+            assert not isinstance(store.backend._backend,
+                                  todo.SnapshotBackend)
+            assert os.path.getsize(path) == size
+            # Reading everything takes it again
+            assert len(list(store.iterate())) == 2
+            assert isinstance(store.backend._backend, todo.SnapshotBackend)
+
+    def test_taken_again_after_lock_recreated(self, backend_store):
+        todo.add_reminder(todo.Reminder('milk', 'shopping'))
+        with todo.TodoStore(read_only=True) as store:
+            assert [x.content for x in store.iterate()] == ['milk']
+            with store.transaction():
+                generation = store._lock.generation
+
+        # A new lock file counts writes from 0 again, so only the database's
+        # files show that it changed
+        lock = todo._split_location(backend_store)[1] + todo.LOCK_SUFFIX
+        os.remove(lock)
+        todo.add_reminder(todo.Reminder('bread', 'shopping'))
+        with todo.TodoStore(read_only=True) as store:
+            with store.transaction():
+                assert store._lock.generation == generation
+            assert [x.content for x in store.iterate()] == ['milk', 'bread']
+            assert len(store.columns()) == 2
+
+    def test_ignores_invalid_file(self, tmpdir):
+        path = str(tmpdir.join('todo.snapshot'))
+        with open(path, 'wb') as stream:
+            stream.write(b'not a snapshot' * 8)
+        assert todo.SnapshotBackend.open(path, 0, (0, 0)) is None
+        assert todo.SnapshotBackend.open(path + '-missing', 0,
+                                            (0, 0)) is None
+
+
+class TestParallelSearch():
+    def test_split_query(self, store):
+        for number in range(10):
+            todo.add_reminder(todo.Reminder('note {}'.format(number)))
+        query = todo.Query(content='note', serials=(3, None))
+        parts = todo._split_query(query, store, 3)
+        assert [part.serials for part in parts] == [(3, 5), (6, 8), (9, 10)]
+        assert all(part.content == 'note' for part in parts)
+
+        # Queries narrowed by an index are left whole
+        due = todo.Query(content='no', due=(datetime.date.today(),) * 2)
+        assert todo._split_query(due, store, 3) == [due]
+        assert todo._split_query(query, store, 1) == [query]
+
+    def test_search_databases(self, tmpdir):
+        locations = [str(tmpdir.join('todo.shelve')),
+                     str(tmpdir.join('todo.journal'))]
+        for location in locations:
+            with todo.TodoStore(location) as store:
+                store.add_many([todo.Reminder('{} {}'.format(word, number),
+                                              'words')
+                                for number in range(20)
+                                for word in ('walk', 'feed')])
+
+        query = todo.Query(content='WALK', case_insensitive=True)
+        for jobs in (1, 3):
+            results = todo.search_databases(query, locations, jobs)
+            assert [location for location, found in results] == locations
+            for location, found in results:
+                assert [x.content for x in found] == [
+                    'walk {}'.format(number) for number in range(20)]
+
+
+class TestSortedIndex():
+    def test_matches_sorted_list(self, store, monkeypatch):
+        import random
+        monkeypatch.setattr(todo, 'INDEX_LEAF_SIZE', 4)
+        rng = random.Random(7)
+        expected = []
+
+        with closing(shelve.open(store)) as db:
+            index = todo._SortedIndex(db, 'test')
+            for serial in range(200):
+                entry = (rng.randint(0, 30), serial)
+                index.insert(entry)
+                expected.append(entry)
+                if rng.random() < 0.3:
+                    entry = expected.pop(rng.randrange(len(expected)))
+                    index.remove(entry)
+
+            expected.sort()
+            assert list(index.entries()) == expected
+            assert index.verify(expected) == []
+            for low, high in ((None, None), (5, 10), (None, 3), (28, None),
+                              (40, None), (10, 5)):
+                assert list(index.range(low, high)) == [
+                    serial for key, serial in expected
+                    if (low is None or key >= low) and
+                    (high is None or key <= high)]
+
+            index.rebuild(expected)
+            assert list(index.entries()) == expected
+
+
+class TestJournal():
+    def reminders(self, path):
+        with todo.TodoStore(path) as store:
+            return sorted(((reminder.serial, reminder.content)
+                           for reminder in store.iterate()))
+
+    def test_replay(self, tmpdir):
+        path = str(tmpdir.join('todo.journal'))
+        with todo.TodoStore(path) as store:
+            for x in range(5):
+                store.add(todo.Reminder('item {}'.format(x), 'work',
+                                        datetime.date(2013, 3, 8 + x)))
+            store.remove(store.get(2))
+
+        assert not os.path.exists(path)
+        assert self.reminders(path) == [(1, 'item 0'), (3, 'item 2'),
+                                        (4, 'item 3'), (5, 'item 4')]
+        with todo.TodoStore(path) as store:
+            assert [reminder.serial for reminder in store.search_due(
+                (datetime.date(2013, 3, 10), None))] == [3, 4, 5]
+            reminder = todo.Reminder('item 5', 'work')
+            store.add(reminder)
+            assert reminder.serial == 6
+
+    def test_truncated_tail(self, tmpdir):
+        path = str(tmpdir.join('todo.journal'))
+        with todo.TodoStore(path) as store:
+            store.add(todo.Reminder('kept', 'work'))
+            store.add(todo.Reminder('torn', 'work'))
+
+        # Cut the log off part way through the second reminder
+        with open(path + todo.JOURNAL_LOG_SUFFIX, 'rb+') as stream:
+            stream.truncate(stream.read().rfind(b'torn'))
+
+        assert [content for serial, content in
+                self.reminders(path)] == ['kept']
+        with todo.TodoStore(path) as store:
+            store.add(todo.Reminder('after', 'work'))
+        assert [content for serial, content in
+                self.reminders(path)] == ['kept', 'after']
+
+    def test_compact(self, tmpdir):
+        path = str(tmpdir.join('todo.journal'))
+        with todo.TodoStore(path) as store:
+            for x in range(20):
+                store.add(todo.Reminder('item {}'.format(x), 'work'))
+            for serial in range(1, 11):
+                store.remove(store.get(serial))
+            store.compact()
+
+        # Only the serials handed back on close follow the snapshot
+        assert os.path.getsize(path + todo.JOURNAL_LOG_SUFFIX) == \
+            todo.JOURNAL_ENTRY.size + todo.JOURNAL_SERIAL.size
+        assert todo._split_location(str(tmpdir.join('todo.journal'))) == \
+            ('journal', path)
+        assert [serial for serial, content in
+                self.reminders(path)] == list(range(11, 21))
+        with todo.TodoStore(path) as store:
+            reminder = todo.Reminder('new', 'work')
+            store.add(reminder)
+            assert reminder.serial > 20
+
+
+@pytest.mark.skipif(not hasattr(socket, 'AF_UNIX'),
+                    reason="needs Unix sockets")
+class TestServer():
+    @pytest.fixture
+    def server(self, store):
+        server = todo.TodoServer(store)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        yield server
+        server.shutdown()
+        thread.join()
+        server.server_close()
+
+    def test_remote_calls(self, server, store):
+        with todo._open_store(store) as remote:
+            assert isinstance(remote, todo.RemoteStore)
+            reminder = todo.Reminder('Walk the dog', 'chores',
+                                     datetime.date(2013, 3, 8))
+            remote.add(reminder)
+            assert reminder.serial == 1
+            with pytest.raises(todo.ReminderExistsException):
+                remote.add(todo.Reminder('Walk the dog', 'chores'))
+
+            found = remote.search_content('dog', due=(
+                datetime.date(2013, 3, 1), None))
+            assert [(item.serial, item.date_due) for item in found] == \
+                [(1, datetime.date(2013, 3, 8))]
+            assert list(remote.query(todo.Query(
+                'chores', due=(datetime.date(2013, 3, 8), None)))) == \
+                [reminder]
+            assert remote.add_many(
+                [todo.Reminder('item {}'.format(x)) for x in range(5)],
+                batch_size=2) == (5, 0)
+            assert remote.update(1, date_due=None).date_due is None
+            remote.remove(reminder)
+            assert remote.get(1) is None
+            assert [item.content for item in remote.remove_matching(
+                todo.Query(content='item 1'))] == ['item 1']
+
+        with todo._open_store(store) as other:
+            assert len(list(other.iterate())) == 4
+
+    def test_falls_back_to_direct_access(self, store):
+        # A socket left behind with nothing listening on it
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(todo._socket_path(store))
+        stale.close()
+
+        with todo._open_store(store) as direct:
+            assert isinstance(direct, todo.TodoStore)
+            direct.add(todo.Reminder('Feed the cat'))
+
+    def test_server_replaces_stale_socket(self, store):
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(todo._socket_path(store))
+        stale.close()
+
+        server = todo.TodoServer(store)
+        server.server_close()
+        assert not os.path.exists(todo._socket_path(store))
+
+
+WRITER = """
+import sys
+import todo
+
+path, worker, count = sys.argv[1], sys.argv[2], int(sys.argv[3])
+for x in range(count):
+    with todo.TodoStore(path) as store:
+        store.add(todo.Reminder('worker {} item {}'.format(worker, x)))
+"""
+
+
+@pytest.mark.skipif(todo.fcntl is None, reason="needs fcntl")
+class TestLocking():
+    def test_parallel_writers(self, backend_store):
+        workers, count = 6, 15
+        writers = [subprocess.Popen(
+            [sys.executable, '-c', WRITER, backend_store, str(worker),
+             str(count)], cwd=os.path.dirname(todo.__file__))
+            for worker in range(workers)]
+        assert [writer.wait() for writer in writers] == [0] * workers
+
+        with todo.TodoStore(backend_store) as store:
+            reminders = list(store.iterate())
+            assert sorted(reminder.content for reminder in reminders) == \
+                sorted('worker {} item {}'.format(worker, x)
+                       for worker in range(workers) for x in range(count))
+            assert len(set(reminder.serial for reminder in reminders)) == \
+                workers * count
+            assert store.verify_indexes() == []
+
+    def test_readers_share_writers_wait(self, tmpdir):
+        path = str(tmpdir.join('todo.lock'))
+        first, second = todo.DatabaseLock(path), todo.DatabaseLock(path, 0.05)
+        with first.hold():
+            with second.hold():
+                pass
+            with pytest.raises(todo.LockTimeoutException):
+                with second.hold(exclusive=True):
+                    pass
+        assert second.stats['acquired'] == 2
+        assert second.stats['waited'] == 1
+        assert second.stats['longest_wait'] >= 0.05
+
+    def test_sees_other_writers(self, backend_store):
+        with todo.TodoStore(backend_store) as first:
+            first.add(todo.Reminder('first'))
+            with todo.TodoStore(backend_store) as second:
+                second.add(todo.Reminder('second'))
+            assert [reminder.content for reminder in first.iterate()] == \
+                ['first', 'second']
+            first.add(todo.Reminder('third'))
+
+        with todo.TodoStore(backend_store) as store:
+            assert len(list(store.iterate())) == 3
+
+
+class TestCommandLine():
+    @pytest.mark.parametrize('argv', [
+        ['list'], ['list', '-n', '3'], ['list', '--category', 'work'],
+        ['--db', 'other.shelve', 'list', '-c', 'home'],
+        ['search', 'milk'], ['search', '-i', 'milk'],
+        ['-d', 'x.sqlite', 'search', 'Milk', '--ignore-case'],
+        ['--profile', 'list'], ['--db', 'x.sqlite', '--profile', 'list'],
+        ['list', '--sort', 'due', '-l', '20', '--cursor', '4'],
+        ['list', '-c', 'work', '--offset', '10', '-s', 'serial'],
+        ['search', 'milk', '-c', 'home', '--numbers', '3..']])
+    def test_fast_path_matches_argparse(self, argv):
+        fast = todo._parse_fast(argv)
+        assert fast is not None
+        assert vars(fast) == vars(todo._build_parser().parse_args(argv))
+
+    @pytest.mark.parametrize('argv', [
+        [], ['add', 'milk'], ['list', '-n', 'three'], ['list', '-n', '1',
+                                                       '-c', 'work'],
+        ['search'], ['search', 'milk', '--due', 'today'], ['list', '--num',
+                                                           '3'],
+        ['list', '--sort', 'category']])
+    def test_fast_path_leaves_the_rest_to_argparse(self, argv):
+        assert todo._parse_fast(argv) is None
+
+    @pytest.mark.parametrize('argv', [
+        ['list', '--limit', '-1'], ['list', '-l', '0'],
+        ['list', '--offset', '-1'], ['list', '--limit', 'ten']])
+    def test_bad_page_rejected(self, argv, capsys):
+        assert todo._parse_fast(argv) is None
+        with pytest.raises(SystemExit):
+            todo._build_parser().parse_args(argv)
+        assert 'invalid' in capsys.readouterr()[1]
+
+    def test_offset_zero_accepted(self):
+        argv = ['list', '--offset', '0', '--limit', '1']
+        assert vars(todo._parse_fast(argv)) == \
+            vars(todo._build_parser().parse_args(argv))
+
+    def test_lazy_imports(self):
+        modules = ('argparse', 'subprocess', 'tempfile', 'shelve', 'sqlite3',
+                   'socket', 'json', 'csv')
+        loaded = subprocess.check_output(
+            [sys.executable, '-c', 'import sys, todo; print(" ".join('
+             'm for m in {!r} if m in sys.modules))'.format(modules)],
+            cwd=os.path.dirname(todo.__file__))
+        assert loaded.split() == []
+
+
+class TestProfiler():
+    def test_nested_phases_are_exclusive(self, monkeypatch):
+        ticks = iter([0.0, 1.0, 3.0, 6.0])
+        monkeypatch.setattr(todo, '_clock', lambda: next(ticks))
+        profiler = todo.Profiler()
+        with profiler.phase('filter'):
+            with profiler.phase('read'):
+                pass
+        report = profiler.report()
+        assert report['phases']['filter'] == 4.0
+        assert report['phases']['read'] == 2.0
+        assert report['total'] == 6.0
+
+    def test_counts_storage(self, backend_store, monkeypatch):
+        with todo.TodoStore() as store:
+            store.add(todo.Reminder('milk', 'shopping'))
+            store.add(todo.Reminder('bread', 'shopping'))
+
+        profiler = todo.Profiler()
+        monkeypatch.setattr(todo, '_profiler', profiler)
+        with todo.TodoStore() as store:
+            assert len(store.search('shopping', 'category')) == 2
+            store.remove(todo.Reminder('milk', 'shopping'))
+
+        counters = profiler.report()['counters']
+        assert counters['opens'] == 1
+        assert counters['keys_read'] >= 2
+        assert counters['keys_written'] + counters['keys_deleted'] >= 1
+        assert profiler.phases['read'] > 0
+        assert profiler.phases['write'] > 0
+
+        with todo.TodoStore(read_only=True) as store:
+            list(store.iterate())
+        profiler = todo.Profiler()
+        monkeypatch.setattr(todo, '_profiler', profiler)
+        with todo.TodoStore(read_only=True) as store:
+            assert [reminder.content for reminder in store.iterate()] == [
+                'bread']
+            # Python 2 reads the database, having no snapshot
+            snapshot = hasattr(memoryview, 'cast')
+            if snapshot:
+                assert isinstance(store.backend._backend,
+                                  todo.SnapshotBackend)
+
+        counters = profiler.report()['counters']
+        assert counters['keys_read'] >= 1
+        if snapshot:
+            assert counters['bytes_read'] > 0
+
+    def test_profile_json(self, store, tmpdir):
+        with todo.TodoStore() as session:
+            session.add(todo.Reminder('milk', 'shopping'))
+
+        output = str(tmpdir.join('profile.jsonl'))
+        subprocess.check_call(
+            [sys.executable, todo.__file__, '--db', store, '--profile-json',
+             output, 'list'], stdout=subprocess.DEVNULL)
+        import json
+        with open(output) as stream:
+            report = json.loads(stream.read())
+        assert report['command'][-1] == 'list'
+        assert set(report['phases']) == set(todo.PROFILE_PHASES)
+        assert report['counters']['opens'] == 1
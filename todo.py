@@ -10,138 +10,3741 @@
     is capable of handling due dates, categories for your reminders, and more.
     Use `todo --help` for a complete list of options.
 
-    A note on compatibility between 2 and 3: databases created in Python 3 are
-    not backwards compatible as Python 3's pickle uses another protocol. Pick
-    a version and stick with it, or create a new database.
+    A note on compatibility between 2 and 3: reminders are stored in a format
+    readable by both, but shelve databases created in Python 3 also hold
+    pickled indexes, which Python 2 cannot read. Pick a version and stick with
+    it, or use an SQLite database.
 """
 
+# Modules that only some commands or backends need, such as the editor's
+# and each backend's, are imported where they are used to keep start-up fast
 import sys
-import shelve
 import datetime
-import argparse
-import subprocess
-import tempfile
 import os
+import io
+import struct
+import time
+import zlib
+import itertools
+import errno
 
-from itertools import chain
-from contextlib import closing
+from bisect import bisect_left, bisect_right, insort
+from contextlib import contextmanager
+
+try:
+    from dbm import whichdb
+except ImportError:
+    from whichdb import whichdb
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 HOME = os.path.join(os.getenv('HOME'), '.todo')
 DB_NAME = 'database.shelve'
 DB_LOCATION = os.path.join(HOME, DB_NAME)
 
+# Keys starting with a NUL byte hold reminders and indexes. Databases from
+# before, which stored categories under their own name, are upgraded on open.
+INTERNAL_PREFIX = '\0'
+LAYOUT_KEY = INTERNAL_PREFIX + 'layout'
+LAYOUT_VERSION = 6
+CATEGORIES_KEY = INTERNAL_PREFIX + 'categories'
+# Set while a shelve is being renumbered, see ShelveBackend.renumber
+RENUMBER_KEY = INTERNAL_PREFIX + 'renumber'
+MEMBER_CHUNK = 1024
+# Content searches look up at most this many of the query's trigrams
+MAX_QUERY_GRAMS = 16
+# Largest number of entries in one leaf of a shelve's sorted indexes
+INDEX_LEAF_SIZE = 512
+# Reminders imported per transaction
+IMPORT_BATCH_SIZE = 1000
+# Serials reserved at a time by a store
+SERIAL_BLOCK = 64
+# Orders `todo list --sort` accepts, besides grouping by category
+LIST_ORDERS = ('serial', 'due')
+# Fields of an exported reminder, in the order of the CSV columns
+EXPORT_FIELDS = ('serial', 'category', 'content', 'date', 'date_due')
+
+# Encoded reminders start with a magic number, which no pickle starts with,
+# and a format version. The header is followed by the UTF-8 category and
+# content: magic, version, flags, serial, date and due date ordinals, and the
+# lengths of the category and content.
+RECORD_MAGIC = b'\0R'
+RECORD_VERSION = 1
+RECORD_HEADER = struct.Struct('<2sBBQiiHI')
+HAS_CONTENT, HAS_DATE, HAS_DUE = 1, 2, 4
+
+# Processes sharing a database take a lock on a file beside it, which holds
+# the number of transactions that have written to the database. Waits for
+# the lock poll with a growing interval, and give up after LOCK_TIMEOUT.
+LOCK_SUFFIX = '.lock'
+LOCK_GENERATION = struct.Struct('<Q')
+LOCK_TIMEOUT = 30.0
+LOCK_POLL_INTERVAL = 0.001
+LOCK_POLL_MAX = 0.05
+
+# `todo serve` listens on a socket named after the database, and answers
+# these TodoStore calls. Messages are JSON preceded by their length.
+SOCKET_SUFFIX = '.sock'
+SERVED_CALLS = ('categories', 'iterate', 'iterate_serials', 'iterate_due',
+                'get', 'append', 'add_many', 'discard', 'exists', 'add',
+                'remove', 'remove_matching', 'remove_many', 'update', 'search',
+                'search_content', 'search_due', 'search_created', 'query',
+                'compact', 'renumber', 'rebuild_indexes', 'verify_indexes')
+MESSAGE_HEADER = struct.Struct('<I')
+
+# Journal databases are a snapshot file, starting with JOURNAL_MAGIC, and a
+# log beside it. Both are sequences of entries: an operation, the length of
+# its payload and a CRC32 of the payload, followed by the payload.
+JOURNAL_MAGIC = b'TODOJOURNAL1\n'
+JOURNAL_LOG_SUFFIX = '-log'
+JOURNAL_ENTRY = struct.Struct('<BII')
+JOURNAL_SERIAL = struct.Struct('<Q')
+# A commit forces the log to disk after this many entries or seconds
+JOURNAL_SYNC_ENTRIES = 100
+JOURNAL_SYNC_SECONDS = 1.0
+# Logs below this size are not compacted on close
+JOURNAL_COMPACT_SIZE = 1 << 20
+
+# Caches of a database are kept up to date by the lock generation and by
+# the latest modification time, in nanoseconds, and total size of the files
+# the database is kept in, found by these suffixes to its path. The files
+# catch writes made without the lock, such as restoring a backup.
+DATABASE_SUFFIXES = ('', '.dat', '.dir', '.db', '.pag', JOURNAL_LOG_SUFFIX,
+                     '-wal', '-journal')
+
+# A columnar snapshot of every reminder's serial, dates and category is
+# cached beside the database, for `todo stats` and queries that no single
+# index can answer. Its header holds the magic number, a format version, the
+# byte order of the columns, the lock generation it was built at, the
+# modification time and size of the database then, the number of reminders,
+# and the length of the category names that follow.
+COLUMNS_SUFFIX = '.columns'
+COLUMNS_MAGIC = b'TODOCOLS'
+COLUMNS_VERSION = 2
+COLUMNS_HEADER = struct.Struct('<8sBcQQQII')
+# Typecodes of the serial, date, due date and category columns, for array
+# and for NumPy. Python 2's array has no 'q', so serials are C longs there,
+# and the columns are only cached where those are 64 bits as well.
+COLUMN_TYPES = (('q' if bytes is not str else 'l', 'int64'),
+                ('i', 'int32'), ('i', 'int32'), ('i', 'int32'))
+
+# Read-only commands map a snapshot of the database kept beside it. Its
+# header holds the magic number, a format version, the byte order of its
+# tables, the lock generation it was taken at, the modification time and
+# size of the database then, the last serial handed out,
+# the number of reminders, of those with a due date and of those with a
+# creation date, and the length of the category names that follow. The
+# tables and the encoded reminders come after, each aligned to 8 bytes.
+SNAPSHOT_SUFFIX = '.snapshot'
+SNAPSHOT_MAGIC = b'TODOSNAP'
+SNAPSHOT_VERSION = 2
+SNAPSHOT_HEADER = struct.Struct('<8sBcQQQQIIII')
+
+# --profile reports the wall time of each phase of a command, in this order,
+# and these counters of the work done by the storage backend
+PROFILE_PHASES = ('parse', 'open', 'read', 'filter', 'write', 'print',
+                  'close')
+PROFILE_COUNTERS = ('opens', 'keys_read', 'bytes_read', 'keys_written',
+                    'bytes_written', 'keys_deleted')
+# Phase of the time spent in each backend call, 'read' for any other
+BACKEND_PHASES = {'put': 'write', 'delete': 'write', 'delete_many': 'write',
+                  'update': 'write', 'commit': 'write',
+                  'reset_serial': 'write', 'reserve_serials': 'write',
+                  'renumber': 'write', 'rebuild_indexes': 'write',
+                  'compact': 'write', 'close': 'close', 'abandon': 'close'}
+
+try:
+    intern = sys.intern
+except AttributeError:
+    # Python 2, whose intern only takes byte strings
+    def intern(text, _intern=intern):
+        return _intern(text) if isinstance(text, str) else text
+
+if bytes is str:
+    # Python 2, where text stays in byte strings as UTF-8, as the command
+    # line gives it, and only unicode needs encoding
+    def _to_utf8(text):
+        return text.encode('utf-8') if isinstance(text, unicode) else text
+
+    def _from_utf8(data):
+        return bytes(data)
+else:
+    def _to_utf8(text):
+        return text.encode('utf-8')
+
+    def _from_utf8(data):
+        return data.decode('utf-8')
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+
+# Each added reminder is an instance of the following class
+class Reminder(object):
+    """A reminder unit with a date, optional due date, category, and content
+    Reminders are numbered when they are first stored, so those used only as
+    search templates never take up a serial.
+    """
+    __slots__ = ('serial', 'date', 'content', 'category', 'date_due')
+
+    def __init__(self, content=None, category=None, date_due=None, date=None,
+                 serial=None):
+        self.serial = serial
+        self.date = date if date else datetime.date.today()
+        self.content = content
+        # Categories repeat across many reminders, so share the strings
+        self.category = intern(category) if category else 'general'
+        self.date_due = date_due
+
+    def __getstate__(self):
+        return self._asdict()
+
+    def __setstate__(self, state):
+        """Restores pickled reminders, including those pickled before
+        Reminder had __slots__
+        """
+        if isinstance(state, tuple):
+            state = state[1]
+        for name in self.__slots__:
+            setattr(self, name, state.get(name))
+
+    def __eq__(self, other):
+        """Attempts an equivalency match between two Reminders
+        If a compared field in either Reminder is None, that field
+        is ignored. The date the reminders were added is ignored.
+        """
+        for attrib in ('content', 'category', 'date_due'):
+            self_attr = getattr(self, attrib)
+            other_attr = getattr(other, attrib)
+
+            if self_attr is None or other_attr is None:
+                continue
+            elif self_attr != other_attr:
+                return False
+
+        return True
+
+    def __str__(self):
+        string = "{category}: #{serial} - {content}"
+        if self.date_due:
+            string += " (Due: {date_due})"
+
+        return string.format(**self._asdict())
+
+    def _asdict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def encode(self):
+        """Encodes the reminder in the compact binary record format"""
+        flags = 0
+        content = b''
+        if self.content is not None:
+            flags |= HAS_CONTENT
+            content = _to_utf8(self.content)
+        if self.date:
+            flags |= HAS_DATE
+        if self.date_due:
+            flags |= HAS_DUE
+        category = _to_utf8(self.category)
+
+        header = RECORD_HEADER.pack(
+            RECORD_MAGIC, RECORD_VERSION, flags, self.serial,
+            self.date.toordinal() if self.date else 0,
+            self.date_due.toordinal() if self.date_due else 0,
+            len(category), len(content))
+        return header + category + content
+
+    @staticmethod
+    def decode(data):
+        """Rebuilds a reminder from the compact binary record format"""
+        (magic, version, flags, serial, date, date_due, category_length,
+         content_length) = RECORD_HEADER.unpack_from(data)
+        if magic != RECORD_MAGIC or version != RECORD_VERSION:
+            raise InvalidRecordException(
+                "Unsupported record format: {!r}".format(data[:3]))
+
+        start = RECORD_HEADER.size
+        category = _from_utf8(data[start:start + category_length])
+        start += category_length
+        content = _from_utf8(data[start:start + content_length])
+
+        reminder = Reminder.__new__(Reminder)
+        reminder.serial = serial
+        reminder.category = intern(category)
+        reminder.content = content if flags & HAS_CONTENT else None
+        reminder.date = (datetime.date.fromordinal(date)
+                         if flags & HAS_DATE else None)
+        reminder.date_due = (datetime.date.fromordinal(date_due)
+                             if flags & HAS_DUE else None)
+        return reminder
+
+    @staticmethod
+    def next_serial():
+        with _load_store() as store:
+            return store.next_serial()
+
+
+# Exceptions used when adding or removing reminders or parsing a date
+class ReminderExistsException(Exception):
+    pass
+
+
+class ReminderDoesNotExistException(Exception):
+    pass
+
+
+class InvalidDateException(Exception):
+    pass
+
+
+class InvalidSerialException(Exception):
+    pass
+
+
+class DatabaseDoesNotExistException(Exception):
+    pass
+
+
+class DatabaseNotEmptyException(Exception):
+    pass
+
+
+class InvalidRecordException(Exception):
+    pass
+
+
+class ServerErrorException(Exception):
+    pass
+
+
+class LockTimeoutException(Exception):
+    pass
+
+
+# Storage
+class Query():
+    """A search combining any of a category, a piece of content, and ranges
+    of due dates, creation dates and serials
+
+    Ranges are (low, high) pairs, either end of which may be None to leave
+    it open, and any criterion left as None matches every reminder. The
+    planner picks one index to find candidates with, see `plan`, and the
+    remaining criteria filter them as they are read.
+    """
+    FIELDS = ('category', 'content', 'case_insensitive', 'due', 'created',
+              'serials')
+
+    def __init__(self, category=None, content=None, case_insensitive=False,
+                 due=None, created=None, serials=None):
+        self.category = category
+        self.content = content
+        self.case_insensitive = case_insensitive
+        self.due = tuple(due) if due is not None else None
+        self.created = tuple(created) if created is not None else None
+        self.serials = tuple(serials) if serials is not None else None
+
+    def __repr__(self):
+        return 'Query({})'.format(', '.join(
+            '{}={!r}'.format(name, getattr(self, name))
+            for name in self.FIELDS if getattr(self, name)))
+
+    def _asdict(self):
+        return dict((name, getattr(self, name)) for name in self.FIELDS)
+
+    def is_empty(self):
+        return all(getattr(self, name) is None for name in self.FIELDS
+                   if name != 'case_insensitive')
+
+    def matches(self, reminder):
+        if self.category is not None and reminder.category != self.category:
+            return False
+        elif self.content is not None and not _content_matches(
+                reminder, self.content, self.case_insensitive):
+            return False
+        return (_in_range(reminder.date_due, self.due) and
+                _in_range(reminder.date, self.created) and
+                _in_range(reminder.serial, self.serials))
+
+    def plan(self):
+        """Chooses the index to find candidates with, in order of how few
+        they are likely to be: a closed range of serials, the content's
+        trigrams, a closed range of due or creation dates, the category,
+        and lastly a half open range. Returns 'serial', 'content', 'due',
+        'created', 'category', or 'scan' when there is nothing to narrow
+        the search.
+        """
+        ranges = [(name, bounds) for name, bounds in (
+            ('serial', self.serials), ('due', self.due),
+            ('created', self.created)) if bounds is not None]
+        for name, bounds in ranges:
+            if name == 'serial' and None not in bounds:
+                return name
+        if self.content and _trigrams(self.content):
+            return 'content'
+        for name, bounds in ranges:
+            if None not in bounds:
+                return name
+        if self.category is not None:
+            return 'category'
+        for name, bounds in ranges:
+            if bounds != (None, None):
+                return name
+        return 'scan'
+
+    def use_columns(self):
+        """Chooses whether to answer from the Columns snapshot: 'build' when
+        nothing narrows the search, so every reminder would be read anyway,
+        'cached' when several criteria without content are combined, so
+        the snapshot is used while it is up to date, or else None.
+        """
+        if self.content is not None:
+            return None
+        elif self.plan() == 'scan':
+            return 'build'
+        criteria = [name for name in self.FIELDS
+                    if name != 'case_insensitive' and
+                    getattr(self, name) is not None]
+        return 'cached' if len(criteria) > 1 else None
+
+
+class Columns():
+    """The serials, creation and due dates, and categories of every
+    reminder, held as columns
+
+    Dates are ordinals, 0 standing for no date, and categories are codes
+    indexing `categories`. Filtering and counting work on whole columns at
+    once with NumPy if it is installed, and loop over arrays otherwise. A
+    snapshot records the lock generation it was built at and the database's
+    (modification time, size) stamp, see `_database_stamp`, so a cached one
+    is only used while nothing has been written since.
+    """
+    def __init__(self, serials, dates, due, codes, categories,
+                 generation=None, stamp=None):
+        self.serials = serials
+        self.dates = dates
+        self.due = due
+        self.codes = codes
+        self.categories = categories
+        self.generation = generation
+        self.stamp = stamp
+
+    def __len__(self):
+        return len(self.serials)
+
+    @classmethod
+    def build(cls, reminders, generation=None, stamp=None):
+        """Builds a snapshot of the reminders from an iterable"""
+        import array
+        columns = [array.array(code) for code, dtype in COLUMN_TYPES]
+        codes = {}
+        for reminder in reminders:
+            code = codes.setdefault(reminder.category, len(codes))
+            for column, value in zip(columns, (
+                    reminder.serial, _to_ordinal(reminder.date) or 0,
+                    _to_ordinal(reminder.date_due) or 0, code)):
+                column.append(value)
+
+        numpy = _numpy()
+        if numpy is not None:
+            columns = [numpy.frombuffer(column, dtype)
+                       for column, (code, dtype) in zip(columns,
+                                                         COLUMN_TYPES)]
+        categories = sorted(codes, key=codes.get)
+        return cls(*columns, categories=categories, generation=generation,
+                   stamp=stamp)
+
+    @classmethod
+    def load(cls, path):
+        """Reads a snapshot saved by `save`, returning None if there is
+        none or it cannot be used
+        """
+        try:
+            with open(path, 'rb') as stream:
+                data = stream.read()
+        except (IOError, OSError):
+            return None
+        if len(data) < COLUMNS_HEADER.size or not _columns_cached():
+            return None
+
+        (magic, version, byteorder, generation, mtime, size, count,
+         length) = COLUMNS_HEADER.unpack_from(data)
+        if (magic != COLUMNS_MAGIC or version != COLUMNS_VERSION or
+                byteorder != sys.byteorder[0].encode('ascii')):
+            return None
+
+        offset = COLUMNS_HEADER.size + length
+        names = data[COLUMNS_HEADER.size:offset].decode('utf-8')
+        categories = names.split('\0') if names else []
+
+        import array
+        numpy = _numpy()
+        columns = []
+        for code, dtype in COLUMN_TYPES:
+            end = offset + array.array(code).itemsize * count
+            if numpy is not None:
+                column = numpy.frombuffer(data, dtype, count, offset)
+            else:
+                column = array.array(code, data[offset:end])
+            columns.append(column)
+            offset = end
+        return cls(*columns, categories=categories, generation=generation,
+                   stamp=(mtime, size))
+
+    def save(self, path):
+        """Writes the snapshot to a file, replacing it in a single rename.
+        Nothing is written where the columns cannot be cached, see
+        COLUMN_TYPES.
+        """
+        if not _columns_cached():
+            return
+        names = '\0'.join(self.categories).encode('utf-8')
+        mtime, size = self.stamp or (0, 0)
+        temporary = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temporary, 'wb') as stream:
+            stream.write(COLUMNS_HEADER.pack(
+                COLUMNS_MAGIC, COLUMNS_VERSION,
+                sys.byteorder[0].encode('ascii'), self.generation or 0,
+                mtime, size, len(self), len(names)))
+            stream.write(names)
+            for column in (self.serials, self.dates, self.due, self.codes):
+                column.tofile(stream)
+        os.rename(temporary, path)
+
+    def select(self, query):
+        """Returns the serials of the reminders matching a Query's category
+        and ranges of due dates, creation dates and serials. Content is
+        left for the caller to check.
+        """
+        if query.category is not None:
+            if query.category not in self.categories:
+                return []
+            code = self.categories.index(query.category)
+
+        bounds = []
+        for column, dates in ((self.due, query.due),
+                              (self.dates, query.created)):
+            if dates is not None:
+                low, high = [_to_ordinal(date) for date in dates]
+                bounds.append((column, low or 1, high))
+        if query.serials is not None:
+            bounds.append((self.serials,) + tuple(query.serials))
+
+        if hasattr(self.serials, 'dtype'):
+            numpy = _numpy()
+            mask = numpy.ones(len(self), dtype=bool)
+            if query.category is not None:
+                mask &= self.codes == code
+            for column, low, high in bounds:
+                if low is not None:
+                    mask &= column >= low
+                if high is not None:
+                    mask &= column <= high
+            return self.serials[mask].tolist()
+
+        matches = []
+        for index, serial in enumerate(self.serials):
+            if query.category is not None and self.codes[index] != code:
+                continue
+            for column, low, high in bounds:
+                value = column[index]
+                if ((low is not None and value < low) or
+                        (high is not None and value > high)):
+                    break
+            else:
+                matches.append(serial)
+        return matches
+
+    def stats(self, today=None):
+        """Counts the reminders in total, in each category, overdue, due
+        today and without a due date, and due in each month
+        Returns a dictionary of the counts, with categories mapped to their
+        count and the number overdue, and months as 'YYYY-MM'.
+        """
+        today = (today or datetime.date.today()).toordinal()
+        if hasattr(self.serials, 'dtype'):
+            numpy = _numpy()
+            dated = self.due > 0
+            overdue = dated & (self.due < today)
+            per_category = numpy.bincount(
+                self.codes, minlength=len(self.categories)).tolist()
+            overdue_per_category = numpy.bincount(
+                self.codes[overdue], minlength=len(self.categories)).tolist()
+            days, counts = numpy.unique(self.due[dated], return_counts=True)
+            by_day = zip(days.tolist(), counts.tolist())
+            totals = (int(overdue.sum()), int((self.due == today).sum()),
+                      len(self) - int(dated.sum()))
+        else:
+            per_category = [0] * len(self.categories)
+            overdue_per_category = [0] * len(self.categories)
+            days = {}
+            for code, due in zip(self.codes, self.due):
+                per_category[code] += 1
+                if due:
+                    days[due] = days.get(due, 0) + 1
+                    if due < today:
+                        overdue_per_category[code] += 1
+            by_day = days.items()
+            totals = (sum(overdue_per_category), days.get(today, 0),
+                      len(self) - sum(days.values()))
+
+        months = {}
+        for day, count in by_day:
+            month = datetime.date.fromordinal(day).strftime('%Y-%m')
+            months[month] = months.get(month, 0) + count
+
+        return {'total': len(self),
+                'overdue': totals[0], 'due_today': totals[1],
+                'undated': totals[2],
+                'categories': dict(
+                    (name, (count, overdue)) for name, count, overdue in zip(
+                        self.categories, per_category, overdue_per_category)),
+                'due_by_month': months}
+
+
+class TodoStore():
+    """A reminder database kept open across operations
+
+    The backend is opened on first use and stays open until `close`, so a
+    command (or a process embedding Trivial Todo) pays for opening and syncing
+    the database once rather than on every call. The location may be a path
+    or a URI such as 'sqlite:///home/me/todo.sqlite', see `open_backend`.
+
+    Each call holds the database's lock, see `transaction`, so several
+    processes can share a database. Waiting longer than `lock_timeout`
+    seconds for it raises LockTimeoutException; None waits for ever.
+
+    A `read_only` store reads from a SnapshotBackend mapped from beside the
+    database, which stores that write take again before they close. While
+    it is missing or out of date, see _StaleSnapshot. It cannot write.
+    """
+    # Fields `update` can change
+    UPDATE_FIELDS = ('content', 'category', 'date_due')
+
+    def __init__(self, path=None, lock_timeout=LOCK_TIMEOUT,
+                 read_only=False):
+        self.path = path if path else DB_LOCATION
+        self.read_only = read_only
+        self._backend = None
+        # The _StaleSnapshot standing in for the snapshot, if any
+        self._stale = None
+        self._serials = None
+        self._written = False
+        self._lock = DatabaseLock(_split_location(self.path)[1] + LOCK_SUFFIX,
+                                  lock_timeout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self):
+        return self.iterate()
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            with _phase('open'):
+                backend = self._open_backend()
+            if _profiler is not None:
+                _profiler.count('opens')
+                backend = _ProfiledBackend(backend, _profiler)
+            self._backend = backend
+        return self._backend
+
+    def _open_backend(self):
+        """Opens the database's backend, or for a read-only store the
+        snapshot beside it, see _StaleSnapshot for when it is out of date
+
+        Other processes may be reading under the shared lock, so a database
+        needing an upgrade is opened again once the lock is exclusive, and
+        checked afresh: two processes opening an old database at once
+        upgrade it only once.
+        """
+        # The lock records what has been seen of the database
+        with self.transaction():
+            if self.read_only:
+                snapshot = self._fresh_snapshot()
+                if snapshot is not None:
+                    return snapshot
+
+            # Opening may create an empty file, which would no longer be
+            # told apart by its extension
+            location = '{}://{}'.format(*_split_location(self.path))
+            backend = open_backend(location, upgrade=self._lock.exclusive)
+            if backend.needs_upgrade():
+                backend.abandon()
+                with self._lock.promote():
+                    backend = open_backend(location)
+            if self.read_only:
+                self._stale = _StaleSnapshot(backend, self._take_snapshot)
+                return self._stale
+            return backend
+
+    def _snapshot_path(self):
+        return _split_location(self.path)[1] + SNAPSHOT_SUFFIX
+
+    def _fresh_snapshot(self):
+        """Maps the snapshot beside the database if it is up to date"""
+        if not hasattr(memoryview, 'cast'):
+            # Python 2
+            return None
+        return SnapshotBackend.open(self._snapshot_path(),
+                                    self._lock.generation,
+                                    _database_stamp(self.path))
+
+    def _take_snapshot(self, backend):
+        """Writes the snapshot beside the database from its backend and maps
+        it. Falls back on the backend itself if the snapshot cannot be
+        written.
+        """
+        if not hasattr(memoryview, 'cast'):
+            return backend
+
+        path = self._snapshot_path()
+        generation = self._lock.generation
+        stamp = _database_stamp(self.path)
+        try:
+            SnapshotBackend.write(path, backend, generation, stamp)
+        except (IOError, OSError):
+            return backend
+        snapshot = SnapshotBackend.open(path, generation, stamp)
+        if snapshot is None:
+            return backend
+        backend.abandon()
+        return snapshot
+
+    @property
+    def lock_stats(self):
+        """How often the lock was taken and waited for, see DatabaseLock"""
+        return self._lock.stats
+
+    def transaction(self, exclusive=False):
+        """Holds the database's lock for the calls made within it
+
+        The lock is shared, letting other processes read at the same time,
+        or exclusive, for writing. Every call takes the lock it needs itself,
+        so a transaction is only needed to make several calls atomic, such
+        as reading a reminder and writing it back. The lock cannot be
+        upgraded atomically, so a transaction that writes must be exclusive
+        from the start.
+        """
+        self._written = self._written or exclusive
+        return self._lock.hold(exclusive, self._changed)
+
+    def _changed(self):
+        """Called when another process has written to the database since
+        the lock was last held
+        """
+        if self._backend is not None and not self._backend.CONCURRENT:
+            self._backend.abandon()
+            self._backend = self._stale = None
+
+    def close(self):
+        if not self._written:
+            # Nothing to write back, and other processes need not be told
+            # that anything changed
+            with self.transaction():
+                if self._stale is not None:
+                    # For the next command, now this one is done
+                    self._stale.take()
+                if self._backend is not None:
+                    self._backend.abandon()
+                    self._backend = self._stale = None
+            self._lock.close()
+            return
+
+        with self.transaction(exclusive=True):
+            if self._serials is not None:
+                self._serials.backend = self.backend
+                self._serials.release()
+                self._serials = None
+            if self._backend is not None:
+                self._backend.commit()
+                self._refresh_snapshot()
+                self._backend.close()
+                self._backend = None
+        self._lock.close()
+
+    def _refresh_snapshot(self):
+        """Takes the snapshot again once a store has written, while the
+        exclusive lock keeps readers out, so that the next read-only store
+        finds it up to date. Only a snapshot read-only stores have already
+        taken is kept up. Closing the backend may yet change its files, as
+        when a journal compacts, in which case see _StaleSnapshot.
+        """
+        path = self._snapshot_path()
+        if not hasattr(memoryview, 'cast') or not os.path.exists(path):
+            return
+        # The count of writes once this transaction lets go of the lock
+        generation = self._lock.generation + 1
+        try:
+            SnapshotBackend.write(path, self._backend, generation,
+                                  _database_stamp(self.path))
+        except (IOError, OSError):
+            # Read-only stores take it themselves
+            pass
+
+    def next_serial(self):
+        """Hands out a serial from the block reserved by this store"""
+        with self.transaction(exclusive=True):
+            if self._serials is None:
+                self._serials = SerialAllocator(self.backend)
+            self._serials.backend = self.backend
+            return self._serials.allocate()
+
+    def categories(self):
+        with self.transaction():
+            return self.backend.categories()
+
+    def iterate(self, category=None):
+        """Provides an iterator for all of the reminders, or those in one
+        category. Reminders are grouped by category and ordered by serial.
+        The lock is held until the iterator is exhausted or discarded.
+        """
+        with self.transaction():
+            for reminder in self.backend.iterate(category):
+                yield reminder
+
+    def iterate_serials(self, start=0):
+        """Provides an iterator for the reminders in order of serial, from
+        the first numbered after `start`
+        """
+        with self.transaction():
+            for reminder in self.backend.iterate_serials(start):
+                yield reminder
+
+    def iterate_due(self, start=None):
+        """Provides an iterator for the reminders with a due date, in order
+        of it and then of serial, from the first after the (due date,
+        serial) pair `start`
+        """
+        start = tuple(start) if start else None
+        with self.transaction():
+            low = start[0] if start else None
+            for reminder in self.backend.find_due((low, None)):
+                if start and (reminder.date_due, reminder.serial) <= start:
+                    continue
+                yield reminder
+
+    def get(self, serial):
+        """Finds a reminder by number, returning None if there is no such
+        reminder
+        """
+        with self.transaction():
+            return self.backend.get(serial)
+
+    def append(self, reminder):
+        """Stores a reminder without checking for duplicates, numbering it
+        if it has no serial yet
+        """
+        with self.transaction(exclusive=True):
+            if reminder.serial is None:
+                reminder.serial = self.next_serial()
+            self.backend.put(reminder)
+            self.backend.commit()
+
+    def add_many(self, reminders, batch_size=IMPORT_BATCH_SIZE,
+                 keep_serials=False):
+        """Adds reminders from an iterable, skipping those that already exist
+        Changes are committed every `batch_size` reminders and serials are
+        reserved as many at a time, unless `keep_serials` is set, in which
+        case the reminders keep the serials they have. Returns the number of
+        reminders added and the number skipped.
+        """
+        added = skipped = 0
+        with self.transaction(exclusive=True):
+            serials = SerialAllocator(self.backend, batch_size)
+            highest = self.backend.last_serial()
+
+            for reminder in reminders:
+                if keep_serials and reminder.serial is None:
+                    raise InvalidSerialException(
+                        "Cannot keep the serial of a reminder without one")
+                elif keep_serials and self.get(reminder.serial) is not None:
+                    skipped += 1
+                    continue
+                elif self.exists(reminder):
+                    skipped += 1
+                    continue
+
+                if keep_serials:
+                    highest = max(highest, reminder.serial)
+                else:
+                    reminder.serial = serials.allocate()
+
+                self.backend.put(reminder)
+                added += 1
+                if added % batch_size == 0:
+                    self.backend.commit()
+
+            if keep_serials:
+                self.backend.reset_serial(highest)
+            serials.release()
+            self.backend.commit()
+
+        return added, skipped
+
+    def discard(self, reminder):
+        """Removes the given reminder, or the first stored reminder in its
+        category equal to it
+        """
+        with self.transaction(exclusive=True):
+            stored = self.get(reminder.serial)
+            if stored is None or stored != reminder:
+                stored = next((item for item in self.iterate(
+                    reminder.category) if item == reminder), None)
+            if stored is None:
+                raise ReminderDoesNotExistException(
+                    "Could not find matching reminder")
+
+            self.backend.delete(stored)
+            self.backend.commit()
+
+    def update(self, serial, **fields):
+        """Changes any of the content, category and due date of a stored
+        reminder, in place and in a single transaction, and returns the
+        changed reminder. Only the indexes of the fields that changed are
+        written, where the backend allows. A due date of None clears it.
+        The other fields are kept as stored. As with `add`, a change that
+        would make the reminder equal to another is refused.
+        """
+        unknown = set(fields) - set(self.UPDATE_FIELDS)
+        if unknown:
+            raise TypeError("Cannot update {}".format(
+                ', '.join(sorted(unknown))))
+
+        with self.transaction(exclusive=True):
+            stored = self.backend.get(serial)
+            if stored is None:
+                raise ReminderDoesNotExistException(
+                    "Could not find matching reminder")
+
+            reminder = Reminder.__new__(Reminder)
+            reminder.__setstate__(dict(stored._asdict(), **fields))
+            if reminder.category is not None:
+                reminder.category = intern(reminder.category)
+            if (reminder.content is not None and
+                    reminder.category is not None and
+                    self.backend.find_duplicate(reminder, serial) is not None):
+                raise ReminderExistsException("Reminder already exists")
+
+            self.backend.update(stored, reminder)
+            self.backend.commit()
+            return reminder
+
+    def exists(self, reminder):
+        """Check to determine of a reminder exists, returning a bool"""
+        with self.transaction():
+            if (reminder.content is not None and
+                    reminder.category is not None):
+                return self.backend.find_duplicate(reminder) is not None
+
+            for item in self.iterate():
+                if item == reminder:
+                    return True
+
+            return False
+
+    def add(self, reminder):
+        """Adds a reminder to the database unless it already exists"""
+        with self.transaction(exclusive=True):
+            if self.exists(reminder):
+                raise ReminderExistsException("Reminder already exists")
+
+            self.append(reminder)
+
+    def remove(self, reminder):
+        """Removes a reminder if one exists"""
+        with self.transaction(exclusive=True):
+            if not self.exists(reminder):
+                raise ReminderDoesNotExistException(
+                    "The reminder that you're attempting to remove does not "
+                    "exist.")
+
+            self.discard(reminder)
+
+    def remove_matching(self, query):
+        """Removes every reminder matching a Query in a single transaction,
+        and returns them. The reminders are found in one pass, see `query`,
+        and the backend removes them together, see Backend.delete_many.
+        """
+        with self.transaction(exclusive=True):
+            reminders = list(self.query(query))
+            self.backend.delete_many(reminders)
+            self.backend.commit()
+            return reminders
+
+    def remove_many(self, serials):
+        """Removes the reminders with the given serials in a single
+        transaction, skipping any no longer stored, and returns them
+        """
+        with self.transaction(exclusive=True):
+            reminders = [reminder for reminder in map(self.get, serials)
+                         if reminder is not None]
+            self.backend.delete_many(reminders)
+            self.backend.commit()
+            return reminders
+
+    def search(self, target, field):
+        """Returns all matching reminders based on a given field and target
+        Returns a list of matches
+        """
+        with self.transaction():
+            if field == 'serial':
+                reminder = self.get(target)
+                matches = [reminder] if reminder is not None else []
+            else:
+                matches = list(self.backend.find_field(target, field))
+
+        if not matches:
+            raise ReminderDoesNotExistException(
+                "Could not find matching reminder")
+
+        return matches
+
+    def search_content(self, content, case_insensitive=False, due=None):
+        """Searches for reminders by partial content
+        Returns a list of all matches. Optional parameter for case
+        insensitivity. Case sensitive by default. Matches can be limited to
+        a (low, high) range of due dates, see `_due_range`.
+        """
+        with self.transaction():
+            return list(self.backend.find_content(content, case_insensitive,
+                                                  due))
+
+    def search_due(self, due):
+        """Returns the reminders due within a (low, high) range of dates,
+        ordered by due date
+        """
+        with self.transaction():
+            return list(self.backend.find_due(due))
+
+    def search_created(self, created):
+        """Returns the reminders added within a (low, high) range of dates,
+        ordered by the date they were added
+        """
+        with self.transaction():
+            return list(self.backend.find_created(created))
+
+    def columns(self, build=True):
+        """Returns a Columns snapshot of the reminders, from the cache
+        beside the database if nothing has been written since it was saved.
+        Otherwise the snapshot is built and cached again, unless `build` is
+        False, in which case None is returned.
+        """
+        path = _split_location(self.path)[1] + COLUMNS_SUFFIX
+        with self.transaction():
+            generation = self._lock.generation
+            stamp = _database_stamp(self.path)
+            columns = Columns.load(path)
+            if (columns is not None and columns.generation == generation and
+                    columns.stamp == stamp):
+                return columns
+            elif not build:
+                return None
+
+            columns = Columns.build(self.backend.iterate(), generation,
+                                    stamp)
+            try:
+                columns.save(path)
+            except (IOError, OSError):
+                # Only a cache
+                pass
+            return columns
+
+    def query(self, query):
+        """Provides an iterator for the reminders matching a Query, found
+        through the index its plan chooses. The order of the reminders
+        depends on that index.
+
+        Queries without content that combine several criteria are answered
+        from the cached Columns snapshot while it is up to date, so only the
+        matching reminders are read. Those that no index narrows would read
+        every reminder anyway, so they build the snapshot if need be.
+        """
+        plan, use_columns = query.plan(), query.use_columns()
+        with self.transaction():
+            backend = self.backend
+            columns = None
+            if use_columns is not None:
+                columns = self.columns(build=use_columns == 'build')
+
+            if columns is not None:
+                for serial in columns.select(query):
+                    reminder = backend.get(serial)
+                    if reminder is not None:
+                        yield reminder
+                return
+
+            if plan == 'serial':
+                low, high = query.serials
+                if low is not None and low == high:
+                    reminder = backend.get(low)
+                    candidates = [reminder] if reminder is not None else []
+                else:
+                    candidates = backend.iterate_serials((low or 1) - 1)
+            elif plan == 'content':
+                candidates = backend.find_content(
+                    query.content, query.case_insensitive, query.due)
+            elif plan == 'due':
+                candidates = backend.find_due(query.due)
+            elif plan == 'created':
+                candidates = backend.find_created(query.created)
+            else:
+                candidates = backend.iterate(query.category)
+
+            for reminder in candidates:
+                if (plan == 'serial' and query.serials[1] is not None and
+                        reminder.serial > query.serials[1]):
+                    break
+                if query.matches(reminder):
+                    yield reminder
+
+    def compact(self):
+        """Reclaims the space left behind by removed reminders"""
+        with self.transaction(exclusive=True):
+            self.backend.compact()
+
+    def renumber(self):
+        """Numbers the reminders from 1 without gaps, keeping their order
+        Returns a list of (old, new) serials for the reminders that moved.
+        """
+        with self.transaction(exclusive=True):
+            if self._serials is not None:
+                self._serials.backend = self.backend
+                self._serials.release()
+                self._serials = None
+
+            moved = self.backend.renumber()
+            self.backend.commit()
+        return moved
+
+    def rebuild_indexes(self):
+        """Rebuilds the indexes from the stored reminders
+        Returns the number of reminders indexed
+        """
+        with self.transaction(exclusive=True):
+            count = self.backend.rebuild_indexes()
+            self.backend.commit()
+        return count
+
+    def verify_indexes(self):
+        """Compares the indexes against the stored reminders
+        Returns a list of problems found, which is empty for sound indexes
+        """
+        with self.transaction():
+            return self.backend.verify_indexes()
+
+
+class SerialAllocator():
+    """Hands out serial numbers from blocks reserved with a single write
+
+    The first block holds a single serial, so that adding one reminder
+    writes the last serial only once, and each block after it is twice the
+    size of the one before, up to `block_size`.
+    """
+    def __init__(self, backend, block_size=SERIAL_BLOCK):
+        self.backend = backend
+        self.block_size = block_size
+        self._next, self._end = 1, 0
+        self._size = 1
+
+    def allocate(self):
+        if self._next > self._end:
+            self._next = self.backend.reserve_serials(self._size)
+            self._end = self._next + self._size - 1
+            self._size = min(self._size * 2, self.block_size)
+
+        serial = self._next
+        self._next += 1
+        return serial
+
+    def release(self):
+        """Gives back the rest of the current block, unless serials have been
+        reserved since
+        """
+        backend = self.backend
+        if self._next <= self._end and backend.last_serial() == self._end:
+            backend.reset_serial(self._next - 1)
+            backend.commit()
+        self._next, self._end = 1, 0
+        self._size = 1
+
+
+class DatabaseLock():
+    """A reader/writer lock shared by every process using a database
+
+    The lock is an flock on a file beside the database, which also counts
+    the transactions that have written to it. A store compares the count
+    when it takes the lock to learn whether another process has written
+    since. Holding the lock again within a transaction is free, and waits
+    for it are recorded in `stats`. Without fcntl, as on Windows, nothing is
+    locked.
+    """
+    def __init__(self, path, timeout=LOCK_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        self.stats = {'acquired': 0, 'waited': 0, 'wait_time': 0.0,
+                      'longest_wait': 0.0}
+        self._file = None
+        self._depth = 0
+        self._exclusive = False
+        self._generation = None
+
+    @contextmanager
+    def hold(self, exclusive=False, changed=None):
+        """Holds the lock for the duration of a with block, calling
+        `changed` if the database has been written to since it was last held
+        """
+        if self._depth:
+            if exclusive and not self._exclusive:
+                raise RuntimeError(
+                    "Cannot write within a shared transaction")
+            self._depth += 1
+            try:
+                yield
+            finally:
+                # An iterator finished after the outer transaction has
+                # already let go of the lock
+                if self._depth:
+                    self._depth -= 1
+            return
+
+        self._acquire(exclusive)
+        self._depth, self._exclusive = 1, exclusive
+        try:
+            generation = self._read_generation()
+            if generation != self._generation and changed is not None:
+                changed()
+            self._generation = generation
+            yield
+            if exclusive:
+                self._generation += 1
+                self._write_generation(self._generation)
+        finally:
+            self._depth, self._exclusive = 0, False
+            if fcntl is not None:
+                fcntl.flock(self._file, fcntl.LOCK_UN)
+
+    @contextmanager
+    def promote(self):
+        """Holds the lock exclusively for the duration of a with block, even
+        within a shared transaction, which holds it shared again afterwards.
+        The lock is let go of while it changes, so anything read before
+        must be read again.
+        """
+        if not self._depth or self._exclusive:
+            with self.hold(exclusive=True):
+                yield
+            return
+
+        self._acquire(exclusive=True)
+        self._exclusive = True
+        try:
+            yield
+            self._generation = self._read_generation() + 1
+            self._write_generation(self._generation)
+        finally:
+            self._exclusive = False
+            if fcntl is not None:
+                fcntl.flock(self._file, fcntl.LOCK_SH)
+
+    @property
+    def exclusive(self):
+        """Whether the lock is held exclusively"""
+        return bool(self._depth) and self._exclusive
+
+    @property
+    def generation(self):
+        """How many transactions had written to the database when the lock
+        was last taken
+        """
+        return self._generation
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _acquire(self, exclusive):
+        if self._file is None:
+            self._file = open(self.path, 'a+b')
+        self.stats['acquired'] += 1
+        if fcntl is None:
+            return
+
+        operation = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        try:
+            fcntl.flock(self._file, operation | fcntl.LOCK_NB)
+            return
+        except (IOError, OSError) as error:
+            if error.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+
+        started = time.time()
+        delay = LOCK_POLL_INTERVAL
+        while True:
+            if self.timeout is None:
+                fcntl.flock(self._file, operation)
+                break
+
+            waited = time.time() - started
+            if waited >= self.timeout:
+                self._record_wait(waited)
+                raise LockTimeoutException(
+                    "Timed out after {:.1f}s waiting for '{}'".format(
+                        waited, self.path))
+            time.sleep(min(delay, self.timeout - waited))
+            delay = min(delay * 2, LOCK_POLL_MAX)
+            try:
+                fcntl.flock(self._file, operation | fcntl.LOCK_NB)
+                break
+            except (IOError, OSError) as error:
+                if error.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+        self._record_wait(time.time() - started)
+
+    def _record_wait(self, waited):
+        self.stats['waited'] += 1
+        self.stats['wait_time'] += waited
+        self.stats['longest_wait'] = max(self.stats['longest_wait'], waited)
+
+    def _read_generation(self):
+        self._file.seek(0)
+        data = self._file.read(LOCK_GENERATION.size)
+        if len(data) < LOCK_GENERATION.size:
+            return 0
+        return LOCK_GENERATION.unpack(data)[0]
+
+    def _write_generation(self, generation):
+        self._file.seek(0)
+        self._file.truncate()
+        self._file.write(LOCK_GENERATION.pack(generation))
+        self._file.flush()
+
+
+class Profiler():
+    """Wall time spent in each phase of a command, and counters of the work
+    done by the storage backend
+
+    Phases nest: time spent in an inner phase, such as reading reminders
+    while filtering them, is not counted in the outer one, so the phases add
+    up to the time measured. Setting the module's `_profiler` to a Profiler
+    instruments the stores opened afterwards, as --profile does.
+    """
+    def __init__(self):
+        self.phases = dict.fromkeys(PROFILE_PHASES, 0.0)
+        self.counters = dict.fromkeys(PROFILE_COUNTERS, 0)
+        self._stack = []
+
+    def add(self, phase, elapsed):
+        """Records time spent outside of `phase`, such as before profiling
+        started
+        """
+        self.phases[phase] = self.phases.get(phase, 0.0) + elapsed
+
+    def count(self, counter, amount=1):
+        self.counters[counter] += amount
+
+    def start(self, phase):
+        now = _clock()
+        if self._stack:
+            outer = self._stack[-1]
+            self.add(outer[0], now - outer[1])
+        self._stack.append([phase, now])
+
+    def stop(self):
+        now = _clock()
+        phase, started = self._stack.pop()
+        self.add(phase, now - started)
+        if self._stack:
+            self._stack[-1][1] = now
+
+    @contextmanager
+    def phase(self, phase):
+        self.start(phase)
+        try:
+            yield
+        finally:
+            self.stop()
+
+    def report(self):
+        """Returns the phases and counters as a dictionary"""
+        return {'total': sum(self.phases.values()),
+                'phases': dict(self.phases), 'counters': dict(self.counters)}
+
+
+class Backend():
+    """Storage engine used by TodoStore
+
+    Subclasses store reminders and keep whatever indexes they need. The
+    searches implemented here scan every reminder and are only a fallback
+    for engines without a better way of answering them.
+    """
+    # Whether the engine sees writes made by other processes while open,
+    # rather than needing to be opened again
+    CONCURRENT = False
+    # Whether content searches are narrowed by an index of trigrams, rather
+    # than reading the content of every reminder
+    CONTENT_INDEX = False
+
+    def close(self):
+        raise NotImplementedError
+
+    def abandon(self):
+        """Closes a backend whose view of the database is out of date,
+        without writing anything back
+        """
+        self.close()
+
+    def needs_upgrade(self):
+        """Whether `upgrade` has anything to write, such as converting the
+        database from an older format or finishing an interrupted change
+        """
+        return False
+
+    def upgrade(self):
+        """Brings the database up to date, checking again what needs doing
+        Only called under the exclusive lock.
+        """
+
+    def commit(self):
+        """Makes the changes so far durable"""
+
+    def compact(self):
+        """Reclaims the space left behind by removed reminders"""
+
+    def last_serial(self):
+        """The most recently handed out serial number"""
+        raise NotImplementedError
+
+    def reset_serial(self, serial):
+        raise NotImplementedError
+
+    def reserve_serials(self, count):
+        """Hands out `count` consecutive serials with a single write
+        Returns the first of them.
+        """
+        first = self.last_serial() + 1
+        self.reset_serial(first + count - 1)
+        return first
+
+    def categories(self):
+        raise NotImplementedError
+
+    def iterate(self, category=None):
+        raise NotImplementedError
+
+    def iterate_serials(self, start=0):
+        """Yields the reminders numbered after `start` in order of serial"""
+        reminders = [reminder for reminder in self.iterate()
+                     if reminder.serial > start]
+        reminders.sort(key=lambda reminder: reminder.serial)
+        return iter(reminders)
+
+    def get(self, serial):
+        raise NotImplementedError
+
+    def put(self, reminder):
+        raise NotImplementedError
+
+    def delete(self, reminder):
+        """Removes a stored reminder"""
+        raise NotImplementedError
+
+    def delete_many(self, reminders):
+        """Removes several stored reminders, rewriting each index entry they
+        share only once where the engine allows
+        """
+        for reminder in reminders:
+            self.delete(reminder)
+
+    def update(self, old, new):
+        """Replaces a stored reminder with a changed copy of it, which keeps
+        its serial
+        """
+        self.delete(old)
+        self.put(new)
+
+    def renumber(self):
+        """Numbers the reminders from 1 in order of serial and sets the last
+        serial to match. Returns a list of (old, new) serials for the
+        reminders that moved.
+        """
+        serials = sorted(reminder.serial for reminder in self.iterate())
+        moved = [(old, new) for new, old in enumerate(serials, 1)
+                 if old != new]
+        # Serials only ever move down, into ones already vacated
+        for old, new in moved:
+            reminder = self.get(old)
+            self.delete(reminder)
+            reminder.serial = new
+            self.put(reminder)
+        self.reset_serial(len(serials))
+        return moved
+
+    def find_duplicate(self, reminder, exclude=None):
+        """Returns the serial of a stored reminder equal to the given one,
+        other than the one numbered `exclude`, or None. Stored reminders
+        without content or a due date match anything in that field, as in
+        Reminder.__eq__.
+        """
+        for item in self.iterate(reminder.category):
+            if item == reminder and item.serial != exclude:
+                return item.serial
+        return None
+
+    def find_field(self, target, field):
+        if field == 'category':
+            return self.iterate(target)
+        return (reminder for reminder in self.iterate()
+                if target == getattr(reminder, field))
+
+    def find_content(self, content, case_insensitive=False, due=None):
+        for reminder in self.iterate():
+            if (_content_matches(reminder, content, case_insensitive) and
+                    _due_in_range(reminder, due)):
+                yield reminder
+
+    def find_due(self, due):
+        """Yields the reminders due within a (low, high) range, see
+        `_due_range`
+        """
+        for reminder in self.iterate():
+            if _due_in_range(reminder, due):
+                yield reminder
+
+    def find_created(self, created):
+        """Yields the reminders added within a (low, high) range of dates"""
+        for reminder in self.iterate():
+            if _in_range(reminder.date, created):
+                yield reminder
+
+    def rebuild_indexes(self):
+        raise NotImplementedError
+
+    def verify_indexes(self):
+        raise NotImplementedError
+
+
+class _SortedIndex():
+    """An ordered set of (key, serial) entries kept in a shelve
+
+    Entries live in sorted leaves of at most INDEX_LEAF_SIZE entries, found
+    through a directory holding each leaf's lower bound. Inserts and removals
+    rewrite one leaf, and the directory only when a leaf splits or empties,
+    while range scans bisect straight to their first entry.
+    """
+    def __init__(self, db, name):
+        self._db = db
+        self.prefix = '{}{}:'.format(INTERNAL_PREFIX, name)
+        self._directory_key = self.prefix + 'directory'
+
+    def _leaf_key(self, leaf):
+        return '{}leaf:{}'.format(self.prefix, leaf)
+
+    def _directory(self):
+        return self._db.get(self._directory_key,
+                            {'bounds': [], 'leaves': [], 'next': 0})
+
+    def _new_leaf(self, directory, entries):
+        leaf = directory['next']
+        directory['next'] += 1
+        self._db[self._leaf_key(leaf)] = entries
+        return leaf
+
+    def insert(self, entry):
+        directory = self._directory()
+        bounds, leaves = directory['bounds'], directory['leaves']
+        if not leaves:
+            leaves.append(self._new_leaf(directory, [entry]))
+            bounds.append(entry)
+            self._db[self._directory_key] = directory
+            return
+
+        position = max(bisect_right(bounds, entry) - 1, 0)
+        leaf = self._db[self._leaf_key(leaves[position])]
+        insort(leaf, entry)
+
+        changed = entry < bounds[position]
+        if changed:
+            bounds[position] = entry
+        if len(leaf) > INDEX_LEAF_SIZE:
+            half = len(leaf) // 2
+            leaves.insert(position + 1,
+                          self._new_leaf(directory, leaf[half:]))
+            bounds.insert(position + 1, leaf[half])
+            leaf = leaf[:half]
+            changed = True
+
+        self._db[self._leaf_key(leaves[position])] = leaf
+        if changed:
+            self._db[self._directory_key] = directory
+
+    def remove(self, entry):
+        directory = self._directory()
+        bounds, leaves = directory['bounds'], directory['leaves']
+        position = bisect_right(bounds, entry) - 1
+        if position < 0:
+            return
+
+        key = self._leaf_key(leaves[position])
+        leaf = self._db[key]
+        index = bisect_left(leaf, entry)
+        if index == len(leaf) or leaf[index] != entry:
+            return
+
+        del leaf[index]
+        if leaf:
+            self._db[key] = leaf
+        else:
+            del self._db[key]
+            del bounds[position]
+            del leaves[position]
+            self._db[self._directory_key] = directory
+
+    def entries(self, low=None, high=None):
+        """Yields the entries whose key lies between low and high inclusive
+        A bound of None leaves that end of the range open.
+        """
+        directory = self._directory()
+        start = (low,) if low is not None else ()
+        position = max(bisect_right(directory['bounds'], start) - 1, 0)
+
+        for leaf in directory['leaves'][position:]:
+            leaf = self._db[self._leaf_key(leaf)]
+            for entry in leaf[bisect_left(leaf, start):]:
+                if high is not None and entry[0] > high:
+                    return
+                yield entry
+
+    def range(self, low=None, high=None):
+        """Yields the serials of entries between low and high inclusive"""
+        return (serial for key, serial in self.entries(low, high))
+
+    def rebuild(self, entries):
+        entries = sorted(entries)
+        directory = {'bounds': [], 'leaves': [], 'next': 0}
+        # Leave room in each leaf so inserts do not split them straight away
+        size = INDEX_LEAF_SIZE // 2
+        for start in range(0, len(entries), size):
+            leaf = entries[start:start + size]
+            directory['leaves'].append(self._new_leaf(directory, leaf))
+            directory['bounds'].append(leaf[0])
+        self._db[self._directory_key] = directory
+
+        # Leaves are numbered from 0 again, overwriting most of the old
+        # ones, so only a few are left to delete
+        kept = set(self._leaf_key(leaf) for leaf in directory['leaves'])
+        kept.add(self._directory_key)
+        for key in list(self._db.keys()):
+            if key.startswith(self.prefix) and key not in kept:
+                del self._db[key]
+
+    def verify(self, expected):
+        """Returns a list of problems found when comparing the index with the
+        entries it should hold
+        """
+        name = self.prefix.strip(INTERNAL_PREFIX + ':')
+        try:
+            stored = list(self.entries())
+        except KeyError:
+            return ["The {} index is missing a leaf".format(name)]
+
+        if stored != sorted(expected):
+            return ["The {} index is incorrect".format(name)]
+        return []
+
+
+class _CountedMapping():
+    """Counts the keys read, written and deleted through a dbm object, and
+    the bytes of their values, for a Profiler
+    """
+    def __init__(self, mapping, profiler):
+        self._mapping = mapping
+        self._profiler = profiler
+
+    def __getattr__(self, name):
+        return getattr(self._mapping, name)
+
+    def __getitem__(self, key):
+        value = self._mapping[key]
+        self._profiler.count('keys_read')
+        self._profiler.count('bytes_read', len(value))
+        return value
+
+    def __setitem__(self, key, value):
+        self._mapping[key] = value
+        self._profiler.count('keys_written')
+        self._profiler.count('bytes_written', len(value))
+
+    def __delitem__(self, key):
+        del self._mapping[key]
+        self._profiler.count('keys_deleted')
+
+    def __contains__(self, key):
+        return key in self._mapping
+
+    def __iter__(self):
+        return iter(self._mapping.keys())
+
+    def __len__(self):
+        return len(self._mapping)
+
+    def keys(self):
+        return self._mapping.keys()
+
+
+class ShelveBackend(Backend):
+    """Stores reminders in a shelve
+
+    Every reminder is stored under its own key, so writing one costs the same
+    however many reminders share its category. The remaining keys hold the
+    indexes: the categories in use, the serials belonging to each category
+    (split into chunks of MEMBER_CHUNK serials), a hash of (content,
+    category) mapping to the (serial, date_due) pairs used for duplicate
+    checks, the serials whose content contains each trigram, chunked the
+    same way, and sorted indexes of (due date, serial) and (date, serial).
+    Databases using an older layout are converted in place when opened.
+
+    Reminders bypass pickle and are written to the underlying dbm in the
+    format of Reminder.encode, which reads the same on any Python version.
+    Pickled reminders from older databases still load.
+    """
+    CONTENT_INDEX = True
+
+    def __init__(self, path):
+        import shelve
+        self._db = shelve.open(path)
+        self._records = self._db.dict
+        if _profiler is not None:
+            # Reminders are counted as they are loaded and stored
+            self._db.dict = _CountedMapping(self._records, _profiler)
+        self._due = _SortedIndex(self._db, 'due')
+        self._created = _SortedIndex(self._db, 'date')
+
+    def needs_upgrade(self):
+        return (self._db.get(LAYOUT_KEY) != LAYOUT_VERSION or
+                RENUMBER_KEY in self._db)
+
+    def upgrade(self):
+        if self._db.get(LAYOUT_KEY) != LAYOUT_VERSION:
+            self._upgrade()
+        if RENUMBER_KEY in self._db:
+            self._finish_renumber()
+
+    def close(self):
+        self._db.close()
+
+    def abandon(self):
+        # dbm.dumb writes its whole directory back on close once anything
+        # has been written, which would undo other processes' changes
+        if type(self._records).__module__ in ('dbm.dumb', 'dumbdbm'):
+            self._records._modified = False
+        self._db.close()
+
+    def commit(self):
+        self._db.sync()
+        if type(self._records).__module__ in ('dbm.dumb', 'dumbdbm'):
+            # The directory was just written, and would be again on close
+            self._records._modified = False
+
+    def last_serial(self):
+        return self._db.get('serial', 0)
+
+    def reset_serial(self, serial):
+        self._db['serial'] = serial
+
+    def categories(self):
+        return list(self._db.get(CATEGORIES_KEY, {}))
+
+    def iterate(self, category=None):
+        categories = [category] if category else self.categories()
+        chunks = self._db.get(CATEGORIES_KEY, {})
+        for category in categories:
+            for chunk in sorted(chunks.get(category, ())):
+                members = self._db[_member_key(category, chunk)]
+                for serial in sorted(members):
+                    yield self._load(serial)
+
+    def iterate_serials(self, start=0):
+        # Serials are merged from every category a chunk at a time
+        categories = {}
+        for category, chunks in self._db.get(CATEGORIES_KEY, {}).items():
+            for chunk in chunks:
+                categories.setdefault(chunk, []).append(category)
+
+        for chunk in sorted(categories):
+            if (chunk + 1) * MEMBER_CHUNK <= start:
+                continue
+            serials = set()
+            for category in categories[chunk]:
+                serials.update(self._db[_member_key(category, chunk)])
+            for serial in sorted(serials):
+                if serial > start:
+                    yield self._load(serial)
+
+    def get(self, serial):
+        try:
+            return self._load(serial)
+        except KeyError:
+            return None
+
+    def _load(self, serial):
+        data = self._records[_record_key(serial).encode('utf-8')]
+        if _profiler is not None:
+            _profiler.count('keys_read')
+            _profiler.count('bytes_read', len(data))
+        if data.startswith(RECORD_MAGIC):
+            return Reminder.decode(data)
+        import pickle
+        return pickle.loads(data)
+
+    def _store(self, reminder):
+        data = reminder.encode()
+        self._records[_record_key(reminder.serial).encode('utf-8')] = data
+        if _profiler is not None:
+            _profiler.count('keys_written')
+            _profiler.count('bytes_written', len(data))
+
+    def put(self, reminder):
+        self._store(reminder)
+        self._add_member(reminder.category, reminder.serial)
+        self._add_duplicate(reminder)
+        self._add_trigrams(reminder.serial, _trigrams(reminder.content))
+        if reminder.date_due:
+            self._due.insert((_to_ordinal(reminder.date_due),
+                              reminder.serial))
+        self._created.insert((_to_ordinal(reminder.date), reminder.serial))
+
+    def delete(self, reminder):
+        del self._db[_record_key(reminder.serial)]
+        self._remove_member(reminder.category, reminder.serial)
+        if reminder.date_due:
+            self._due.remove((_to_ordinal(reminder.date_due),
+                              reminder.serial))
+        self._created.remove((_to_ordinal(reminder.date), reminder.serial))
+        self._remove_trigrams(reminder.serial, _trigrams(reminder.content))
+        self._remove_duplicate(reminder)
+
+    def delete_many(self, reminders):
+        # The serials leaving each member chunk, duplicate bucket and
+        # trigram posting are gathered first, so that each of those keys is
+        # written once however many of the reminders it held
+        members, buckets, postings = {}, {}, {}
+        with _batched_deletes(self._records):
+            for reminder in reminders:
+                serial = reminder.serial
+                chunk = serial // MEMBER_CHUNK
+                del self._db[_record_key(serial)]
+                if reminder.date_due:
+                    self._due.remove((_to_ordinal(reminder.date_due), serial))
+                self._created.remove((_to_ordinal(reminder.date), serial))
+
+                members.setdefault((reminder.category, chunk),
+                                   set()).add(serial)
+                buckets.setdefault(_dedup_key(reminder.content,
+                                              reminder.category),
+                                   set()).add(serial)
+                for gram in _trigrams(reminder.content):
+                    postings.setdefault(_gram_key(gram, chunk),
+                                        set()).add(serial)
+
+            for key, serials in buckets.items():
+                bucket = [entry for entry in self._db.get(key, [])
+                          if entry[0] not in serials]
+                if bucket:
+                    self._db[key] = bucket
+                else:
+                    self._db.pop(key, None)
+
+            for key, serials in postings.items():
+                remaining = self._db.get(key, set()) - serials
+                if remaining:
+                    self._db[key] = remaining
+                else:
+                    self._db.pop(key, None)
+
+            chunks = self._db.get(CATEGORIES_KEY, {})
+            for (category, chunk), serials in members.items():
+                key = _member_key(category, chunk)
+                remaining = self._db.get(key, set()) - serials
+                if remaining:
+                    self._db[key] = remaining
+                    continue
+
+                self._db.pop(key, None)
+                chunks.get(category, set()).discard(chunk)
+                if not chunks.get(category):
+                    chunks.pop(category, None)
+            if members:
+                self._db[CATEGORIES_KEY] = chunks
+
+    def update(self, old, new):
+        # The record is overwritten, and only the indexes of the fields that
+        # changed are touched
+        self._store(new)
+        if new.category != old.category:
+            self._remove_member(old.category, old.serial)
+            self._add_member(new.category, new.serial)
+        if ((new.content, new.category, new.date_due) !=
+                (old.content, old.category, old.date_due)):
+            self._remove_duplicate(old)
+            self._add_duplicate(new)
+        if new.content != old.content:
+            before, after = _trigrams(old.content), _trigrams(new.content)
+            self._remove_trigrams(old.serial, before - after)
+            self._add_trigrams(new.serial, after - before)
+        if new.date_due != old.date_due:
+            if old.date_due:
+                self._due.remove((_to_ordinal(old.date_due), old.serial))
+            if new.date_due:
+                self._due.insert((_to_ordinal(new.date_due), new.serial))
+        if new.date != old.date:
+            self._created.remove((_to_ordinal(old.date), old.serial))
+            self._created.insert((_to_ordinal(new.date), new.serial))
+
+    def _add_duplicate(self, reminder):
+        key = _dedup_key(reminder.content, reminder.category)
+        bucket = self._db.get(key, [])
+        bucket.append((reminder.serial, reminder.date_due))
+        self._db[key] = bucket
+
+    def _remove_duplicate(self, reminder):
+        key = _dedup_key(reminder.content, reminder.category)
+        bucket = [entry for entry in self._db.get(key, [])
+                  if entry[0] != reminder.serial]
+        if bucket:
+            self._db[key] = bucket
+        else:
+            self._db.pop(key, None)
+
+    def _add_trigrams(self, serial, grams):
+        chunk = serial // MEMBER_CHUNK
+        for gram in grams:
+            key = _gram_key(gram, chunk)
+            postings = self._db.get(key, set())
+            postings.add(serial)
+            self._db[key] = postings
+
+    def _remove_trigrams(self, serial, grams):
+        chunk = serial // MEMBER_CHUNK
+        for gram in grams:
+            key = _gram_key(gram, chunk)
+            postings = self._db.get(key, set())
+            postings.discard(serial)
+            if postings:
+                self._db[key] = postings
+            else:
+                self._db.pop(key, None)
+
+    def find_duplicate(self, reminder, exclude=None):
+        for content in (reminder.content, None):
+            key = _dedup_key(content, reminder.category)
+            for serial, date_due in self._db.get(key, []):
+                if serial != exclude and (
+                        reminder.date_due is None or date_due is None or
+                        reminder.date_due == date_due):
+                    return serial
+        return None
+
+    def find_content(self, content, case_insensitive=False, due=None):
+        grams = sorted(_trigrams(content))[:MAX_QUERY_GRAMS]
+        if not grams:
+            candidates = self.find_due(due) if due else self.iterate()
+            for reminder in candidates:
+                if _content_matches(reminder, content, case_insensitive):
+                    yield reminder
+            return
+
+        chunks = set()
+        for category_chunks in self._db.get(CATEGORIES_KEY, {}).values():
+            chunks.update(category_chunks)
+
+        # Every match contains all of the query's trigrams, so only those
+        # candidates are loaded and checked against the actual query
+        for chunk in sorted(chunks):
+            candidates = None
+            for gram in grams:
+                postings = self._db.get(_gram_key(gram, chunk))
+                if not postings:
+                    break
+                candidates = (postings if candidates is None
+                              else candidates & postings)
+                if not candidates:
+                    break
+            else:
+                for serial in sorted(candidates):
+                    reminder = self._load(serial)
+                    if (_content_matches(reminder, content,
+                                         case_insensitive) and
+                            _due_in_range(reminder, due)):
+                        yield reminder
+
+    def find_due(self, due):
+        low, high = [_to_ordinal(bound) for bound in due]
+        for serial in self._due.range(low, high):
+            yield self._load(serial)
+
+    def find_created(self, created):
+        low, high = [_to_ordinal(bound) for bound in created]
+        for serial in self._created.range(low, high):
+            yield self._load(serial)
+
+    def renumber(self):
+        # Moving the records alone and indexing them again once is much
+        # quicker than updating every index for each reminder. The moved
+        # records are first copied under keys of their own, leaving the
+        # originals alone, and only once they all are is RENUMBER_KEY set
+        # to the moves. From then on, an interrupted renumbering is finished
+        # when the shelve is next opened, and before then it is undone.
+        serials = sorted(self._serials())
+        moved = [(old, new) for new, old in enumerate(serials, 1)
+                 if old != new]
+        self._db[RENUMBER_KEY] = None
+        self.commit()
+        for old, new in moved:
+            reminder = self._load(old)
+            reminder.serial = new
+            self._records[_staged_key(new).encode('utf-8')] = \
+                reminder.encode()
+
+        self._db[RENUMBER_KEY] = (len(serials), moved)
+        self.commit()
+        self._finish_renumber()
+        return moved
+
+    def _finish_renumber(self):
+        """Moves the records staged by `renumber` into place, or discards
+        them if they were not all staged. Each move can be made again, so
+        this can itself be interrupted and started over.
+        """
+        state = self._db[RENUMBER_KEY]
+        with _batched_deletes(self._records):
+            if state is None:
+                for key in list(self._db.keys()):
+                    if key.startswith(_staged_key('')):
+                        del self._db[key]
+            else:
+                count, moved = state
+                for old, new in moved:
+                    staged = _staged_key(new).encode('utf-8')
+                    data = self._records.get(staged)
+                    if data is None:
+                        continue
+                    self._records[_record_key(new).encode('utf-8')] = data
+                    # Serials up to the new count are overwritten by moves
+                    if old > count:
+                        try:
+                            del self._records[
+                                _record_key(old).encode('utf-8')]
+                        except KeyError:
+                            pass
+                    del self._records[staged]
+
+                self.reset_serial(count)
+                self.rebuild_indexes()
+            del self._db[RENUMBER_KEY]
+        self.commit()
+
+    def _serials(self):
+        prefix = _record_key('')
+        for key in self._db.keys():
+            if key.startswith(prefix):
+                yield int(key[len(prefix):])
+
+    def compact(self):
+        # Only some dbm modules, such as gdbm, can give space back
+        if hasattr(self._records, 'reorganize'):
+            self._records.reorganize()
+
+    def _add_member(self, category, serial):
+        chunk = serial // MEMBER_CHUNK
+        key = _member_key(category, chunk)
+        members = self._db.get(key, set())
+        members.add(serial)
+        self._db[key] = members
+
+        # The category directory only changes when a chunk appears
+        chunks = self._db.get(CATEGORIES_KEY, {})
+        if chunk not in chunks.get(category, ()):
+            chunks.setdefault(category, set()).add(chunk)
+            self._db[CATEGORIES_KEY] = chunks
+
+    def _remove_member(self, category, serial):
+        chunk = serial // MEMBER_CHUNK
+        key = _member_key(category, chunk)
+        members = self._db.get(key, set())
+        members.discard(serial)
+        if members:
+            self._db[key] = members
+            return
+
+        self._db.pop(key, None)
+        chunks = self._db.get(CATEGORIES_KEY, {})
+        chunks.get(category, set()).discard(chunk)
+        if not chunks.get(category):
+            chunks.pop(category, None)
+        self._db[CATEGORIES_KEY] = chunks
+
+    def _upgrade(self):
+        """Converts a database from an older layout
+        Databases holding one list of reminders per category have each
+        reminder written under its own key before its category list is
+        deleted, so an interrupted upgrade is simply resumed next time.
+        Pickled reminders are rewritten in the compact record format.
+        """
+        legacy = [key for key in self._db.keys()
+                  if key != 'serial' and not key.startswith(INTERNAL_PREFIX)]
+        for category in legacy:
+            for reminder in self._db[category]:
+                self._store(reminder)
+            del self._db[category]
+
+        for key in self._db.keys():
+            if key.startswith(_record_key('')):
+                data = self._records[key.encode('utf-8')]
+                if not data.startswith(RECORD_MAGIC):
+                    import pickle
+                    self._store(pickle.loads(data))
+
+        # Indexes kept alongside the category lists
+        for key in list(self._db.keys()):
+            if key.startswith((INTERNAL_PREFIX + 'serial:',
+                               INTERNAL_PREFIX + 'indexed')):
+                del self._db[key]
+
+        self._db[LAYOUT_KEY] = LAYOUT_VERSION
+        self.rebuild_indexes()
+
+    def _index_entries(self):
+        """Computes every index entry from the stored reminders
+        Returns the entries stored under their own keys, and the entries of
+        the due date and creation date indexes.
+        """
+        entries = {CATEGORIES_KEY: {}}
+        due, created = [], []
+        for key in self._db.keys():
+            if not key.startswith(_record_key('')):
+                continue
+
+            reminder = self._load(int(key.split(':', 1)[1]))
+            chunk = reminder.serial // MEMBER_CHUNK
+            entries[CATEGORIES_KEY].setdefault(reminder.category,
+                                               set()).add(chunk)
+            entries.setdefault(_member_key(reminder.category, chunk),
+                               set()).add(reminder.serial)
+            entries.setdefault(_dedup_key(reminder.content, reminder.category),
+                               []).append((reminder.serial,
+                                           reminder.date_due))
+            for gram in _trigrams(reminder.content):
+                entries.setdefault(_gram_key(gram, chunk),
+                                   set()).add(reminder.serial)
+            if reminder.date_due:
+                due.append((_to_ordinal(reminder.date_due), reminder.serial))
+            created.append((_to_ordinal(reminder.date), reminder.serial))
+        return entries, due, created
+
+    def rebuild_indexes(self):
+        entries, due, created = self._index_entries()
+        with _batched_deletes(self._records):
+            for key, value in entries.items():
+                self._db[key] = value
+            self._due.rebuild(due)
+            self._created.rebuild(created)
+
+            for key in list(self._db.keys()):
+                if _is_index_key(key) and key not in entries:
+                    del self._db[key]
+
+        return sum(len(members) for key, members in entries.items()
+                   if key.startswith(INTERNAL_PREFIX + 'members:'))
+
+    def verify_indexes(self):
+        expected, due, created = self._index_entries()
+        problems = self._due.verify(due) + self._created.verify(created)
+        for key, value in expected.items():
+            if key not in self._db:
+                problems.append("{} is not indexed".format(
+                    _describe_index_key(key)))
+                continue
+
+            stored = self._db[key]
+            if isinstance(value, list):
+                # Bucket order depends on the order reminders were added
+                stored, value = set(stored), set(value)
+            if stored != value:
+                problems.append("{} is indexed incorrectly".format(
+                    _describe_index_key(key)))
+
+        for key in self._db.keys():
+            if _is_index_key(key) and key not in expected:
+                problems.append("{} is indexed but does not exist".format(
+                    _describe_index_key(key)))
+
+        return problems
+
+
+class SqliteBackend(Backend):
+    """Stores reminders in an SQLite database
+
+    Reminders are rows of a single table with indexes on category, due date
+    and creation date; the serial is the primary key. Dates are stored as
+    ordinals. A second table maps the trigrams of each reminder's content to
+    its serial for content searches.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS reminders (
+            serial INTEGER PRIMARY KEY,
+            category TEXT NOT NULL,
+            content TEXT,
+            date INTEGER,
+            date_due INTEGER);
+        CREATE INDEX IF NOT EXISTS reminders_category
+            ON reminders (category, content);
+        CREATE INDEX IF NOT EXISTS reminders_date_due
+            ON reminders (date_due);
+        CREATE INDEX IF NOT EXISTS reminders_date ON reminders (date);
+        CREATE TABLE IF NOT EXISTS settings (
+            name TEXT PRIMARY KEY,
+            value);
+        CREATE TABLE IF NOT EXISTS trigrams (
+            gram TEXT,
+            serial INTEGER,
+            PRIMARY KEY (gram, serial)) WITHOUT ROWID;
+    """
+    # Bumped whenever a new index needs building for existing databases
+    SCHEMA_VERSION = 2
+    CONCURRENT = True
+    CONTENT_INDEX = True
+    COLUMNS = 'serial, category, content, date, date_due'
+
+    def __init__(self, path):
+        # `todo serve` uses the connection from several threads, one at a
+        # time
+        import sqlite3
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        # SQL's lower() only folds ASCII, so use Python's for -i searches
+        self._db.create_function('py_lower', 1,
+                                 lambda text: text and text.lower())
+        if bytes is str:
+            # Python 2, where text stays in UTF-8 byte strings, see
+            # _to_utf8, and is folded as the other backends fold it
+            self._db.text_factory = str
+            self._db.create_function(
+                'py_lower', 1, lambda text: text and _to_utf8(text).lower())
+
+    def needs_upgrade(self):
+        import sqlite3
+        try:
+            row = self._db.execute(
+                "SELECT value FROM settings WHERE name = 'schema'"
+            ).fetchone()
+        except sqlite3.OperationalError:
+            # A new database, without any tables yet
+            return True
+        return not row or row[0] < self.SCHEMA_VERSION
+
+    def upgrade(self):
+        self._db.executescript(self.SCHEMA)
+        if self.needs_upgrade():
+            self.rebuild_indexes()
+            self._db.execute("INSERT OR REPLACE INTO settings VALUES "
+                             "('schema', ?)", (self.SCHEMA_VERSION,))
+            self._db.commit()
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+
+    def commit(self):
+        self._db.commit()
+
+    def last_serial(self):
+        row = self._db.execute(
+            "SELECT value FROM settings WHERE name = 'serial'").fetchone()
+        return row[0] if row else 0
+
+    def reset_serial(self, serial):
+        self._db.execute(
+            "INSERT OR REPLACE INTO settings VALUES ('serial', ?)", (serial,))
+
+    def categories(self):
+        # In the order iterate lists them
+        return [row[0] for row in self._db.execute(
+            "SELECT DISTINCT category FROM reminders ORDER BY category")]
+
+    def _select(self, where='', parameters=(), order='category, serial'):
+        query = "SELECT {} FROM reminders {} ORDER BY {}".format(
+            self.COLUMNS, where, order)
+        for row in self._db.execute(query, parameters):
+            if _profiler is not None:
+                _profiler.count('keys_read')
+            yield _reminder_from_row(row)
+
+    def iterate(self, category=None):
+        if category:
+            return self._select("WHERE category = ?", (category,))
+        return self._select()
+
+    def iterate_serials(self, start=0):
+        return self._select("WHERE serial > ?", (start,), order='serial')
+
+    def get(self, serial):
+        return next(self._select("WHERE serial = ?", (serial,)), None)
+
+    def put(self, reminder):
+        self._db.execute(
+            "INSERT INTO reminders ({}) VALUES (?, ?, ?, ?, ?)".format(
+                self.COLUMNS), _reminder_to_row(reminder))
+        if _profiler is not None:
+            _profiler.count('keys_written')
+        self._db.executemany("INSERT INTO trigrams VALUES (?, ?)",
+                             ((gram, reminder.serial)
+                              for gram in _trigrams(reminder.content)))
+
+    def delete(self, reminder):
+        self._db.execute("DELETE FROM reminders WHERE serial = ?",
+                         (reminder.serial,))
+        self._db.execute("DELETE FROM trigrams WHERE serial = ?",
+                         (reminder.serial,))
+        if _profiler is not None:
+            _profiler.count('keys_deleted')
+
+    def delete_many(self, reminders):
+        serials = [(reminder.serial,) for reminder in reminders]
+        self._db.executemany("DELETE FROM reminders WHERE serial = ?",
+                             serials)
+        self._db.executemany("DELETE FROM trigrams WHERE serial = ?",
+                             serials)
+        if _profiler is not None:
+            _profiler.count('keys_deleted', len(serials))
+
+    def update(self, old, new):
+        row = _reminder_to_row(new)
+        self._db.execute(
+            """UPDATE reminders SET category = ?, content = ?, date = ?,
+               date_due = ? WHERE serial = ?""", row[1:] + row[:1])
+        if _profiler is not None:
+            _profiler.count('keys_written')
+        if new.content != old.content:
+            before, after = _trigrams(old.content), _trigrams(new.content)
+            self._db.executemany(
+                "DELETE FROM trigrams WHERE gram = ? AND serial = ?",
+                ((gram, old.serial) for gram in before - after))
+            self._db.executemany("INSERT INTO trigrams VALUES (?, ?)",
+                                 ((gram, new.serial)
+                                  for gram in after - before))
+
+    def find_duplicate(self, reminder, exclude=None):
+        due = _to_ordinal(reminder.date_due)
+        row = self._db.execute(
+            """SELECT serial FROM reminders
+               WHERE category = ? AND (content = ? OR content IS NULL)
+               AND (? IS NULL OR date_due IS NULL OR date_due = ?)
+               AND serial IS NOT ?
+               LIMIT 1""",
+            (reminder.category, reminder.content, due, due,
+             exclude)).fetchone()
+        return row[0] if row else None
+
+    def find_field(self, target, field):
+        if field not in ('category', 'content', 'date', 'date_due'):
+            return Backend.find_field(self, target, field)
+
+        if field in ('date', 'date_due'):
+            target = _to_ordinal(target)
+        return self._select("WHERE {} = ?".format(field), (target,))
+
+    def find_content(self, content, case_insensitive=False, due=None):
+        if case_insensitive:
+            where = "WHERE instr(py_lower(content), ?) > 0"
+            parameters = [content.lower()]
+        else:
+            where = "WHERE instr(content, ?) > 0"
+            parameters = [content]
+
+        grams = sorted(_trigrams(content))[:MAX_QUERY_GRAMS]
+        if grams:
+            where += """ AND serial IN (
+                SELECT serial FROM trigrams WHERE gram IN ({})
+                GROUP BY serial HAVING COUNT(*) = ?)""".format(
+                ', '.join('?' * len(grams)))
+            parameters.extend(grams)
+            parameters.append(len(grams))
+
+        if due is not None:
+            where += " AND " + self._range_clause('date_due', due,
+                                                  parameters)
+
+        return self._select(where, parameters)
+
+    def find_due(self, due):
+        parameters = []
+        where = "WHERE " + self._range_clause('date_due', due, parameters)
+        return self._select(where, parameters, order='date_due, serial')
+
+    def find_created(self, created):
+        parameters = []
+        where = "WHERE " + self._range_clause('date', created, parameters)
+        return self._select(where, parameters, order='date, serial')
+
+    @staticmethod
+    def _range_clause(column, bounds, parameters):
+        """SQL condition for a (low, high) range of dates in a column, adding
+        its parameters
+        """
+        clause = "{} IS NOT NULL".format(column)
+        for operator, bound in zip(('>=', '<='), bounds):
+            if bound is not None:
+                clause += " AND {} {} ?".format(column, operator)
+                parameters.append(bound.toordinal())
+        return clause
+
+    def renumber(self):
+        serials = [row[0] for row in self._db.execute(
+            "SELECT serial FROM reminders ORDER BY serial")]
+        moved = [(old, new) for new, old in enumerate(serials, 1)
+                 if old != new]
+
+        self._db.execute("CREATE TEMP TABLE renumbered "
+                         "(old INTEGER PRIMARY KEY, new INTEGER)")
+        self._db.executemany("INSERT INTO renumbered VALUES (?, ?)", moved)
+        # Serials pass through negative values, so that no reminder takes a
+        # serial another still has
+        self._db.execute(
+            """UPDATE reminders SET serial = -(SELECT new FROM renumbered
+                                               WHERE old = serial)
+               WHERE serial IN (SELECT old FROM renumbered)""")
+        self._db.execute("UPDATE reminders SET serial = -serial "
+                         "WHERE serial < 0")
+        # Trigram rows are keyed by gram, so rather than move them one by
+        # one, those that change are written out again in key order
+        self._db.execute(
+            """CREATE TEMP TABLE renumbered_grams AS
+               SELECT gram, new AS serial FROM trigrams
+               JOIN renumbered ON serial = old""")
+        self._db.execute("DELETE FROM trigrams "
+                         "WHERE serial IN (SELECT old FROM renumbered)")
+        self._db.execute("INSERT INTO trigrams SELECT gram, serial "
+                         "FROM renumbered_grams ORDER BY gram, serial")
+        self._db.execute("DROP TABLE renumbered_grams")
+        self._db.execute("DROP TABLE renumbered")
+
+        self.reset_serial(len(serials))
+        return moved
+
+    def compact(self):
+        self._db.commit()
+        self._db.execute("VACUUM")
+
+    def rebuild_indexes(self):
+        self._db.execute("DELETE FROM trigrams")
+        for serial, content in self._db.execute(
+                "SELECT serial, content FROM reminders").fetchall():
+            self._db.executemany("INSERT INTO trigrams VALUES (?, ?)",
+                                 ((gram, serial)
+                                  for gram in _trigrams(content)))
+        self._db.execute("REINDEX")
+        return self._db.execute("SELECT COUNT(*) FROM reminders").fetchone()[0]
+
+    def verify_indexes(self):
+        problems = [row[0] for row in self._db.execute(
+            "PRAGMA integrity_check") if row[0] != 'ok']
+
+        indexed = {}
+        for gram, serial in self._db.execute("SELECT * FROM trigrams"):
+            indexed.setdefault(serial, set()).add(gram)
+        for serial, content in self._db.execute(
+                "SELECT serial, content FROM reminders"):
+            if indexed.pop(serial, set()) != _trigrams(content):
+                problems.append("Trigrams of #{} are indexed "
+                                "incorrectly".format(serial))
+        for serial in indexed:
+            problems.append("#{} is indexed but does not exist".format(
+                serial))
+
+        return problems
+
+
+class JournalBackend(Backend):
+    """Keeps reminders in memory, backed by a snapshot and an append-only log
+
+    Every change is appended to the log, so writes are sequential however
+    large the database is. Opening loads the snapshot and replays the log on
+    top of it. An entry left half written by a crash fails its checksum and
+    is cut off along with anything after it, so the database reopens as it
+    was after the last complete change. `compact` writes a new snapshot and
+    empties the log, and happens on close once the log outgrows the
+    snapshot.
+
+    `commit` hands new entries to the operating system straight away, which
+    survives the process crashing, but only asks for them to reach the disk
+    every JOURNAL_SYNC_ENTRIES entries or JOURNAL_SYNC_SECONDS seconds, and
+    on close.
+    """
+    PUT, DELETE, SERIAL = 1, 2, 3
+
+    def __init__(self, path):
+        self.path = path
+        self._log_path = path + JOURNAL_LOG_SUFFIX
+        self._records = {}
+        self._categories = {}
+        self._duplicates = {}
+        self._due, self._created = [], []
+        self._serial = 0
+
+        if os.path.exists(path):
+            with open(path, 'rb') as snapshot:
+                if snapshot.read(len(JOURNAL_MAGIC)) != JOURNAL_MAGIC:
+                    raise InvalidRecordException(
+                        "'{}' is not a journal snapshot".format(path))
+                end = self._replay(snapshot)
+                if snapshot.read(1):
+                    raise InvalidRecordException(
+                        "Snapshot '{}' is damaged at byte {}".format(
+                            path, end))
+
+        self._log = open(self._log_path, 'ab+')
+        self._log.seek(0)
+        end = self._replay(self._log)
+        self._log.seek(end)
+        # Where an entry left torn by a crash starts, cut off by `upgrade`
+        self._torn_at = (
+            None if end == os.fstat(self._log.fileno()).st_size else end)
+
+        self._unsynced = 0
+        self._synced_at = time.time()
+
+    def needs_upgrade(self):
+        return self._torn_at is not None
+
+    def upgrade(self):
+        if self._torn_at is not None:
+            self._log.truncate(self._torn_at)
+            self._log.seek(self._torn_at)
+            self._torn_at = None
+
+    def _replay(self, stream):
+        """Applies the entries read from a stream, stopping at the end or at
+        the first incomplete entry. Returns the offset reached.
+        """
+        offset = stream.tell()
+        while True:
+            header = stream.read(JOURNAL_ENTRY.size)
+            if len(header) < JOURNAL_ENTRY.size:
+                return offset
+
+            operation, length, checksum = JOURNAL_ENTRY.unpack(header)
+            payload = stream.read(length)
+            if (len(payload) < length or
+                    zlib.crc32(payload) & 0xffffffff != checksum):
+                return offset
+            if _profiler is not None:
+                _profiler.count('keys_read')
+                _profiler.count('bytes_read', JOURNAL_ENTRY.size + length)
+
+            if operation == self.PUT:
+                self._apply_put(payload)
+            elif operation == self.DELETE:
+                self._apply_delete(JOURNAL_SERIAL.unpack(payload)[0])
+            elif operation == self.SERIAL:
+                self._serial = JOURNAL_SERIAL.unpack(payload)[0]
+            offset += JOURNAL_ENTRY.size + length
+
+    def _write(self, stream, operation, payload):
+        stream.write(JOURNAL_ENTRY.pack(operation, len(payload),
+                                        zlib.crc32(payload) & 0xffffffff))
+        stream.write(payload)
+        self._unsynced += 1
+        if _profiler is not None:
+            _profiler.count('keys_written')
+            _profiler.count('bytes_written', JOURNAL_ENTRY.size + len(payload))
+
+    def _apply_put(self, data):
+        reminder = Reminder.decode(data)
+        # Replaying a log over the snapshot it was compacted into puts the
+        # same reminders again
+        if reminder.serial in self._records:
+            self._apply_delete(reminder.serial)
+
+        self._records[reminder.serial] = data
+        self._categories.setdefault(reminder.category,
+                                    set()).add(reminder.serial)
+        self._duplicates.setdefault((reminder.content, reminder.category),
+                                    {})[reminder.serial] = reminder.date_due
+        if reminder.date_due:
+            insort(self._due, (reminder.date_due.toordinal(),
+                               reminder.serial))
+        if reminder.date:
+            insort(self._created, (reminder.date.toordinal(),
+                                   reminder.serial))
+
+    def _apply_delete(self, serial):
+        data = self._records.pop(serial, None)
+        if data is None:
+            return
+
+        reminder = Reminder.decode(data)
+        members = self._categories[reminder.category]
+        members.discard(serial)
+        if not members:
+            del self._categories[reminder.category]
+
+        key = (reminder.content, reminder.category)
+        del self._duplicates[key][serial]
+        if not self._duplicates[key]:
+            del self._duplicates[key]
+
+        for index, date in ((self._due, reminder.date_due),
+                            (self._created, reminder.date)):
+            if date:
+                del index[bisect_left(index, (date.toordinal(), serial))]
+
+    def abandon(self):
+        self._log.close()
+
+    def close(self):
+        self._log.flush()
+        os.fsync(self._log.fileno())
+        size = self._log.tell()
+        self._log.close()
+
+        snapshot = os.path.getsize(self.path) if os.path.exists(
+            self.path) else 0
+        if size > max(snapshot, JOURNAL_COMPACT_SIZE):
+            self.compact()
+
+    def commit(self):
+        self._log.flush()
+        if (self._unsynced >= JOURNAL_SYNC_ENTRIES or
+                time.time() - self._synced_at >= JOURNAL_SYNC_SECONDS):
+            os.fsync(self._log.fileno())
+            self._unsynced = 0
+            self._synced_at = time.time()
+
+    def compact(self):
+        """Writes every reminder to a new snapshot and empties the log
+        The snapshot replaces the old one in a single rename, and replaying
+        the log again over it changes nothing, so a crash at any point
+        leaves the database intact.
+        """
+        temporary = self.path + '.tmp'
+        with open(temporary, 'wb') as snapshot:
+            snapshot.write(JOURNAL_MAGIC)
+            for serial in sorted(self._records):
+                self._write(snapshot, self.PUT, self._records[serial])
+            self._write(snapshot, self.SERIAL,
+                        JOURNAL_SERIAL.pack(self._serial))
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.rename(temporary, self.path)
+
+        closed = self._log.closed
+        if not closed:
+            self._log.close()
+        self._log = open(self._log_path, 'wb+')
+        self._unsynced = 0
+        if closed:
+            self._log.close()
+
+    def last_serial(self):
+        return self._serial
+
+    def reset_serial(self, serial):
+        self._write(self._log, self.SERIAL, JOURNAL_SERIAL.pack(serial))
+        self._serial = serial
+
+    def categories(self):
+        return list(self._categories)
+
+    def iterate(self, category=None):
+        categories = [category] if category else self.categories()
+        for category in categories:
+            for serial in sorted(self._categories.get(category, ())):
+                yield Reminder.decode(self._records[serial])
+
+    def iterate_serials(self, start=0):
+        for serial in sorted(self._records):
+            if serial > start:
+                yield Reminder.decode(self._records[serial])
+
+    def get(self, serial):
+        data = self._records.get(serial)
+        return Reminder.decode(data) if data is not None else None
+
+    def put(self, reminder):
+        data = reminder.encode()
+        self._write(self._log, self.PUT, data)
+        self._apply_put(data)
+
+    def delete(self, reminder):
+        self._write(self._log, self.DELETE,
+                    JOURNAL_SERIAL.pack(reminder.serial))
+        self._apply_delete(reminder.serial)
+
+    def update(self, old, new):
+        # Putting a stored serial again replaces it, in a single entry
+        self.put(new)
+
+    def find_duplicate(self, reminder, exclude=None):
+        for content in (reminder.content, None):
+            entries = self._duplicates.get((content, reminder.category), {})
+            for serial, date_due in entries.items():
+                if serial != exclude and (
+                        reminder.date_due is None or date_due is None or
+                        reminder.date_due == date_due):
+                    return serial
+        return None
+
+    def find_content(self, content, case_insensitive=False, due=None):
+        # Records hold their content as UTF-8, so records without the
+        # query's bytes are skipped without decoding them
+        needle = None if case_insensitive else _to_utf8(content)
+        for category in self.categories():
+            for serial in sorted(self._categories[category]):
+                data = self._records[serial]
+                if needle is not None and needle not in data:
+                    continue
+
+                reminder = Reminder.decode(data)
+                if (_content_matches(reminder, content, case_insensitive) and
+                        _due_in_range(reminder, due)):
+                    yield reminder
+
+    def _range(self, index, bounds):
+        low, high = [_to_ordinal(bound) for bound in bounds]
+        start = bisect_left(index, (low,)) if low is not None else 0
+        for ordinal, serial in index[start:]:
+            if high is not None and ordinal > high:
+                return
+            yield Reminder.decode(self._records[serial])
+
+    def find_due(self, due):
+        return self._range(self._due, due)
+
+    def find_created(self, created):
+        return self._range(self._created, created)
+
+    def renumber(self):
+        # Written as a new snapshot, which replaces the old one at once
+        records = self._records
+        self._records = {}
+        moved = []
+        for new, old in enumerate(sorted(records), 1):
+            data = records[old]
+            if old != new:
+                reminder = Reminder.decode(data)
+                reminder.serial = new
+                data = reminder.encode()
+                moved.append((old, new))
+            self._records[new] = data
+
+        self._serial = len(self._records)
+        self.rebuild_indexes()
+        self.compact()
+        return moved
+
+    def rebuild_indexes(self):
+        records = self._records
+        self._records, self._categories, self._duplicates = {}, {}, {}
+        self._due, self._created = [], []
+        for serial in sorted(records):
+            self._apply_put(records[serial])
+        return len(self._records)
+
+    def verify_indexes(self):
+        # The indexes only live in memory, built from the records on open
+        return []
+
+
+class SnapshotBackend(Backend):
+    """Reads reminders from a memory-mapped snapshot of another backend
+
+    Reminders are stored one after another, grouped by category, and found
+    through tables of their offsets, of their serials in order, and of their
+    due and creation dates in order.
+    Only the reminders returned are decoded, and processes reading the same
+    snapshot share its pages. A snapshot cannot be written to, and is taken
+    anew with `write`.
+    """
+    # Tables after the category names: a name of each table, its typecode,
+    # and the header field giving its length, offsets having one more entry
+    # than there are reminders
+    TABLES = (('ranges', 'I', 'categories'), ('serials', 'q', 'count'),
+              ('positions', 'I', 'count'), ('offsets', 'Q', 'count'),
+              ('due', 'i', 'due_count'), ('due_positions', 'I', 'due_count'),
+              ('created', 'i', 'created_count'),
+              ('created_positions', 'I', 'created_count'))
+
+    def __init__(self, path):
+        import mmap
+        with open(path, 'rb') as stream:
+            self._map = mmap.mmap(stream.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        try:
+            self._load()
+        except Exception:
+            self.close()
+            raise
+
+    def _load(self):
+        (magic, version, byteorder, self.generation, mtime, size,
+         self._last_serial, count, due_count, created_count,
+         length) = SNAPSHOT_HEADER.unpack_from(self._map)
+        self.stamp = (mtime, size)
+        if (magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION or
+                byteorder != sys.byteorder[0].encode('ascii')):
+            raise InvalidRecordException("Unsupported snapshot")
+
+        offset = SNAPSHOT_HEADER.size
+        names = self._map[offset:offset + length].decode('utf-8')
+        self._categories = names.split('\0') if names else []
+        offset = _align(offset + length)
+
+        lengths = {'categories': 2 * len(self._categories),
+                   'count': count, 'due_count': due_count,
+                   'created_count': created_count}
+        view = memoryview(self._map)
+        self._views = []
+        for name, code, field in self.TABLES:
+            size = lengths[field] + (name == 'offsets')
+            end = offset + size * struct.calcsize(code)
+            table = view[offset:end].cast(code)
+            self._views.append(table)
+            setattr(self, '_' + name, table)
+            offset = _align(end)
+        self._records = offset
+        self._views.append(view)
+
+    @classmethod
+    def open(cls, path, generation, stamp):
+        """Maps the snapshot at `path` if it was taken at the given lock
+        generation and database stamp, see `_database_stamp`, or returns
+        None
+        """
+        try:
+            snapshot = cls(path)
+        except (IOError, OSError, ValueError, struct.error,
+                InvalidRecordException):
+            return None
+        if snapshot.generation != generation or snapshot.stamp != stamp:
+            snapshot.close()
+            return None
+        return snapshot
+
+    @staticmethod
+    def write(path, backend, generation, stamp):
+        """Takes a snapshot of every reminder in a backend, replacing the
+        one at `path` in a single rename
+        """
+        import array
+        import shutil
+        serials, offsets = array.array('q'), array.array('Q', [0])
+        due, created, categories = [], [], []
+        temporary = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temporary + '-records', 'w+b') as records:
+            for category in backend.categories():
+                categories.append([category, len(serials), 0])
+                for reminder in backend.iterate(category):
+                    position = len(serials)
+                    categories[-1][2] += 1
+                    records.write(reminder.encode())
+                    offsets.append(records.tell())
+                    serials.append(reminder.serial)
+                    if reminder.date_due:
+                        due.append((reminder.date_due.toordinal(),
+                                    reminder.serial, position))
+                    if reminder.date:
+                        created.append((reminder.date.toordinal(),
+                                        reminder.serial, position))
+
+            order = sorted(range(len(serials)), key=serials.__getitem__)
+            due.sort()
+            created.sort()
+            names = '\0'.join(name for name, start, count in
+                              categories).encode('utf-8')
+            tables = [
+                array.array('I', [value for name, start, count in categories
+                                  for value in (start, count)]),
+                array.array('q', [serials[index] for index in order]),
+                array.array('I', order), offsets,
+                array.array('i', [entry[0] for entry in due]),
+                array.array('I', [entry[2] for entry in due]),
+                array.array('i', [entry[0] for entry in created]),
+                array.array('I', [entry[2] for entry in created])]
+
+            with open(temporary, 'wb') as stream:
+                stream.write(SNAPSHOT_HEADER.pack(
+                    SNAPSHOT_MAGIC, SNAPSHOT_VERSION,
+                    sys.byteorder[0].encode('ascii'), generation or 0,
+                    stamp[0], stamp[1], backend.last_serial(), len(serials),
+                    len(due), len(created), len(names)))
+                stream.write(names)
+                for table in tables:
+                    stream.write(b'\0' * (_align(stream.tell()) -
+                                          stream.tell()))
+                    stream.write(table.tobytes())
+                stream.write(b'\0' * (_align(stream.tell()) - stream.tell()))
+                records.seek(0)
+                shutil.copyfileobj(records, stream)
+        os.remove(temporary + '-records')
+        os.rename(temporary, path)
+
+    def close(self):
+        # The map cannot close while tables still point into it
+        for view in self._views if hasattr(self, '_views') else ():
+            view.release()
+        self._views = []
+        self._map.close()
+
+    def last_serial(self):
+        return self._last_serial
+
+    def categories(self):
+        return list(self._categories)
+
+    def _record(self, position):
+        start = self._records + self._offsets[position]
+        end = self._records + self._offsets[position + 1]
+        if _profiler is not None:
+            _profiler.count('keys_read')
+            _profiler.count('bytes_read', end - start)
+        return self._map[start:end]
+
+    def _reminder(self, position):
+        return Reminder.decode(self._record(position))
+
+    def iterate(self, category=None):
+        if category is None:
+            positions = range(len(self._serials))
+        elif category in self._categories:
+            index = 2 * self._categories.index(category)
+            start, count = self._ranges[index], self._ranges[index + 1]
+            positions = range(start, start + count)
+        else:
+            positions = ()
+        for position in positions:
+            yield self._reminder(position)
+
+    def iterate_serials(self, start=0):
+        for index in range(bisect_right(self._serials, start),
+                           len(self._serials)):
+            yield self._reminder(self._positions[index])
+
+    def get(self, serial):
+        index = bisect_left(self._serials, serial)
+        if index == len(self._serials) or self._serials[index] != serial:
+            return None
+        return self._reminder(self._positions[index])
+
+    def find_content(self, content, case_insensitive=False, due=None):
+        # As in JournalBackend, records without the query's bytes are
+        # skipped without decoding them
+        needle = None if case_insensitive else _to_utf8(content)
+        for position in range(len(self._serials)):
+            data = self._record(position)
+            if needle is not None and needle not in data:
+                continue
+
+            reminder = Reminder.decode(data)
+            if (_content_matches(reminder, content, case_insensitive) and
+                    _due_in_range(reminder, due)):
+                yield reminder
+
+    def _range(self, keys, positions, bounds):
+        low, high = [_to_ordinal(bound) for bound in bounds]
+        start = bisect_left(keys, low) if low is not None else 0
+        end = bisect_right(keys, high) if high is not None else len(keys)
+        for index in range(start, end):
+            yield self._reminder(positions[index])
+
+    def find_due(self, due):
+        return self._range(self._due, self._due_positions, due)
+
+    def find_created(self, created):
+        return self._range(self._created, self._created_positions, created)
+
+    def verify_indexes(self):
+        return []
+
+
+class _ProfiledBackend():
+    """Times the calls made to a backend for a Profiler
+
+    Each call counts towards its phase in BACKEND_PHASES. Iterators are
+    timed a step at a time, so the time their caller spends on each reminder
+    is left to the caller's phase.
+    """
+    def __init__(self, backend, profiler):
+        self._backend = backend
+        self._profiler = profiler
+
+    def __getattr__(self, name):
+        value = getattr(self._backend, name)
+        if not callable(value):
+            return value
+
+        profiler = self._profiler
+        phase = BACKEND_PHASES.get(name, 'read')
+
+        def call(*args, **kwargs):
+            with profiler.phase(phase):
+                result = value(*args, **kwargs)
+            if hasattr(result, '__next__') or hasattr(result, 'next'):
+                return self._steps(result, phase)
+            return result
+        return call
+
+    def _steps(self, iterator, phase):
+        while True:
+            with self._profiler.phase(phase):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+
+class _StaleSnapshot():
+    """Stands in for a read-only store's snapshot while it is missing or
+    out of date, as after a write by an older todo
+
+    Reads answered through an index go to the database's backend, so the
+    command does not wait for the whole database to be copied first. The
+    first read of every reminder costs about as much as taking the
+    snapshot, so it takes it, and the snapshot answers from then on.
+    Otherwise the store takes it on close, once the command is done.
+    """
+    def __init__(self, backend, take):
+        self._backend = backend
+        self._take = take
+
+    def __getattr__(self, name):
+        return getattr(self._backend, name)
+
+    def take(self):
+        """Takes the snapshot, unless it already has been"""
+        if self._take is not None:
+            self._backend, self._take = self._take(self._backend), None
+
+    def iterate(self, category=None):
+        if category is None:
+            self.take()
+        return self._backend.iterate(category)
+
+
+# Backends by URI scheme, and the file extensions that select them
+BACKENDS = {'shelve': ShelveBackend, 'sqlite': SqliteBackend,
+            'journal': JournalBackend}
+BACKEND_EXTENSIONS = {'.sqlite': 'sqlite', '.sqlite3': 'sqlite',
+                      '.journal': 'journal',
+                      '.db': 'sqlite'}
+SQLITE_HEADER = b'SQLite format 3\0'
+
+
+def open_backend(location, upgrade=True):
+    """Opens the storage backend for a database location
+
+    A location may name its backend with a URI scheme, as in
+    'sqlite:///path/to/todo.sqlite' or 'shelve://todo.shelve'. Otherwise an
+    existing file is recognised by its contents, and a new one by its
+    extension, with shelve as the default.
+
+    The database is brought up to date unless `upgrade` is false, which
+    leaves it to the caller to check `needs_upgrade` and call `upgrade`
+    under the exclusive lock.
+    """
+    name, path = _split_location(location)
+    backend = BACKENDS[name](path)
+    if upgrade and backend.needs_upgrade():
+        backend.upgrade()
+        backend.commit()
+    return backend
+
+
+def _align(offset, boundary=8):
+    return -(-offset // boundary) * boundary
+
+
+def _split_location(location):
+    """Returns the backend name and path of a database location"""
+    scheme, sep, path = location.partition('://')
+    if sep and scheme in BACKENDS:
+        return scheme, path
+
+    if os.path.isfile(location):
+        with open(location, 'rb') as stream:
+            header = stream.read(max(len(SQLITE_HEADER), len(JOURNAL_MAGIC)))
+            if header.startswith(SQLITE_HEADER):
+                return 'sqlite', location
+            elif header.startswith(JOURNAL_MAGIC):
+                return 'journal', location
+            return 'shelve', location
+
+    # Shelves whose dbm module adds its own extensions, such as an older
+    # todo.db kept by dbm.dumb as todo.db.dat and todo.db.dir
+    if whichdb(location):
+        return 'shelve', location
+
+    extension = os.path.splitext(location)[1].lower()
+    return BACKEND_EXTENSIONS.get(extension, 'shelve'), location
+
+
+def _database_stamp(location):
+    """The latest modification time, in nanoseconds, and the total size of
+    the files a database is kept in, which change with any write to it
+    """
+    path = _split_location(location)[1]
+    mtime = size = 0
+    for suffix in DATABASE_SUFFIXES:
+        try:
+            info = os.stat(path + suffix)
+        except OSError:
+            continue
+        mtime = max(mtime, getattr(info, 'st_mtime_ns',
+                                   int(info.st_mtime * 1e9)))
+        size += info.st_size
+    return mtime, size
+
+
+def _database_exists(location):
+    name, path = _split_location(location)
+    if name == 'shelve':
+        # Some dbm modules add their own extensions to the file name
+        return os.path.exists(path) or bool(whichdb(path))
+    elif name == 'journal':
+        return (os.path.exists(path) or
+                os.path.exists(path + JOURNAL_LOG_SUFFIX))
+    return os.path.exists(path)
+
+
+def convert_database(source, destination):
+    """Copies every reminder from one database to another, which may use a
+    different backend. Returns the number of reminders copied.
+    """
+    if not _database_exists(source):
+        raise DatabaseDoesNotExistException(
+            "Database at '{}' does not exist".format(source))
+
+    with TodoStore(source) as old, TodoStore(destination) as new, \
+            old.transaction(), new.transaction(exclusive=True):
+        if next(iter(new), None) is not None:
+            raise DatabaseNotEmptyException(
+                "Database at '{}' already holds reminders".format(
+                    destination))
+
+        count = 0
+        for reminder in old:
+            new.backend.put(reminder)
+            count += 1
+
+        new.backend.reset_serial(old.backend.last_serial())
+        new.backend.commit()
+
+    return count
+
+
+# Daemon
+class RemoteStore():
+    """Stands in for a TodoStore held open by `todo serve`
+
+    Calls are sent over the server's Unix socket and answered from the
+    store it keeps open. Reminders and dates travel as JSON, and exceptions
+    raised by the store are raised again here.
+    """
+    def __init__(self, connection):
+        self._connection = connection
+        self._stream = connection.makefile('rb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self):
+        return self.iterate()
+
+    def close(self):
+        self._stream.close()
+        self._connection.close()
+
+    def _call(self, name, *args, **kwargs):
+        request = {'call': name, 'args': args}
+        if kwargs:
+            request['kwargs'] = kwargs
+        _send_message(self._connection, request)
+        response = _receive_message(self._stream)
+        if response is None:
+            raise ServerErrorException("The server closed the connection")
+        elif 'error' in response:
+            exception = globals().get(response['error'])
+            if not (isinstance(exception, type) and
+                    issubclass(exception, Exception)):
+                raise ServerErrorException("{}: {}".format(
+                    response['error'], response['message']))
+            raise exception(response['message'])
+        return response['result']
+
+    def categories(self):
+        return self._call('categories')
+
+    def iterate(self, category=None):
+        return iter(self._call('iterate', category))
+
+    def iterate_serials(self, start=0):
+        return iter(self._call('iterate_serials', start))
+
+    def iterate_due(self, start=None):
+        return iter(self._call('iterate_due', start))
+
+    def get(self, serial):
+        return self._call('get', serial)
+
+    def append(self, reminder):
+        reminder.serial = self._call('append', reminder)
+
+    def add_many(self, reminders, batch_size=IMPORT_BATCH_SIZE,
+                 keep_serials=False):
+        added = skipped = 0
+        batch = []
+        for reminder in itertools.chain(reminders, [None]):
+            if reminder is not None:
+                batch.append(reminder)
+            if len(batch) == batch_size or (reminder is None and batch):
+                counts = self._call('add_many', batch, batch_size,
+                                    keep_serials)
+                added, skipped = added + counts[0], skipped + counts[1]
+                batch = []
+        return added, skipped
+
+    def discard(self, reminder):
+        self._call('discard', reminder)
+
+    def exists(self, reminder):
+        return self._call('exists', reminder)
+
+    def update(self, serial, **fields):
+        return self._call('update', serial, **fields)
+
+    def add(self, reminder):
+        reminder.serial = self._call('add', reminder)
+
+    def remove(self, reminder):
+        self._call('remove', reminder)
+
+    def remove_matching(self, query):
+        return self._call('remove_matching', query)
+
+    def remove_many(self, serials):
+        return self._call('remove_many', list(serials))
+
+    def transaction(self, exclusive=False):
+        """The server makes each call in a transaction of its own, so this
+        only lets code written for a TodoStore run unchanged
+        """
+        return _nullcontext(self)
+
+    def search(self, target, field):
+        return self._call('search', target, field)
+
+    def search_content(self, content, case_insensitive=False, due=None):
+        return self._call('search_content', content, case_insensitive, due)
+
+    def search_due(self, due):
+        return self._call('search_due', due)
+
+    def search_created(self, created):
+        return self._call('search_created', created)
+
+    def query(self, query):
+        return iter(self._call('query', query))
+
+    def compact(self):
+        self._call('compact')
+
+    def renumber(self):
+        return [tuple(pair) for pair in self._call('renumber')]
+
+    def rebuild_indexes(self):
+        return self._call('rebuild_indexes')
+
+    def verify_indexes(self):
+        return self._call('verify_indexes')
+
+
+class _RequestHandler():
+    """Answers the calls of one RemoteStore, one at a time"""
+    def __init__(self, connection, address, server):
+        self.connection = connection
+        self.server = server.todo
+        self.rfile = connection.makefile('rb')
+        try:
+            self.handle()
+        finally:
+            self.rfile.close()
+
+    def handle(self):
+        while True:
+            request = _receive_message(self.rfile)
+            if request is None:
+                return
+
+            name, args = request['call'], request['args']
+            kwargs = request.get('kwargs', {})
+            try:
+                if name not in SERVED_CALLS:
+                    raise ServerErrorException(
+                        "Unknown call '{}'".format(name))
+                with self.server.lock:
+                    result = getattr(self.server.store, name)(*args,
+                                                              **kwargs)
+                    if name in ('add', 'append'):
+                        result = args[0].serial
+                    elif name in ('iterate', 'iterate_serials',
+                                  'iterate_due', 'query'):
+                        result = list(result)
+                response = {'result': result}
+            except Exception as error:
+                response = {'error': type(error).__name__,
+                            'message': str(error)}
+            _send_message(self.connection, response)
+
+
+class TodoServer():
+    """Keeps a database open and serves it over a Unix socket beside it
+
+    Each client is answered on its own thread, but calls reach the store
+    one at a time.
+    """
+    def __init__(self, location, lock_timeout=LOCK_TIMEOUT):
+        import threading
+        try:
+            import socketserver
+        except ImportError:
+            import SocketServer as socketserver
+
+        self.path = _socket_path(location)
+        if _connect(location) is not None:
+            raise ServerErrorException(
+                "A server is already running on '{}'".format(self.path))
+        elif os.path.exists(self.path):
+            # Left behind by a server that did not shut down cleanly
+            os.remove(self.path)
+
+        self.store = TodoStore(location, lock_timeout)
+        self.lock = threading.Lock()
+        # Only the user may connect
+        umask = os.umask(0o177)
+        try:
+            self._server = socketserver.ThreadingUnixStreamServer(
+                self.path, _RequestHandler)
+        finally:
+            os.umask(umask)
+        self._server.daemon_threads = True
+        self._server.todo = self
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def shutdown(self):
+        """Stops serve_forever, from another thread"""
+        self._server.shutdown()
+
+    def server_close(self):
+        self._server.server_close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.store.close()
+
+
+# Implementation details
+def _confirm():
+    """Handles user input for confirming various questions
+    Allows Trivial Todo to work with both Python 2 & 3
+    """
+    prompt = "(y/N) "
+    if sys.version_info.major == 3:
+        inpt = input(prompt)
+    else:
+        inpt = raw_input(prompt)
+
+    return inpt.lower() in ('y', 'yes')
+
+
+_session = None  # TodoStore kept open for the running command
+_profiler = None  # Profiler for the running command, with --profile
+
+
+def _load_store():
+    """Shortcut for using the store with a context manager
+    Uses the store opened for the current command if there is one, otherwise
+    the store is opened for the duration of the with block.
+    """
+    if _session is not None:
+        return _nullcontext(_session)
+    return TodoStore()
+
+
+@contextmanager
+def _nullcontext(value):
+    yield value
+
+
+def _columns_cached():
+    """Whether the serial column is 64 bits, as the columns cache holds it"""
+    import array
+    return array.array(COLUMN_TYPES[0][0]).itemsize == 8
+
+
+def _numpy():
+    """Returns NumPy if it is installed, or else None"""
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def _phase(phase):
+    """Counts the time spent in a with block towards a phase of the
+    command's profile, if it is being profiled
+    """
+    if _profiler is not None:
+        return _profiler.phase(phase)
+    return _nullcontext(None)
+
+
+def _open_store(location, lock_timeout=LOCK_TIMEOUT, read_only=False):
+    """Connects to the server for a database if one is running, or else
+    opens the database directly
+    """
+    remote = _connect(location)
+    if remote is not None:
+        return remote
+    return TodoStore(location, lock_timeout, read_only)
+
+
+def _connect(location):
+    """Returns a RemoteStore connected to the server for a database, or None
+    if no server is running
+    """
+    path = _socket_path(location)
+    if not os.path.exists(path):
+        return None
+
+    import socket
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(path)
+    except socket.error:
+        connection.close()
+        return None
+    return RemoteStore(connection)
+
+
+def _describe_lock_stats(stats):
+    return ("Lock taken {acquired} times, waited {waited} times for "
+            "{wait_time:.3f}s (longest {longest_wait:.3f}s)".format(**stats))
+
+
+def _describe_plan(query, backend=Backend, cached=False):
+    """Describes how a Query is answered by a backend, or its class, given
+    whether the columns cache is up to date, see Query.use_columns
+    """
+    plan, use_columns = query.plan(), query.use_columns()
+    if use_columns == 'build' or (cached and use_columns is not None):
+        plan = 'columns'
+    paths = {'serial': ('serials', "by number"),
+             'content': ('content', "by the trigrams of their content"
+                         if backend.CONTENT_INDEX else
+                         "by reading the content of every reminder"),
+             'due': ('due', "by due date"),
+             'created': ('created', "by the date they were added"),
+             'category': ('category', "by category"),
+             'scan': (None, "by reading every reminder"),
+             'columns': (None, "from the columns cache")}
+    used, description = paths[plan]
+    filters = [name for name in Query.FIELDS
+               if name not in (used, 'case_insensitive') and
+               getattr(query, name) is not None]
+    if filters:
+        description += ", filtered by " + ', '.join(filters)
+    return "Finding reminders " + description
+
+
+def _describe_profile(report):
+    total = report['total']
+    lines = ["Profile: {:.3f}s".format(total)]
+    for phase in PROFILE_PHASES:
+        elapsed = report['phases'][phase]
+        lines.append("  {:8} {:9.3f}s {:5.1f}%".format(
+            phase, elapsed, elapsed / total * 100 if total else 0))
+    lines.append("Storage: {opens} opens, {keys_read} keys read ({bytes_read} "
+                 "bytes), {keys_written} keys written ({bytes_written} "
+                 "bytes), {keys_deleted} keys deleted".format(
+                     **report['counters']))
+    return '\n'.join(lines)
+
+
+def _write_profile(path, report, argv):
+    """Appends a profile to a JSON Lines file, with the command profiled"""
+    import json
+    report = dict(report, command=argv,
+                  time=time.strftime('%Y-%m-%dT%H:%M:%S'))
+    with open(path, 'a') as stream:
+        stream.write(json.dumps(report, sort_keys=True) + '\n')
+
+
+def _socket_path(location):
+    return os.path.abspath(_split_location(location)[1]) + SOCKET_SUFFIX
+
+
+def _send_message(connection, message):
+    import json
+    data = json.dumps(message, default=_to_message).encode('utf-8')
+    connection.sendall(MESSAGE_HEADER.pack(len(data)) + data)
+
+
+def _receive_message(stream):
+    """Reads a message, returning None at the end of the stream"""
+    import json
+    header = stream.read(MESSAGE_HEADER.size)
+    if len(header) < MESSAGE_HEADER.size:
+        return None
+    data = stream.read(MESSAGE_HEADER.unpack(header)[0])
+    return json.loads(data.decode('utf-8'), object_hook=_from_message)
+
+
+def _to_message(value):
+    """Converts the values JSON has no type for into tagged objects"""
+    if isinstance(value, Reminder):
+        return {'$reminder': _reminder_to_record(value)}
+    elif isinstance(value, Query):
+        return {'$query': value._asdict()}
+    elif isinstance(value, datetime.date):
+        return {'$date': value.isoformat()}
+    raise TypeError("Cannot send {!r}".format(value))
+
+
+def _from_message(value):
+    if '$reminder' in value:
+        return _reminder_from_record(value['$reminder'])
+    elif '$query' in value:
+        return Query(**value['$query'])
+    elif '$date' in value:
+        return datetime.datetime.strptime(value['$date'], '%Y-%m-%d').date()
+    return value
+
+
+@contextmanager
+def _batched_deletes(db):
+    """Stops dbm.dumb rewriting its directory file after every deletion
+    within the block, and writes it once at the end instead. Other dbm
+    modules are left alone.
+    """
+    if (type(db).__module__ not in ('dbm.dumb', 'dumbdbm') or
+            '_commit' in vars(db)):
+        yield
+        return
+
+    commit = db._commit
+    db._commit = lambda: None
+    try:
+        yield
+    finally:
+        del db._commit
+        commit()
+
+
+def _iter_reminders():
+    """Privides an iterator for all of the reminders"""
+    with _load_store() as store:
+        for reminder in store.iterate():
+            yield reminder
+
+
+def _iter_by_category(store, category=None, after=None):
+    """Reminders grouped by category, from the first after `after`"""
+    categories = [category] if category else store.categories()
+    if after is not None:
+        if after.category not in categories:
+            return
+        categories = categories[categories.index(after.category):]
+
+    for name in categories:
+        for reminder in store.iterate(name):
+            if (after is not None and name == after.category and
+                    reminder.serial <= after.serial):
+                continue
+            yield reminder
+
+
+def _iter_by_due(store, after=None):
+    """Reminders by due date, then those without one by serial, from the
+    first after `after`
+    """
+    if after is None or after.date_due:
+        start = (after.date_due, after.serial) if after else None
+        for reminder in store.iterate_due(start):
+            yield reminder
+
+    start = after.serial if after is not None and not after.date_due else 0
+    for reminder in store.iterate_serials(start):
+        if not reminder.date_due:
+            yield reminder
+
+
+def _append_reminder(reminder):
+    with _load_store() as store:
+        store.append(reminder)
+
 
-# Each added reminder is an instance of the following class
-class Reminder():
-    """A reminder unit with a date, optional due date, category, and content"""
-    def __init__(self, content=None, category=None, date_due=None, date=None):
-        self.serial = Reminder.next_serial()
-        self.date = date if date else datetime.date.today()
-        self.content = content
-        self.category = category if category else 'general'
-        self.date_due = date_due
+def _remove_reminder(reminder):
+    with _load_store() as store:
+        store.discard(reminder)
 
-    def __eq__(self, other):
-        """Attempts an equivalency match between two Reminders
-        If a compared field in either Reminder is None, that field
-        is ignored. The date the reminders were added is ignored.
-        """
-        for attrib in ('content', 'category', 'date_due'):
-            self_attr = getattr(self, attrib)
-            other_attr = getattr(other, attrib)
 
-            if self_attr is None or other_attr is None:
-                continue
-            elif self_attr != other_attr:
-                return False
+def _record_key(serial):
+    """Key a reminder is stored under"""
+    return '{}reminder:{}'.format(INTERNAL_PREFIX, serial)
 
-        return True
 
-    def __str__(self):
-        string = "{category}: #{serial} - {content}"
-        if self.date_due:
-            string += " (Due: {date_due})"
+def _staged_key(serial):
+    """Key a renumbered reminder is copied to before it moves"""
+    return '{}renumbered:{}'.format(INTERNAL_PREFIX, serial)
 
-        return string.format(**self.__dict__)
 
-    @staticmethod
-    def next_serial():
-        with _load_reminders() as reminders:
-            serial = reminders.get('serial', 0)
-            serial += 1
-            reminders['serial'] = serial
+def _member_key(category, chunk):
+    """Key of the set of serials in one chunk of a category"""
+    return '{}members:{}:{}'.format(INTERNAL_PREFIX, chunk, category)
 
-        return serial
 
+def _dedup_key(content, category):
+    """Key of the bucket holding every reminder with this content and category
+    The bucket lists (serial, date_due) pairs, so duplicate checks only need to
+    compare due dates.
+    """
+    import hashlib
+    digest = hashlib.sha1(repr((content, category)).encode('utf-8'))
+    return '{}dedup:{}'.format(INTERNAL_PREFIX, digest.hexdigest())
 
-# Exceptions used when adding or removing reminders or parsing a date
-class ReminderExistsException(Exception):
-    pass
 
+def _gram_key(gram, chunk):
+    """Key of the serials in one chunk whose content contains a trigram"""
+    return '{}gram:{}:{}'.format(INTERNAL_PREFIX, chunk, gram)
 
-class ReminderDoesNotExistException(Exception):
-    pass
 
+def _is_index_key(key):
+    return key == CATEGORIES_KEY or key.startswith(
+        (INTERNAL_PREFIX + 'members:', INTERNAL_PREFIX + 'dedup:',
+         INTERNAL_PREFIX + 'gram:'))
 
-class InvalidDateException(Exception):
-    pass
 
+def _to_ordinal(date):
+    return date.toordinal() if date is not None else None
 
-class InvalidSerialException(Exception):
-    pass
 
+def _from_ordinal(ordinal):
+    return datetime.date.fromordinal(ordinal) if ordinal is not None else None
 
-class DatabaseDoesNotExistException(Exception):
-    pass
 
+def _reminder_to_row(reminder):
+    return (reminder.serial, reminder.category, reminder.content,
+            _to_ordinal(reminder.date), _to_ordinal(reminder.date_due))
 
-# Implementation details
-def _confirm():
-    """Handles user input for confirming various questions
-    Allows Trivial Todo to work with both Python 2 & 3
+
+def _reminder_from_row(row):
+    serial, category, content, date, date_due = row
+    reminder = Reminder(content, category, _from_ordinal(date_due),
+                        serial=serial)
+    # As stored, where the constructor would date an undated reminder today
+    reminder.date = _from_ordinal(date)
+    return reminder
+
+
+def _fold(text):
+    """Case folds text for the trigram index"""
+    try:
+        return text.casefold()
+    except AttributeError:
+        # Python 2
+        return text.lower()
+
+
+def _trigrams(text):
+    """The set of case folded three character substrings of some text
+    Any text containing a query, in either case, contains all of the query's
+    trigrams, which makes them a safe filter for substring searches.
     """
-    prompt = "(y/N) "
-    if sys.version_info.major == 3:
-        inpt = input(prompt)
-    else:
-        inpt = raw_input(prompt)
+    if not text:
+        return set()
+    text = _fold(text)
+    return set(text[i:i + 3] for i in range(len(text) - 2))
 
-    return inpt.lower() in ('y', 'yes')
 
+def _content_matches(reminder, content, case_insensitive=False):
+    if case_insensitive:
+        return content.lower() in reminder.content.lower()
+    return content in reminder.content
 
-def _load_reminders(stream=None):
-    """Shortcut for loading the shelve with a context manager"""
-    # Necessary to reload stream for testing purposes
-    if stream is None:
-        stream = DB_LOCATION
-    return closing(shelve.open(stream))
 
+def _due_range(date, before=False, after=False):
+    """Turns the --due/--before/--after options into a (low, high) range of
+    due dates, where None leaves that end open
+    """
+    if before and after:
+        return (None, None)
+    elif after:
+        return (date, None)
+    elif before:
+        return (None, date)
+    return (date, date)
 
-def _iter_reminders():
-    """Privides an iterator for all of the reminders"""
-    with _load_reminders() as reminders:
-        categories = (reminders[x] for x in reminders.keys() if x != 'serial')
-        for reminder in chain(*categories):
-            yield reminder
 
+def _parse_due(value, before=False, after=False):
+    """Parses the --due option, a date or a range of dates such as
+    '3/1..3/15', '3/1..' or '..3/15', along with --before and --after
+    """
+    low, sep, high = value.partition('..')
+    if not sep:
+        return _due_range(parse_date(value), before, after)
+    return (parse_date(low) if low else None,
+            parse_date(high) if high else None)
 
-def _append_reminder(reminder):
-    """Necessary to prevent writeback being required on the shelve"""
-    with _load_reminders() as reminders:
-        temp = reminders.get(reminder.category, [])
-        temp.append(reminder)
-        reminders[reminder.category] = temp
 
+def _in_range(date, bounds):
+    """Whether a date falls in a (low, high) range, where None leaves that
+    end of the range open. A range of None matches anything, even no date.
+    """
+    if bounds is None:
+        return True
+    elif not date:
+        return False
 
-def _remove_reminder(reminder):
-    """Necessary to prevent writeback being required on the shelve"""
-    with _load_reminders() as reminders:
-        temp = reminders.get(reminder.category, [])
-        temp.remove(reminder)
-        if not temp:
-            del reminders[reminder.category]
-        else:
-            reminders[reminder.category] = temp
+    low, high = bounds
+    return (low is None or date >= low) and (high is None or date <= high)
+
+
+def _due_in_range(reminder, due):
+    """Whether a reminder's due date falls in a range from `_due_range`"""
+    return _in_range(reminder.date_due, due)
+
+
+def _describe_index_key(key):
+    if key == CATEGORIES_KEY:
+        return "Category list"
+    elif key.startswith(INTERNAL_PREFIX + 'members:'):
+        return "Category '{}'".format(key.split(':', 2)[2])
+    elif key.startswith(INTERNAL_PREFIX + 'gram:'):
+        return "Trigram '{}'".format(key.split(':', 2)[2])
+    return "Duplicate bucket {}".format(key.split(':', 1)[1][:8])
 
 
 def _parse_absolute_date(date, sep):
@@ -190,32 +3793,152 @@ def _parse_relative_date(date):
     raise InvalidDateException("Cannot parse time: {}".format(date))
 
 
-def _print_results(results):
-    """Helper function used to display results"""
+def _parse_age(age):
+    """Parses an age such as '2 weeks' into the date that long ago
+    Absolute dates like '03/08' are returned as they are.
+    """
+    date = parse_date(age)
+    if ' ' in age:
+        return datetime.date.today() - (date - datetime.date.today())
+    return date
+
+
+def _format_for(path, format=None):
+    """The import/export format to use for a file, from its extension unless
+    one is given
+    """
+    if format:
+        return format
+    elif path and path.lower().endswith('.csv'):
+        return 'csv'
+    return 'jsonl'
+
+
+def _open_for(path, mode):
+    """Opens a file for import or export, where '-' or None means stdin or
+    stdout
+    """
+    if path in (None, '-'):
+        stream = sys.stdin if 'r' in mode else sys.stdout
+        return _nullcontext(stream)
+    return io.open(path, mode, encoding='utf-8', newline='')
+
+
+def _reminder_to_record(reminder):
+    """A reminder as a dictionary of strings, for exporting"""
+    record = dict((field, getattr(reminder, field)) for field in EXPORT_FIELDS)
+    for field in ('date', 'date_due'):
+        record[field] = record[field].isoformat() if record[field] else ''
+    return record
+
+
+def _reminder_from_record(record):
+    """Rebuilds an exported reminder, keeping its serial if it has one"""
+    dates = []
+    for field in ('date', 'date_due'):
+        value = record.get(field)
+        dates.append(datetime.datetime.strptime(value, '%Y-%m-%d').date()
+                     if value else None)
+
+    serial = record.get('serial')
+    return Reminder(record.get('content'), record.get('category'),
+                    dates[1], dates[0], int(serial) if serial else None)
+
+
+def _read_jsonl(stream):
+    import json
+    for line in stream:
+        if line.strip():
+            yield json.loads(line)
+
+
+def _write_jsonl(stream, records):
+    import json
+    for record in records:
+        stream.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def _read_csv(stream):
+    import csv
+    return csv.DictReader(stream)
+
+
+def _write_csv(stream, records):
+    import csv
+    writer = csv.DictWriter(stream, EXPORT_FIELDS)
+    writer.writeheader()
+    for record in records:
+        writer.writerow(record)
+
+
+# Readers and writers for each import/export format
+READERS = {'jsonl': _read_jsonl, 'csv': _read_csv}
+WRITERS = {'jsonl': _write_jsonl, 'csv': _write_csv}
+
+
+def _print_results(results, grouped=True):
+    """Helper function used to display results
+    Results may be a reminder, a list, or an iterator, which is printed as
+    it is read. Reminders are shown under their category unless `grouped`
+    is False; those from an iterator should arrive grouped by category.
+    """
+    with _phase('print'):
+        return _print_reminders(results, grouped)
+
+
+def _print_reminders(results, grouped=True):
     if isinstance(results, Reminder):
         print(results)
         return None
-    elif len(results) == 1:
-        print(results[0])
+    elif isinstance(results, list):
+        categories = {}
+        for result in results:
+            categories.setdefault(result.category, []).append(result)
+        results = itertools.chain.from_iterable(categories.values())
+
+    # A single reminder is shown on its own
+    results = iter(results)
+    first = next(results, None)
+    second = next(results, None)
+    if first is None:
+        return None
+    elif second is None:
+        print(first)
         return None
 
-    categories = {}
-    for result in results:
-        categories.setdefault(result.category, []).append(result)
+    category = None
+    for reminder in itertools.chain([first, second], results):
+        if not grouped:
+            print(reminder)
+            continue
+        elif reminder.category != category:
+            category = reminder.category
+            print("{}:".format(category))
 
-    for category, lst in categories.items():
-        print("{}:".format(category))
-        for reminder in lst:
-            string = "\t#{serial} - {content}"
+        string = "\t#{serial} - {content}"
+
+        if reminder.date_due:
+            string += " ({date_due})"
+
+        print(string.format(**reminder._asdict()))
 
-            if reminder.date_due:
-                string += " ({date_due})"
 
-            print(string.format(**reminder.__dict__))
+def _paginate(reminders, limit):
+    """Yields up to `limit` reminders, then says on standard error how to
+    list the next page if there are more
+    """
+    last = None
+    for reminder in itertools.islice(reminders, limit):
+        last = reminder
+        yield reminder
+
+    if last is not None and next(reminders, None) is not None:
+        sys.stderr.write("More reminders follow, list them with --cursor "
+                         "{}\n".format(last.serial))
 
 
 def _create_new_database(path):
-    """Used when specified shelve database does not exist"""
+    """Used when specified database does not exist"""
     print("Database at '{}' does not exist, create it?".format(path))
     if _confirm():
         return True
@@ -227,66 +3950,270 @@ def search_field(target, field):
     """Returns all matching reminders based on a given field and target data
     Returns a list of matches
     """
-    matches = []
+    with _load_store() as store:
+        return store.search(target, field)
 
-    for reminder in _iter_reminders():
-        if target == getattr(reminder, field):
-            matches.append(reminder)
 
-    if not matches:
-        raise ReminderDoesNotExistException("Could not find matching reminder")
+def search_in_content(content, case_insensitive=False, due=None):
+    """Searches for reminders by partial content
+    Returns a list of all matches. Optional parameter for case insensitivity.
+    Case sensitive by default. Matches can be limited to a (low, high) range
+    of due dates, see `_due_range`.
+    """
+    with _load_store() as store:
+        return store.search_content(content, case_insensitive, due)
+
 
-    return matches
+def search_due(due):
+    """Returns the reminders due within a (low, high) range of dates, see
+    `_due_range`. Reminders are ordered by due date.
+    """
+    with _load_store() as store:
+        return store.search_due(due)
 
 
-def search_in_content(content, case_insensitive=False):
-    """Searches for reminders by partial content
-    Returns a list of all matches. Optional parameter for case insensitivity.
-    Case sensitive by default.
+def search_created(created):
+    """Returns the reminders added within a (low, high) range of dates,
+    ordered by the date they were added
     """
-    matches = []
+    with _load_store() as store:
+        return store.search_created(created)
 
-    if case_insensitive:
-        target = content.lower()
+
+def search_query(query):
+    """Returns the reminders matching a Query, see `Query.plan` for how they
+    are found
+    """
+    with _load_store() as store:
+        return list(store.query(query))
+
+
+def search_databases(query, locations, jobs=1, lock_timeout=LOCK_TIMEOUT):
+    """Returns the reminders matching a Query in each of several databases,
+    as a list of (location, reminders) pairs in the order given
+
+    With more than one job the databases are searched at once by a pool of
+    processes, and the serials of a database whose content would be scanned
+    are split into a range for each job, see `_split_query`. Each process
+    reads from the database's snapshot, see SnapshotBackend, and sends back
+    only the reminders that match, in order of serial.
+    """
+    parts = [(location, part) for location in locations
+             for part in _split_query(query, location, jobs, lock_timeout)]
+    pool = None
+    if jobs > 1 and len(parts) > 1:
+        try:
+            from concurrent.futures import ProcessPoolExecutor
+        except ImportError:
+            # Python 2 without the futures backport
+            pass
+        else:
+            pool = ProcessPoolExecutor(min(jobs, len(parts)))
+
+    arguments = ([location for location, part in parts],
+                 [part for location, part in parts],
+                 [lock_timeout] * len(parts))
+    if pool is None:
+        found = map(_search_part, *arguments)
     else:
-        target = content
+        with pool:
+            found = list(pool.map(_search_part, *arguments))
 
-    for reminder in _iter_reminders():
-        if case_insensitive:
-            search = reminder.content.lower()
+    results = [(location, []) for location in locations]
+    positions = dict((location, index)
+                     for index, location in enumerate(locations))
+    for (location, part), records in zip(parts, found):
+        results[positions[location]][1].extend(
+            Reminder.decode(record) for record in records)
+    return results
+
+
+def _split_query(query, location, parts, lock_timeout=LOCK_TIMEOUT):
+    """Splits a Query into up to `parts` queries over consecutive ranges of
+    serials, if it would scan the content of every reminder in the database
+    at `location`. Served databases are left to their server.
+    """
+    if (parts < 2 or query.content is None or
+            query.plan() not in ('content', 'category', 'scan') or
+            os.path.exists(_socket_path(location))):
+        return [query]
+
+    with TodoStore(location, lock_timeout, read_only=True) as store:
+        with store.transaction():
+            last = store.backend.last_serial()
+    low, high = query.serials or (None, None)
+    low = max(low or 1, 1)
+    high = min(high, last) if high is not None else last
+    if high < low:
+        return [query]
+
+    size = -(-(high - low + 1) // parts)
+    fields = query._asdict()
+    split = []
+    for start in range(low, high + 1, size):
+        fields['serials'] = (start, min(start + size - 1, high))
+        split.append(Query(**fields))
+    return split
+
+
+def _search_part(location, query, lock_timeout=LOCK_TIMEOUT):
+    """Searches one database for `search_databases`, perhaps in another
+    process, returning the matching reminders encoded
+    """
+    with _open_store(location, lock_timeout, read_only=True) as store:
+        return [reminder.encode() for reminder in store.query(query)]
+
+
+def reminder_stats(today=None):
+    """Counts reminders by category, due date and more, see Columns.stats
+    The cached Columns snapshot is used if it is up to date.
+    """
+    with _load_store() as store:
+        if hasattr(store, 'columns'):
+            columns = store.columns()
         else:
-            search = reminder.content
+            # Served stores only send reminders
+            columns = Columns.build(store.iterate())
+    return columns.stats(today)
+
 
-        if target in search:
-            matches.append(reminder)
+def list_reminders(category=None, sort=None, cursor=None):
+    """Yields reminders as they are read, for listing
+    Reminders come grouped by category and in order of serial within each,
+    or with `sort`, in order of 'serial' or of 'due' date, followed by those
+    without a due date. Listing resumes after the reminder numbered `cursor`
+    if one is given.
+    """
+    with _load_store() as store:
+        after = store.get(cursor) if cursor is not None else None
+        if cursor is not None and after is None and sort != 'serial':
+            raise ReminderDoesNotExistException(
+                "Cannot continue after #{}, which no longer "
+                "exists".format(cursor))
+
+        if sort == 'serial':
+            reminders = store.iterate_serials(cursor or 0)
+        elif sort == 'due':
+            reminders = _iter_by_due(store, after)
+        else:
+            reminders = _iter_by_category(store, category, after)
 
-    return matches
+        # Let go of the store's lock before it is closed, should listing
+        # stop early
+        try:
+            for reminder in reminders:
+                if category is None or reminder.category == category:
+                    yield reminder
+        finally:
+            if hasattr(reminders, 'close'):
+                reminders.close()
 
 
 def reminder_exists(reminder):
     """Check to determine of a reminder exists, returning a bool"""
-    for item in _iter_reminders():
-        if item == reminder:
-            return True
-
-    return False
+    with _load_store() as store:
+        return store.exists(reminder)
 
 
 def add_reminder(reminder):
     """Adds a reminder to the database unless it already exists"""
-    if reminder_exists(reminder):
-        raise ReminderExistsException("Reminder already exists")
+    with _load_store() as store:
+        store.add(reminder)
+
+
+def remove_reminders(query):
+    """Removes every reminder matching a Query in a single transaction
+    Returns the removed reminders.
+    """
+    with _load_store() as store:
+        return store.remove_matching(query)
+
 
-    _append_reminder(reminder)
+def update_reminder(serial, **fields):
+    """Changes fields of a stored reminder in place, see TodoStore.update
+    Returns the changed reminder.
+    """
+    with _load_store() as store:
+        return store.update(serial, **fields)
 
 
 def delete_reminder(reminder):
     """Removes a reminder if one exists"""
-    if not reminder_exists(reminder):
-        raise ReminderDoesNotExistException(
-            "The reminder that you're attempting to remove does not exist.")
+    with _load_store() as store:
+        store.remove(reminder)
+
+
+def rebuild_indexes():
+    """Rebuilds the serial and dedup indexes from scratch
+    Returns the number of reminders indexed
+    """
+    with _load_store() as store:
+        return store.rebuild_indexes()
+
+
+def renumber_reminders():
+    """Numbers the reminders from 1 without gaps, keeping their order
+    Returns a list of (old, new) serials for the reminders that moved.
+    """
+    with _load_store() as store:
+        return store.renumber()
+
+
+def verify_indexes():
+    """Compares the indexes against the stored reminders
+    Returns a list of problems found, which is empty for sound indexes
+    """
+    with _load_store() as store:
+        return store.verify_indexes()
+
+
+def export_reminders(stream, format='jsonl'):
+    """Writes every reminder to a stream, one at a time
+    Returns the number of reminders written.
+    """
+    count = [0]
+
+    def records(store):
+        for reminder in store:
+            count[0] += 1
+            yield _reminder_to_record(reminder)
+
+    with _load_store() as store:
+        WRITERS[format](stream, records(store))
+
+    return count[0]
+
+
+def import_reminders(stream, format='jsonl', batch_size=IMPORT_BATCH_SIZE,
+                     keep_serials=False):
+    """Adds the reminders read from a stream, one at a time
+    Returns the number of reminders added and the number skipped because
+    they already exist.
+    """
+    reminders = (_reminder_from_record(record)
+                 for record in READERS[format](stream))
+    with _load_store() as store:
+        return store.add_many(reminders, batch_size, keep_serials)
+
+
+def compact_database():
+    """Reclaims the space left behind by removed reminders"""
+    with _load_store() as store:
+        store.compact()
+
 
-    _remove_reminder(reminder)
+def serve_database(location, lock_timeout=LOCK_TIMEOUT):
+    """Serves a database to other todo commands until interrupted"""
+    import signal
+    server = TodoServer(location, lock_timeout)
+    # Shut down cleanly when killed as well as when interrupted
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
 
 
 def parse_date(date):
@@ -315,6 +4242,8 @@ def add(args):
     arguments = {}
 
     if not args.content:
+        import subprocess
+        import tempfile
         content = tempfile.mktemp()
         subprocess.call([os.getenv('EDITOR'), content])
         with open(content) as text:
@@ -334,6 +4263,9 @@ def add(args):
 
 def remove(args):
     """Called by the 'remove' subparser"""
+    if getattr(args, 'serial', None) is None:
+        return _remove_matching(args)
+
     reminder = search_field(args.serial, 'serial')[0]
     if not args.confirm:
         print("Remove '{}'?".format(reminder))
@@ -343,30 +4275,80 @@ def remove(args):
         print("Reminder removed successfully")
 
 
+def _remove_matching(args):
+    """Removes the reminders matching the options to remove, asking once for
+    all of them
+
+    The lock is held from finding the reminders until they are removed, so
+    that exactly those listed go.
+    """
+    due = None
+    if args.due_before:
+        due = (None, parse_date(args.due_before) - datetime.timedelta(days=1))
+    query = Query(args.category, due=due, serials=args.serials)
+
+    with _load_store() as store, store.transaction(exclusive=True):
+        reminders = list(store.query(query))
+        if not args.confirm:
+            counts = {}
+            for reminder in reminders:
+                counts[reminder.category] = \
+                    counts.get(reminder.category, 0) + 1
+            if not counts:
+                print("No reminders match")
+                return
+
+            print("Remove {} reminders?".format(len(reminders)))
+            for category, count in sorted(counts.items()):
+                print("\t{}: {}".format(category, count))
+            if not _confirm():
+                return
+
+        removed = store.remove_many(
+            [reminder.serial for reminder in reminders])
+    print("Removed {} reminders".format(len(removed)))
+
+
 def search(args):
     """Called by the 'search' subparser"""
-    if args.content:
-        reminders = search_in_content(args.content, args.insensitive)
-    else:
-        reminders = []
+    due = None
+    if getattr(args, 'overdue', False):
+        due = (None, datetime.date.today() - datetime.timedelta(days=1))
+    elif args.date_due:
+        due = _parse_due(args.date_due, args.before, args.after)
 
-    if args.date_due and reminders:
-        date = parse_date(args.date_due)
-        matches = []
+    created = None
+    if getattr(args, 'older', None) or getattr(args, 'newer', None):
+        created = (_parse_age(args.newer) if args.newer else None,
+                   _parse_age(args.older) if args.older else None)
 
-        for reminder in reminders:
-            if not reminder.date_due:
-                continue
-            elif args.after and reminder.date_due >= date:
-                matches.append(reminder)
-            elif args.before and reminder.date_due <= date:
-                matches.append(reminder)
-            elif reminder.date_due == date:
-                matches.append(reminder)
+    query = Query(getattr(args, 'category', None), args.content,
+                  args.insensitive, due, created,
+                  getattr(args, 'serials', None))
+    if getattr(args, 'explain', False):
+        # The backend answering the search, or for a served database or
+        # one not yet open, that of its location
+        backend = getattr(_session, 'backend', None)
+        if backend is None:
+            backend = BACKENDS[_split_location(DB_LOCATION)[0]]
+        cached = (query.use_columns() == 'cached' and
+                  hasattr(_session, 'columns') and
+                  _session.columns(build=False) is not None)
+        sys.stderr.write(_describe_plan(query, backend, cached) + '\n')
+    if query.is_empty():
+        return _print_results([])
 
-        return _print_results(matches)
+    locations = getattr(args, 'db', None) or [DB_LOCATION]
+    jobs = getattr(args, 'jobs', 1)
+    if len(locations) == 1 and jobs == 1:
+        return _print_results(search_query(query))
 
-    return _print_results(reminders)
+    results = search_databases(query, locations, jobs,
+                               getattr(args, 'lock_timeout', LOCK_TIMEOUT))
+    for location, reminders in results:
+        if len(locations) > 1 and reminders:
+            print("Database {}:".format(location))
+        _print_results(reminders)
 
 
 def lst(args):
@@ -376,29 +4358,152 @@ def lst(args):
             return _print_results(search_field(args.serial, 'serial')[0])
         except ValueError:
             raise InvalidSerialException("{} is not a valid serial number")
-    elif args.category:
-        return _print_results(search_field(args.category, 'category'))
-    else:
-        return _print_results(list(_iter_reminders()))
+
+    sort = getattr(args, 'sort', None)
+    cursor = getattr(args, 'cursor', None)
+    offset = getattr(args, 'offset', None)
+    limit = getattr(args, 'limit', None)
+    reminders = listing = list_reminders(args.category, sort, cursor)
+    if args.category and cursor is None and not offset:
+        first = next(reminders, None)
+        if first is None:
+            raise ReminderDoesNotExistException(
+                "Could not find matching reminder")
+        reminders = itertools.chain([first], reminders)
+
+    if offset:
+        reminders = itertools.islice(reminders, offset, None)
+    if limit is not None:
+        reminders = _paginate(reminders, limit)
+    try:
+        return _print_results(reminders, grouped=sort is None)
+    finally:
+        listing.close()
 
 
 def edit(args):
+    """Called by the 'edit' subparser"""
+    fields = {}
+    if getattr(args, 'category', None):
+        fields['category'] = args.category
+    if getattr(args, 'no_due', False):
+        fields['date_due'] = None
+    elif getattr(args, 'date_due', None):
+        fields['date_due'] = parse_date(args.date_due)
+    if fields:
+        return update_reminder(args.serial, **fields)
+
+    import subprocess
+    import tempfile
     content = tempfile.mktemp()
     reminder = search_field(args.serial, 'serial')[0]
-    _remove_reminder(reminder)
 
     with open(content, 'w') as text:
         text.write(reminder.content)
 
     subprocess.call([os.getenv('EDITOR'), content])
 
+    # The reminder stays stored while the editor is open
     with open(content) as text:
-        reminder.content = '\n'.join(text.readlines()).strip()
+        update_reminder(reminder.serial,
+                        content='\n'.join(text.readlines()).strip())
 
-    _append_reminder(reminder)
 
+def compact(args):
+    """Called by the 'compact' subparser"""
+    compact_database()
+    print("Database compacted")
 
-if __name__ == '__main__':
+
+def serve(args):
+    """Called by the 'serve' subparser"""
+    remote = _connect(DB_LOCATION)
+    if remote is not None:
+        remote.close()
+        print("A server is already running for '{}'".format(DB_LOCATION))
+        sys.exit(1)
+
+    print("Serving '{}' on {}".format(DB_LOCATION, _socket_path(DB_LOCATION)))
+    sys.stdout.flush()
+    serve_database(DB_LOCATION, args.lock_timeout)
+
+
+def renumber(args):
+    """Called by the 'renumber' subparser"""
+    moved = renumber_reminders()
+    for old, new in moved:
+        print("#{} -> #{}".format(old, new))
+    print("Renumbered {} reminders".format(len(moved)))
+
+
+def export(args):
+    """Called by the 'export' subparser"""
+    format = _format_for(args.file, args.format)
+    with _open_for(args.file, 'w') as stream:
+        count = export_reminders(stream, format)
+
+    if args.file not in (None, '-'):
+        print("Exported {} reminders".format(count))
+
+
+def import_(args):
+    """Called by the 'import' subparser"""
+    format = _format_for(args.file, args.format)
+    with _open_for(args.file, 'r') as stream:
+        added, skipped = import_reminders(stream, format, args.batch_size,
+                                          args.keep_serials)
+
+    print("Imported {} reminders, skipped {} already present".format(
+        added, skipped))
+
+
+def convert(args):
+    """Called by the 'convert' subparser"""
+    count = convert_database(args.source, args.destination)
+    print("Copied {} reminders to '{}'".format(count, args.destination))
+
+
+def stats(args):
+    """Called by the 'stats' subparser"""
+    counts = reminder_stats()
+    if args.json:
+        import json
+        print(json.dumps(counts, indent=2, sort_keys=True))
+        return
+
+    print("{total} reminders, {overdue} overdue, {due_today} due today, "
+          "{undated} without a due date".format(**counts))
+    if counts['categories']:
+        width = max(len(name) for name in counts['categories'])
+        print("\n{:{}}  {:>9}  {:>7}".format('Category', width, 'Reminders',
+                                             'Overdue'))
+        for name, (count, overdue) in sorted(counts['categories'].items()):
+            print("{:{}}  {:>9}  {:>7}".format(name, width, count, overdue))
+    if counts['due_by_month']:
+        print("\n{:7}  {:>9}".format('Due', 'Reminders'))
+        for month, count in sorted(counts['due_by_month'].items()):
+            print("{:7}  {:>9}".format(month, count))
+
+
+def reindex(args):
+    """Called by the 'reindex' subparser"""
+    if args.verify:
+        problems = verify_indexes()
+        for problem in problems:
+            print(problem)
+        if problems:
+            print("Indexes are inconsistent, run 'todo reindex' to rebuild "
+                  "them")
+            sys.exit(1)
+        print("Indexes are consistent")
+    else:
+        count = rebuild_indexes()
+        print("Indexed {} reminders".format(count))
+
+
+def _build_parser():
+    """Builds the parser for every command"""
+    import argparse
     parser = argparse.ArgumentParser(
         description="""Trivial Todo keeps track of your reminders. Remember to
         enclose multi-word arguments in quotes! For help on the sub commands,
@@ -411,7 +4516,30 @@ if __name__ == '__main__':
         year if omitted. Either a period, dash or slash may be used (eg. 03/08
         or 03.08 or 03-08).""")
 
-    parser.add_argument('--db', '-d', help="Use specified shelve database")
+    parser.add_argument('--db', '-d', help="""Use specified database. The
+            backend is chosen by a 'shelve://', 'sqlite://' or 'journal://'
+            prefix, or else by the file (.sqlite, .sqlite3 and .db files use
+            SQLite, .journal files use a journal). search may be given
+            several databases, and searches them all""", action='append')
+    parser.add_argument(
+        '--lock-timeout', type=float, default=LOCK_TIMEOUT, metavar='SECONDS',
+        help="""how long to wait for other todo processes to finish with the
+        database (default: {:g})""".format(LOCK_TIMEOUT))
+    parser.add_argument(
+        '--lock-stats', help="""report how long the command waited for the
+        database's lock on standard error""", default=False,
+        action='store_const', const=True)
+    parser.add_argument(
+        '--profile', help="""report the time spent in each phase of the
+        command, and the keys and bytes the database read and wrote, on
+        standard error. With a server running, the server does the database's
+        work.""", default=False, action='store_const', const=True)
+    parser.add_argument(
+        '--profile-json', help="""append the profile to a JSON Lines file,
+        along with the command profiled""", metavar='FILE', default=None)
+    parser.add_argument(
+        '--cprofile', help="""write cProfile statistics for the command to a
+        file, for use with pstats""", metavar='FILE', default=None)
 
     subparsers = parser.add_subparsers(help="Commands for todo:")
 
@@ -428,9 +4556,20 @@ if __name__ == '__main__':
 
     # Remove reminders
     parser_remove = subparsers.add_parser('remove', help="""remove reminders
-            by number""")
+            by number, or all of those in a category, due before a date or
+            numbered within a range""")
     parser_remove.add_argument('serial', help="""number of the reminder to be
-            removed""", metavar='NUMBER', type=int)
+            removed""", metavar='NUMBER', type=int, nargs='?', default=None)
+    parser_remove.add_argument(
+        '--category', '-c', help="remove the reminders in a category",
+        default=None)
+    parser_remove.add_argument(
+        '--due-before', help="""remove the reminders due before a date,
+        not on it""", metavar='DATE', default=None)
+    parser_remove.add_argument(
+        '--numbers', '-n', help="""remove the reminders numbered within a
+        range, such as 10..20, 10.. or ..20""", dest='serials',
+        metavar='RANGE', type=_serial_range, default=None)
     parser_remove.add_argument(
         '--yes', '-y', action='store_const',
         const=True, help="""bypasses request for approval before removing
@@ -441,9 +4580,14 @@ if __name__ == '__main__':
     parser_search = subparsers.add_parser('search', help="search reminders")
     parser_search.add_argument('content', help="find reminders by content",
                                nargs='?', default=None)
-    parser_search.add_argument(
-        '--due', '-d', help="find reminders by due date",
-        dest='date_due', default=None)
+    due_group = parser_search.add_mutually_exclusive_group()
+    due_group.add_argument(
+        '--due', '-d', help="""find reminders by due date, or due within a
+        range such as 3/1..3/15, 3/1.. or ..3/15""", dest='date_due',
+        default=None)
+    due_group.add_argument(
+        '--overdue', '-o', help="find reminders due before today",
+        default=False, action='store_const', const=True)
     parser_search.add_argument(
         '--before', '-b', help=("search for due dates prior to given date. "
                                 "(if no date is given, this will be ignored)"),
@@ -452,9 +4596,31 @@ if __name__ == '__main__':
         '--after', '-a', help=("search for due dates following given date. "
                                "(if no date is given, this will be ignored)"),
         default=False, action='store_const', const=True)
+    parser_search.add_argument(
+        '--older-than', help="""find reminders added at least this long ago
+        (eg. '2 weeks') or on or before a date""", dest='older',
+        metavar='AGE', default=None)
+    parser_search.add_argument(
+        '--newer-than', help="""find reminders added at most this long ago
+        (eg. '3 days') or on or after a date""", dest='newer',
+        metavar='AGE', default=None)
     parser_search.add_argument(
         '--ignore-case', '-i', help="case insensitive search",
         dest='insensitive', const=True, default=False, action='store_const')
+    parser_search.add_argument(
+        '--category', '-c', help="find reminders in a category",
+        default=None)
+    parser_search.add_argument(
+        '--numbers', '-n', help="""find reminders numbered within a range,
+        such as 10..20, 10.. or ..20""", dest='serials', metavar='RANGE',
+        type=_serial_range, default=None)
+    parser_search.add_argument(
+        '--explain', help="""describe how the reminders are found on
+        standard error""", default=False, action='store_const', const=True)
+    parser_search.add_argument(
+        '--jobs', '-j', help="""search with this many processes, splitting
+        each database's reminders between them (default: 1)""", type=int,
+        default=1, metavar='N')
     parser_search.set_defaults(func=search)
 
     # List reminders
@@ -464,25 +4630,283 @@ if __name__ == '__main__':
                        dest='serial', default=None, metavar='NUMBER', type=int)
     group.add_argument('--category', '-c', help="""list reminders in a
             category""", default=None)
+    parser_list.add_argument(
+        '--sort', '-s', choices=LIST_ORDERS, default=None, help="""list
+        reminders in order of number or of due date instead of by
+        category""")
+    parser_list.add_argument(
+        '--limit', '-l', type=_page_size, default=None, metavar='COUNT',
+        help="""list at most this many reminders, at least one, and say how
+        to list the next page""")
+    parser_list.add_argument(
+        '--offset', type=_count, default=None, metavar='COUNT', help="""skip
+        this many reminders""")
+    parser_list.add_argument(
+        '--cursor', type=int, default=None, metavar='NUMBER', help="""list
+        the reminders after this one, as given at the end of a page""")
     parser_list.set_defaults(func=lst)
 
     # Edit reminder
     parser_edit = subparsers.add_parser('edit', help="edit a reminder")
     parser_edit.add_argument('serial', help="""number of the reminder to be
             edited""", metavar='NUMBER', type=int)
+    parser_edit.add_argument('--category', '-c', help="""move the reminder to
+            this category instead of editing its content""")
+    due_group = parser_edit.add_mutually_exclusive_group()
+    due_group.add_argument('--due', '-d', help="""change the reminder's due
+            date instead of editing its content""", dest='date_due')
+    due_group.add_argument(
+        '--no-due', help="""clear the reminder's due date instead of
+        editing its content""", default=False, action='store_const',
+        const=True)
     parser_edit.set_defaults(func=edit)
 
-    args = parser.parse_args()
+    # Count reminders
+    parser_stats = subparsers.add_parser('stats', help="""count reminders by
+            category and by month due, and those overdue""")
+    parser_stats.add_argument(
+        '--json', help="print the counts as JSON", default=False,
+        action='store_const', const=True)
+    parser_stats.set_defaults(func=stats)
+
+    # Rebuild or verify indexes
+    parser_reindex = subparsers.add_parser('reindex', help="""rebuild the
+            indexes used to look up, search and deduplicate reminders""")
+    parser_reindex.add_argument(
+        '--verify', help="check the indexes without changing them",
+        default=False, action='store_const', const=True)
+    parser_reindex.set_defaults(func=reindex)
+
+    # Reclaim space
+    parser_compact = subparsers.add_parser('compact', help="""reclaim space
+            left by removed reminders, and fold a journal's log into its
+            snapshot""")
+    parser_compact.set_defaults(func=compact)
+
+    # Keep the database open for other commands
+    parser_serve = subparsers.add_parser('serve', help="""keep the database
+            open and answer other todo commands for it over a Unix socket,
+            until interrupted. Commands use a running server instead of
+            opening the database themselves.""")
+    parser_serve.set_defaults(func=serve)
+
+    # Close the gaps left in the serials by removed reminders
+    parser_renumber = subparsers.add_parser('renumber', help="""number the
+            reminders from 1 without gaps, printing each old and new
+            number""")
+    parser_renumber.set_defaults(func=renumber)
+
+    # Copy reminders between databases
+    parser_convert = subparsers.add_parser('convert', help="""copy all
+            reminders into a new database, which may use another backend""")
+    parser_convert.add_argument('source', help="database to copy from")
+    parser_convert.add_argument('destination', help="database to copy to")
+    parser_convert.set_defaults(func=convert)
+
+    # Export and import reminders
+    parser_export = subparsers.add_parser('export', help="""write all
+            reminders to a JSON Lines or CSV file""")
+    parser_export.add_argument('file', help="""file to write, or '-' for
+            standard output (default)""", nargs='?', default=None)
+    parser_export.add_argument(
+        '--format', '-f', choices=sorted(WRITERS), help="""file format
+        (default: csv for .csv files, otherwise jsonl)""")
+    parser_export.set_defaults(func=export)
+
+    parser_import = subparsers.add_parser('import', help="""add reminders
+            from a JSON Lines or CSV file""")
+    parser_import.add_argument('file', help="""file to read, or '-' for
+            standard input""")
+    parser_import.add_argument(
+        '--format', '-f', choices=sorted(READERS), help="""file format
+        (default: csv for .csv files, otherwise jsonl)""")
+    parser_import.add_argument(
+        '--batch-size', '-b', type=int, default=IMPORT_BATCH_SIZE,
+        help="""reminders written per transaction (default: {})""".format(
+            IMPORT_BATCH_SIZE))
+    parser_import.add_argument(
+        '--keep-serials', help="""keep the numbers reminders were exported
+        with instead of numbering them anew""", default=False,
+        action='store_const', const=True)
+    parser_import.set_defaults(func=import_)
+
+    return parser
+
+
+class _Arguments():
+    """Parsed arguments, as argparse would give them"""
+    def __init__(self, **values):
+        self.__dict__.update(values)
+
+
+def _serial_range(value):
+    """Parses a range of serials such as '10..20', '10..' or '..20', or a
+    single serial
+    """
+    low, sep, high = value.partition('..')
+    if not sep:
+        high = low
+    return (int(low) if low else None, int(high) if high else None)
+
+
+def _count(value):
+    """Parses a number of reminders to skip, which cannot be negative"""
+    count = int(value)
+    if count < 0:
+        raise ValueError("Negative count {}".format(count))
+    return count
+
+
+def _page_size(value):
+    """Parses a number of reminders to list, which must be at least one"""
+    size = int(value)
+    if size < 1:
+        raise ValueError("Page size {} is not positive".format(size))
+    return size
+
+
+def _list_order(value):
+    if value not in LIST_ORDERS:
+        raise ValueError("Unknown order '{}'".format(value))
+    return value
+
+
+# Commands `_parse_fast` understands, with their defaults and their options
+# mapped to (destination, type), where a type of None marks a flag
+FAST_COMMANDS = {
+    'list': ({'serial': None, 'category': None, 'sort': None, 'limit': None,
+              'offset': None, 'cursor': None},
+             {'-n': ('serial', int), '--number': ('serial', int),
+              '-c': ('category', str), '--category': ('category', str),
+              '-s': ('sort', _list_order), '--sort': ('sort', _list_order),
+              '-l': ('limit', _page_size), '--limit': ('limit', _page_size),
+              '--offset': ('offset', _count), '--cursor': ('cursor', int)}),
+    'search': ({'content': None, 'date_due': None, 'overdue': False,
+                'before': False, 'after': False, 'older': None,
+                'newer': None, 'insensitive': False, 'category': None,
+                'serials': None, 'explain': False, 'jobs': 1},
+               {'-i': ('insensitive', None),
+                '--ignore-case': ('insensitive', None),
+                '-c': ('category', str), '--category': ('category', str),
+                '-n': ('serials', _serial_range),
+                '--numbers': ('serials', _serial_range),
+                '-j': ('jobs', int), '--jobs': ('jobs', int)}),
+}
+
+
+def _parse_fast(argv):
+    """Parses the simplest and most common read commands without building
+    the full parser, returning None for anything else
+    """
+    values = {'db': None, 'lock_timeout': LOCK_TIMEOUT, 'lock_stats': False,
+              'profile': False, 'profile_json': None, 'cprofile': None}
+    while argv and argv[0] not in FAST_COMMANDS:
+        if len(argv) > 2 and argv[0] in ('--db', '-d') and not values['db']:
+            values['db'], argv = [argv[1]], argv[2:]
+        elif argv[0] == '--profile' and not values['profile']:
+            values['profile'], argv = True, argv[1:]
+        else:
+            return None
+    if not argv:
+        return None
+
+    command, tokens = argv[0], iter(argv[1:])
+    defaults, options = FAST_COMMANDS[command]
+    values.update(defaults)
+    values['func'] = {'list': lst, 'search': search}[command]
+    given, positional = set(), []
+    for token in tokens:
+        if token not in options:
+            if token.startswith('-'):
+                return None
+            positional.append(token)
+            continue
+
+        destination, kind = options[token]
+        if destination in given:
+            return None
+        given.add(destination)
+        if kind is None:
+            values[destination] = True
+            continue
+
+        value = next(tokens, None)
+        if value is None or value.startswith('-'):
+            return None
+        try:
+            values[destination] = kind(value)
+        except ValueError:
+            return None
+
+    # Leave mistakes to argparse, which reports them
+    if command == 'list' and (positional or
+                              set(['serial', 'category']) <= given):
+        return None
+    elif command == 'search':
+        if len(positional) != 1:
+            return None
+        values['content'] = positional[0]
+
+    return _Arguments(**values)
+
+
+if __name__ == '__main__':
+    started = _clock()
+    args = _parse_fast(sys.argv[1:])
+    if args is None:
+        args = _build_parser().parse_args()
+
+    if getattr(args, 'profile', False) or getattr(args, 'profile_json', None):
+        _profiler = Profiler()
+        _profiler.add('parse', _clock() - started)
+    if getattr(args, 'cprofile', None):
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+
+    if getattr(args, 'func', None) is remove and (args.serial is None) == (
+            args.category is None and args.due_before is None and
+            args.serials is None):
+        _build_parser().error("remove takes a reminder's number, or any of "
+                              "--category, --due-before and --numbers")
 
     if args.db:
-        if not os.path.exists(args.db):
-            _create_new_database(args.db)
-        DB_LOCATION = args.db
+        if len(args.db) > 1 and getattr(args, 'func', None) is not search:
+            _build_parser().error("only search can use several databases")
+        for location in args.db:
+            if not _database_exists(location):
+                _create_new_database(location)
+        DB_LOCATION = args.db[0]
     else:
-        if not os.path.exists(DB_LOCATION):
+        if not _database_exists(DB_LOCATION):
             _create_new_database(DB_LOCATION)
 
-    if hasattr(args, 'func'):
-        args.func(args)
+    if getattr(args, 'func', None) is serve:
+        serve(args)
+    elif hasattr(args, 'func'):
+        try:
+            # Commands that only read are served from a mapped snapshot
+            read_only = args.func in (lst, search, stats)
+            with _open_store(DB_LOCATION, args.lock_timeout,
+                             read_only) as _session:
+                with _phase('filter'):
+                    args.func(args)
+        except IOError as error:
+            # Output piped into a command that stopped reading, such as head
+            if error.errno != errno.EPIPE:
+                raise
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        if args.lock_stats and hasattr(_session, 'lock_stats'):
+            sys.stderr.write(_describe_lock_stats(_session.lock_stats) + '\n')
     else:
-        parser.print_help()
+        _build_parser().print_help()
+
+    if getattr(args, 'cprofile', None):
+        profile.disable()
+        profile.dump_stats(args.cprofile)
+    if _profiler is not None:
+        if args.profile_json:
+            _write_profile(args.profile_json, _profiler.report(),
+                           sys.argv[1:])
+        if args.profile:
+            sys.stderr.write(_describe_profile(_profiler.report()) + '\n')